@@ -0,0 +1,87 @@
+"""
+Compare the throughput of the alignment backends in nextgen4b.process.align,
+and check that they agree on scores and alignments.
+
+Usage:
+    python benchmarks/bench_align.py [n_reads] [template]
+
+needle is only benchmarked if it is on the path.
+"""
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+
+from nextgen4b.process.align import align_seqs
+
+TEMPLATE = ('GGGCTAGTCGTCTGTATAGGTCTTGCTTCTATCTTTGGCTTCTGTATTTGTCGTCTTGCTTATTG'
+            'TTCTTGTTCTTATGTTCTGTTCTGGTATTTCGGTT')
+
+
+def mutate(template, rng, sub_rate=0.01, indel_rate=0.002):
+    read = []
+    for c in template:
+        r = rng.random()
+        if r < indel_rate / 2:
+            continue # deletion
+        elif r < indel_rate:
+            read.append(rng.choice('ACGT')) # insertion
+        if rng.random() < sub_rate:
+            c = rng.choice('ACGT')
+        read.append(c)
+    return ''.join(read)
+
+
+def make_reads(template, n_reads, seed=0):
+    rng = random.Random(seed)
+    reads = [mutate(template, rng) for _ in range(n_reads)]
+    return [SeqRecord(Seq(r), id='read%i' % i,
+                      letter_annotations={'phred_quality': [40]*len(r)})
+            for i, r in enumerate(reads)]
+
+
+def time_backend(seqs, template, **kwargs):
+    start = time.perf_counter()
+    alignments = align_seqs(seqs, template, **kwargs)
+    elapsed = time.perf_counter() - start
+    return alignments, elapsed
+
+
+def main(n_reads=5000, template=TEMPLATE):
+    seqs = make_reads(template, n_reads)
+    results = {}
+
+    backends = [('numpy', {'aligner': 'numpy'}),
+                ('numpy (band=10)', {'aligner': 'numpy', 'band': 10})]
+    if shutil.which('needle'):
+        workdir = tempfile.mkdtemp()
+        backends.insert(0, ('needle', {'aligner': 'needle',
+                                       'workdir': workdir}))
+    else:
+        print('needle not found on path; skipping.')
+
+    for name, kwargs in backends:
+        alignments, elapsed = time_backend(seqs, template, **kwargs)
+        results[name] = alignments
+        print('%-16s %8.0f reads/s (%i reads in %.2f s)'
+              % (name, n_reads / elapsed, n_reads, elapsed))
+
+    reference = list(results.keys())[0]
+    for name, alignments in results.items():
+        if name == reference:
+            continue
+        same_score = sum(a[0] == b[0] for a, b
+                         in zip(results[reference], alignments))
+        same_aln = sum(a == b for a, b in zip(results[reference], alignments))
+        print('%s vs %s: %i/%i identical scores, %i/%i identical alignments'
+              % (name, reference, same_score, n_reads, same_aln, n_reads))
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    t = sys.argv[2] if len(sys.argv) > 2 else TEMPLATE
+    main(n_reads=n, template=t)
@@ -0,0 +1,73 @@
+"""
+Compare the throughput of Bio.SeqIO.parse and nextgen4b.process.fastq for
+reading FASTQ files, with and without quality filtering.
+
+Usage:
+    python benchmarks/bench_fastq.py [fastq or fastq.gz file]
+
+If no file is given, a synthetic one is written to a temporary directory.
+"""
+import gzip
+import os
+import random
+import sys
+import tempfile
+import time
+
+from Bio import SeqIO
+
+from nextgen4b.process.fastq import read_fastq
+from nextgen4b.process.filter import passes_quality
+
+
+def write_synthetic_fastq(fpath, n_reads=200000, read_len=150, seed=0):
+    rng = random.Random(seed)
+    opener = gzip.open if fpath.endswith('.gz') else open
+    with opener(fpath, 'wt') as out_f:
+        for i in range(n_reads):
+            seq = ''.join(rng.choice('ACGT') for _ in range(read_len))
+            qual = ''.join(chr(33 + rng.randint(25, 40)) for _ in range(read_len))
+            out_f.write('@SIM:1:FC:1:%i:%i:%i 1:N:0:1\n%s\n+\n%s\n'
+                        % (1101 + i % 10, i, i, seq, qual))
+
+
+def seqio_reader(fpath):
+    opener = gzip.open if fpath.endswith('.gz') else open
+    with opener(fpath, 'rt') as in_f:
+        for s in SeqIO.parse(in_f, 'fastq'):
+            yield s
+
+
+def time_reader(name, reader, fpath, quality=False):
+    start = time.perf_counter()
+    n = 0
+    for s in reader(fpath):
+        if quality:
+            passes_quality(s)
+        else:
+            str(s.seq)
+        n += 1
+    elapsed = time.perf_counter() - start
+    print('%-30s %9.0f reads/s (%i reads in %.2f s)'
+          % (name, n / elapsed, n, elapsed))
+
+
+def main(fpaths):
+    for fpath in fpaths:
+        print(os.path.basename(fpath))
+        for quality in [False, True]:
+            suffix = ' + quality filter' if quality else ''
+            time_reader('SeqIO.parse' + suffix, seqio_reader, fpath, quality)
+            time_reader('read_fastq' + suffix, read_fastq, fpath, quality)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(sys.argv[1:])
+    else:
+        tmp_dir = tempfile.mkdtemp()
+        fpaths = [os.path.join(tmp_dir, 'synthetic.fastq'),
+                  os.path.join(tmp_dir, 'synthetic.fastq.gz')]
+        for fpath in fpaths:
+            write_synthetic_fastq(fpath)
+        main(fpaths)
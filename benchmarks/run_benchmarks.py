@@ -0,0 +1,285 @@
+"""
+Per-stage benchmarks of the filter and analysis code, on synthetic data from
+nextgen4b.tools.synthetic.
+
+Usage:
+    python benchmarks/run_benchmarks.py [-n N_READS] [-o results.json]
+                                        [--compare old_results.json]
+                                        [--only NAME [NAME ...]]
+
+Each benchmark is run --repeat times, and the best and mean times are kept.
+Results are written as JSON, with the package version, git revision and
+platform, so runs on different versions can be compared with --compare.
+"""
+import argparse
+import datetime
+import gzip
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from nextgen4b.process import filter as ngs_filter
+from nextgen4b.tools.synthetic import write_synthetic_run
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class Data(object):
+    """
+    Inputs for every stage, made once (untimed) from a synthetic run.
+    """
+
+    def __init__(self, tmp_dir, n_reads, n_align, seed=0):
+        import yaml
+
+        self.n_align = n_align
+        self.yaml_path = write_synthetic_run(tmp_dir, n_reads, compress=False,
+                                             seed=seed)
+        with open(self.yaml_path) as yaml_f:
+            expt_yaml = yaml.safe_load(yaml_f)
+        run, run_data = list(expt_yaml['ngsruns'].items())[0]
+        self.bcs, self.templates = ngs_filter.get_run_settings(expt_yaml, run)
+        self.f_name = os.path.join(tmp_dir, run_data['f_read_name'])
+        self.pe_name = os.path.join(tmp_dir, run_data['pe_read_name'])
+        self.gz_name = self.f_name + '.gz'
+        with open(self.f_name, 'rb') as in_f, \
+             gzip.open(self.gz_name, 'wb') as out_f:
+            shutil.copyfileobj(in_f, out_f)
+
+        self.f_res = ngs_filter.compile_res(run_data['filter_seqs']['forward'])
+        self.pe_res = ngs_filter.compile_res(run_data['filter_seqs']['reverse'])
+        self.copied_func = ngs_filter.gen_copied_seq_function(self.f_res)
+
+        self.f_seqs = list(ngs_filter.load_ngs_file(self.f_name))
+        self.pe_seqs = list(ngs_filter.load_ngs_file(self.pe_name))
+        self.regex_seqs = self.f_seqs
+        for regex in self.f_res:
+            self.regex_seqs = [s for s in self.regex_seqs
+                               if regex.search(str(s.seq))]
+        self.mates = ngs_filter.index_mates(self.pe_seqs)
+        self.bc_seqs = ngs_filter.barcodeDemux(self.regex_seqs, self.bcs)
+
+        self.expt = sorted(self.bcs.keys())[0]
+        self.template = self.bcs[self.expt] + self.templates[self.expt]
+        pe_matched = ngs_filter.filter_pe_mismatch(self.bc_seqs[self.expt],
+                                                   self.mates,
+                                                   self.copied_func)
+        self.trimmed = [ngs_filter.trim_lig_adapter(s, self.f_res)
+                        for s in pe_matched]
+        self.to_align = ngs_filter.quality_filter(self.trimmed)[:n_align]
+        self.aligned = [str(s.seq) for s in
+                        ngs_filter.alignment_filter(self.to_align,
+                                                    self.template,
+                                                    aligner='numpy')]
+
+        # Error words on a 6-base strand, written during a 3-phase signal
+        rng = np.random.RandomState(seed)
+        self.words = (rng.random_sample((n_reads, 6)) < 0.2).astype(int)
+        self.signal = np.array([0, 1, 0])
+        self.rates = np.array([[0.05, 0.4]] * 6)
+
+
+#####################
+# Benchmarks
+#####################
+# Each takes a Data and returns the number of items it processed.
+
+def bench_load_ngs_file(data):
+    return sum(1 for _ in ngs_filter.load_ngs_file(data.f_name))
+
+def bench_load_ngs_file_gz(data):
+    return sum(1 for _ in ngs_filter.load_ngs_file(data.gz_name))
+
+def bench_load_ngs_file_compact(data):
+    return sum(1 for _ in ngs_filter.load_ngs_file(data.f_name, compact=True))
+
+def bench_load_ngs_file_compact_gz(data):
+    return sum(1 for _ in ngs_filter.load_ngs_file(data.gz_name,
+                                                   compact=True))
+
+def bench_filter_seqs(data):
+    ngs_filter.filter_seqs(data.f_seqs, data.f_res[0])
+    return len(data.f_seqs)
+
+def bench_barcodeDemux(data):
+    ngs_filter.barcodeDemux(data.regex_seqs, data.bcs)
+    return len(data.regex_seqs)
+
+def bench_index_mates(data):
+    ngs_filter.index_mates(data.pe_seqs)
+    return len(data.pe_seqs)
+
+def bench_filter_pe_mismatch(data):
+    seqs = data.bc_seqs[data.expt]
+    ngs_filter.filter_pe_mismatch(seqs, data.mates, data.copied_func)
+    return len(seqs)
+
+def bench_quality_filter(data):
+    ngs_filter.quality_filter(data.trimmed)
+    return len(data.trimmed)
+
+def bench_alignment_filter_numpy(data):
+    ngs_filter.alignment_filter(data.to_align, data.template, aligner='numpy')
+    return len(data.to_align)
+
+def bench_alignment_filter_needle(data):
+    ngs_filter.alignment_filter(data.to_align, data.template,
+                                aligner='needle')
+    return len(data.to_align)
+
+def bench_get_all_position_misincs(data):
+    from nextgen4b.analyze.analyze import get_all_position_misincs
+    get_all_position_misincs(data.aligned, data.template)
+    return len(data.aligned)
+
+def bench_pop_log_lhood_fast(data):
+    from nextgen4b.analyze.likelihood import pop_log_lhood_fast
+    pop_log_lhood_fast(data.words, data.signal, data.rates)
+    return len(data.words)
+
+def bench_pop_log_lhood(data):
+    from nextgen4b.analyze.likelihood import pop_log_lhood
+    words = data.words[:1000]
+    pop_log_lhood(words, data.signal, data.rates)
+    return len(words)
+
+BENCHMARKS = [
+    ('load_ngs_file', bench_load_ngs_file),
+    ('load_ngs_file[gz]', bench_load_ngs_file_gz),
+    ('load_ngs_file[compact]', bench_load_ngs_file_compact),
+    ('load_ngs_file[compact,gz]', bench_load_ngs_file_compact_gz),
+    ('filter_seqs', bench_filter_seqs),
+    ('barcodeDemux', bench_barcodeDemux),
+    ('index_mates', bench_index_mates),
+    ('filter_pe_mismatch', bench_filter_pe_mismatch),
+    ('quality_filter', bench_quality_filter),
+    ('alignment_filter[numpy]', bench_alignment_filter_numpy),
+    ('alignment_filter[needle]', bench_alignment_filter_needle),
+    ('get_all_position_misincs', bench_get_all_position_misincs),
+    ('pop_log_lhood_fast', bench_pop_log_lhood_fast),
+    ('pop_log_lhood', bench_pop_log_lhood),
+]
+
+#####################
+# Running and reporting
+#####################
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always',
+                                        '--dirty'], cwd=HERE,
+                                       stderr=subprocess.DEVNULL
+                                       ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def package_version():
+    try:
+        from importlib import metadata
+        return metadata.version('nextgen4b')
+    except Exception:
+        return None
+
+def time_benchmark(func, data, repeat):
+    times = []
+    cpu_times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        n_items = func(data)
+        cpu_times.append(time.process_time() - cpu_start)
+        times.append(time.perf_counter() - start)
+    best = min(times)
+    return {'n_items': n_items,
+            'best_s': best,
+            'mean_s': sum(times) / len(times),
+            'cpu_s': min(cpu_times),
+            'items_per_s': n_items / best if best > 0 else None}
+
+def run_benchmarks(n_reads=20000, n_align=2000, repeat=3, only=None, seed=0):
+    tmp_dir = tempfile.mkdtemp(prefix='ngs_bench_')
+    try:
+        data = Data(tmp_dir, n_reads, n_align, seed=seed)
+        results = {}
+        for name, func in BENCHMARKS:
+            if only and name not in only:
+                continue
+            if name == 'alignment_filter[needle]' and not shutil.which('needle'):
+                print('%-28s skipped (needle not on path)' % name)
+                continue
+            try:
+                results[name] = time_benchmark(func, data, repeat)
+            except ImportError as e:
+                print('%-28s skipped (%s)' % (name, e))
+                continue
+            print('%-28s %12.0f items/s (%i items, best of %i: %.3f s)'
+                  % (name, results[name]['items_per_s'] or 0,
+                     results[name]['n_items'], repeat,
+                     results[name]['best_s']))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return {'suite': 'nextgen4b',
+            'format_version': 1,
+            'timestamp': datetime.datetime.now().isoformat(),
+            'version': package_version(),
+            'git': git_revision(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'params': {'n_reads': n_reads, 'n_align': n_align,
+                       'repeat': repeat, 'seed': seed},
+            'results': results}
+
+def compare(old, new, threshold=0.1):
+    """
+    Print the change in throughput of each benchmark between two result
+    dicts, flagging slowdowns of more than threshold.
+    """
+    if old['params'] != new['params']:
+        print('Warning: benchmark parameters differ (%s vs %s)'
+              % (old['params'], new['params']))
+    print('%-28s %12s %12s %8s' % ('benchmark', 'old items/s', 'new items/s',
+                                   'ratio'))
+    for name, result in new['results'].items():
+        if name not in old['results']:
+            continue
+        old_rate = old['results'][name]['items_per_s']
+        new_rate = result['items_per_s']
+        ratio = new_rate / old_rate if old_rate and new_rate else float('nan')
+        flag = '  SLOWER' if ratio < 1 - threshold else ''
+        print('%-28s %12.0f %12.0f %8.2f%s' % (name, old_rate, new_rate,
+                                              ratio, flag))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark nextgen4b on synthetic data.')
+    parser.add_argument('-n', '--n-reads', type=int, default=20000)
+    parser.add_argument('--n-align', type=int, default=2000,
+                        help='Reads to align in the alignment benchmarks')
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', nargs='+', metavar='NAME')
+    parser.add_argument('-o', '--out', help='Write results to this JSON file')
+    parser.add_argument('--compare', metavar='JSON',
+                        help='Compare with results from an earlier run')
+    args = parser.parse_args(sys.argv[1:])
+
+    results = run_benchmarks(n_reads=args.n_reads, n_align=args.n_align,
+                             repeat=args.repeat, only=args.only,
+                             seed=args.seed)
+    if args.out:
+        with open(args.out, 'w') as out_f:
+            json.dump(results, out_f, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as old_f:
+            compare(json.load(old_f), results)
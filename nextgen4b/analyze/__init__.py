@@ -1,8 +1,10 @@
 from nextgen4b.analyze.to_csv import get_pos_stats, write_all_pos_stats, \
                    write_all_simple_misinc, get_stats
-from nextgen4b.analyze.analyze import analyze_all_experiments
+from nextgen4b.analyze.analyze import analyze_all_experiments, \
+                   MisincAccumulator
 import nextgen4b.analyze.likelihood
 import nextgen4b.analyze.words
 
 __all__ = ['get_pos_stats', 'write_all_pos_stats', 'write_all_simple_misinc',
-           'analyze_all_experiments', 'likelihood', 'words']
\ No newline at end of file
+           'analyze_all_experiments', 'MisincAccumulator', 'likelihood',
+           'words']
\ No newline at end of file
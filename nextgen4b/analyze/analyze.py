@@ -1,5 +1,9 @@
+import concurrent.futures
 import logging
+import os
 import sys
+import time
+import traceback
 
 import numpy as np
 import pandas as pd
@@ -7,7 +11,9 @@ import tqdm
 import yaml
 from Bio import SeqIO
 
-from ..process.filter import cull_alignments
+from ..process.filter import cull_alignments, misinc_output_name
+from ..process.manifest import atomic_open
+from ..process.store import STORE_SUFFIX, is_store, load
 
 
 #####################
@@ -23,12 +29,83 @@ def get_positional_misinc(seqs, template, n, letterorder=['C', 'A', 'T', 'G']):
             
     return mat
 
-def get_all_position_misincs(seqs, template, letterorder=['C', 'A', 'T', 'G']):
-    mat = np.zeros([len(letterorder), len(letterorder), len(template)])
-    for i in range(len(template)):
-        posMat = get_positional_misinc(seqs, template, i, letterorder=letterorder)
-        mat[:,:,i] = np.sum(posMat, axis=2)
-    return mat
+def _letter_codes(letterorder):
+    """
+    Lookup table from ASCII code to index in letterorder, with
+    len(letterorder) for every other character.
+    """
+    codes = np.full(256, len(letterorder), dtype=np.intp)
+    for i, c in enumerate(letterorder):
+        codes[ord(c)] = i
+    return codes
+
+def encode_reads(seqs, width):
+    """
+    Return seqs (a list of aligned sequences as strings or SeqRecords, a
+    uint8 array of ASCII codes, or AlignedReads from
+    nextgen4b.process.store) as an (n, width) uint8 array, cut or padded
+    with zeros to width, and their counts (None for a list or array, or
+    uncollapsed reads).
+    """
+    weights = None
+    if hasattr(seqs, 'seqs'): # AlignedReads
+        weights = seqs.counts
+        seqs = seqs.seqs
+    if isinstance(seqs, np.ndarray):
+        if seqs.ndim == 2 and seqs.shape[1] >= width:
+            return seqs[:, :width], weights # A view; no copy of a store
+        mat = np.zeros((len(seqs), width), dtype=np.uint8)
+        w = seqs.shape[1] if seqs.ndim == 2 else 0
+        mat[:, :w] = seqs
+        return mat, weights
+
+    seqs = [str(s.seq) if hasattr(s, 'seq') else str(s) for s in seqs]
+    if seqs and all(len(s) == width for s in seqs):
+        text = ''.join(seqs).encode('ascii')
+        return (np.frombuffer(text, dtype=np.uint8).reshape(len(seqs), width),
+                weights)
+    mat = np.zeros((len(seqs), width), dtype=np.uint8)
+    for i, s in enumerate(seqs):
+        row = np.frombuffer(s[:width].encode('ascii'), dtype=np.uint8)
+        mat[i, :len(row)] = row
+    return mat, weights
+
+def get_all_position_misincs(seqs, template, letterorder=['C', 'A', 'T', 'G'],
+                             weights=None, batch_size=65536):
+    """
+    Count, at each position of template, how often each template letter was
+    read as each letter, as a (letters, letters, len(template)) array
+    indexed [template letter, read letter, position]. Letters not in
+    letterorder are skipped.
+
+    seqs can be a list of aligned sequences, a uint8 array of ASCII codes,
+    or AlignedReads. weights (e.g. duplicate counts; by default, the counts
+    of collapsed AlignedReads) weight each read's contribution.
+    """
+    n_letters = len(letterorder)
+    width = len(template)
+    mat, read_weights = encode_reads(seqs, width)
+    if weights is None:
+        weights = read_weights
+
+    # Flat index into a (letters+1, letters+1, width) array, with the last
+    # letter standing for anything not in letterorder
+    codes = _letter_codes(letterorder)
+    t_idx = codes[np.frombuffer(template.encode('ascii'), dtype=np.uint8)]
+    base = (t_idx * (n_letters + 1)) * width + np.arange(width)
+    size = (n_letters + 1) ** 2 * width
+
+    counts = np.zeros(size)
+    for start in range(0, len(mat), batch_size):
+        idx = codes[mat[start:start+batch_size]] * width + base
+        if weights is None:
+            counts += np.bincount(idx.ravel(), minlength=size)
+        else:
+            w = np.asarray(weights[start:start+batch_size], dtype=float)
+            counts += np.bincount(idx.ravel(), weights=np.repeat(w, width),
+                                  minlength=size)
+    counts = counts.reshape(n_letters + 1, n_letters + 1, width)
+    return np.ascontiguousarray(counts[:n_letters, :n_letters, :])
     
 def pos_mat_to_df(m, letterorder=['C', 'A', 'T', 'G']):
     # Generate column labels
@@ -50,6 +127,63 @@ def add_sequence_column(df, template):
     df['sequence'] = tS
     return df
 
+class MisincAccumulator(object):
+    """
+    Running per-position misincorporation counts against one template, which
+    can be fed aligned reads a batch at a time (for instance by the filter,
+    see filter_run in nextgen4b.process.filter) and merged with the counts
+    of other batches or workers. to_df gives the same table as do_analysis
+    on all the reads at once.
+    """
+
+    def __init__(self, template, letterorder=['C', 'A', 'T', 'G']):
+        self.template = template
+        self.letterorder = list(letterorder)
+        self.mat = np.zeros([len(letterorder), len(letterorder),
+                             len(template)])
+        self.n_reads = 0
+
+    def add(self, seqs, weights=None):
+        """
+        Add a batch of aligned reads (see get_all_position_misincs). Unless
+        weights are given, SeqRecords are weighted by their 'count'
+        annotation, if they have one.
+        """
+        if weights is None and isinstance(seqs, list) and \
+                any('count' in getattr(s, 'annotations', {}) for s in seqs):
+            weights = [s.annotations.get('count', 1) for s in seqs]
+        if weights is None and getattr(seqs, 'counts', None) is not None:
+            weights = seqs.counts
+        self.mat += get_all_position_misincs(seqs, self.template,
+                                             letterorder=self.letterorder,
+                                             weights=weights)
+        self.n_reads += len(seqs) if weights is None else int(np.sum(weights))
+
+    def merge(self, other):
+        """
+        Add the counts from another accumulator for the same template to
+        this one, and return this one.
+        """
+        if (other.template != self.template
+                or other.letterorder != self.letterorder):
+            raise ValueError('Cannot merge misincorporation counts for '
+                             'different templates or letter orders.')
+        self.mat += other.mat
+        self.n_reads += other.n_reads
+        return self
+
+    def to_df(self):
+        return add_sequence_column(pos_mat_to_df(self.mat,
+                                                 letterorder=self.letterorder),
+                                   self.template)
+
+    def save(self, fpath):
+        """
+        Write the table to a .csv file, atomically.
+        """
+        with atomic_open(fpath) as of:
+            self.to_df().to_csv(of)
+
 ############
 # Main Routine Helper Functions
 ############
@@ -59,29 +193,110 @@ def do_analysis(seqs, template):
     df = add_sequence_column(pos_mat_to_df(m), template)
     return df
 
+def get_aln_fname(run, expt, data_dir='./'):
+    """
+    Path to the aligned reads for an experiment in a run: the store, if
+    there is one, otherwise the fasta file.
+    """
+    base = os.path.join(data_dir, 'aln_seqs_%s_%s' % (run, expt))
+    if os.path.exists(base + STORE_SUFFIX):
+        return base + STORE_SUFFIX
+    return base + '.fa'
+
 ############
 # Main Routines
 ############
 
-def analyze_all_experiments(yf_name, data_dir='./'):
+def analyze_expt(run, expt, template, data_dir='./', batch_size=10000):
+    """
+    Count the misincorporations in the aligned reads for one experiment in
+    a run, and write them to <expt>_<run>_misinc_data.csv. Stores are
+    memory-mapped and fasta files read batch_size reads at a time, so the
+    reads are never all held in memory. Returns the number of reads.
+    """
+    fname = get_aln_fname(run, expt, data_dir)
+    acc = MisincAccumulator(template)
+    if is_store(fname):
+        acc.add(load(fname))
+    else:
+        batch = []
+        for s in SeqIO.parse(fname, 'fasta'):
+            batch.append(s)
+            if len(batch) >= batch_size:
+                acc.add(batch)
+                batch = []
+        if batch:
+            acc.add(batch)
+    acc.save(misinc_output_name(run, expt))
+    return acc.n_reads
+
+def _analyze_worker(job):
+    """
+    Worker for analyze_all_experiments. Returns (run, expt, reads, seconds,
+    traceback), where traceback is None if the analysis succeeded.
+    """
+    run, expt, template, data_dir = job
+    start = time.time()
+    try:
+        n_reads = analyze_expt(run, expt, template, data_dir)
+        tb = None
+    except Exception:
+        n_reads = None
+        tb = traceback.format_exc()
+    return run, expt, n_reads, time.time() - start, tb
+
+def analyze_all_experiments(yf_name, data_dir='./', processes=None,
+                            summary=True):
     """
     Given a folder of aligned fasta files from `filter`, output the old 
     misinc_data.csv files, along with a summary .csv of misincorporations
-    at a given site.
+    at a given site. Aligned read stores are used instead of fasta files
+    where they exist.
+
+    Each (run, experiment) is analyzed as a separate job (see analyze_expt)
+    on a pool of processes processes (default: one per CPU; 1 to run in
+    this process). Tables are written atomically. A job that raises is
+    logged, but does not stop the others. If summary is True, the reads and
+    time taken for each job are written to ngs_analysis_<time>.csv.
+
+    Returns a dict of the (run, expt) jobs that failed, mapped to their
+    tracebacks.
     """
+    text_logger = logging.getLogger(__name__+'.text_logger')
+    timestr = time.strftime("%Y%m%d-%H%M%S")
     with open(yf_name) as expt_f:
         expt_yaml = yaml.load(expt_f) # Should probably make this a class at some point...
     runs = expt_yaml['ngsruns']
-    for run in tqdm.tqdm(runs.keys()):
-        expts = runs[run]['experiments']
-        for expt in expts:
-            analyzed_data_fname = '%s_%s_misinc_data.csv' % (expt, run)
-            template = expt_yaml['experiments'][expt]['template_seq']
-            aln_seqs = list(SeqIO.parse('aln_seqs_%s_%s.fa' % (run, expt),
-                                        'fasta'))
-            data = do_analysis(aln_seqs, template)
-            
-            # Save dataframe
-            with open(analyzed_data_fname, 'w') as of:
-                data.to_csv(of)
+    jobs = [(run, expt, expt_yaml['experiments'][expt]['template_seq'],
+             data_dir)
+            for run in runs.keys() for expt in runs[run]['experiments']]
+
+    results = {}
+    if processes == 1 or len(jobs) < 2:
+        for job in tqdm.tqdm(jobs):
+            result = _analyze_worker(job)
+            results[result[:2]] = result
+    else:
+        with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+            futures = [executor.submit(_analyze_worker, job) for job in jobs]
+            for future in tqdm.tqdm(concurrent.futures.as_completed(futures),
+                                    total=len(futures)):
+                result = future.result()
+                results[result[:2]] = result
 
+    failed = {}
+    rows = ['run,expt,reads,seconds,status']
+    for job in jobs: # YAML order, whatever order the jobs finished in
+        run, expt, n_reads, seconds, tb = results[job[:2]]
+        if tb is not None:
+            failed[(run, expt)] = tb
+            text_logger.error('Analysis failed for run %s, expt ID %s:\n%s',
+                              run, expt, tb)
+        rows.append('%s,%s,%s,%.3f,%s' % (run, expt,
+                                          '' if n_reads is None else n_reads,
+                                          seconds,
+                                          'ok' if tb is None else 'failed'))
+    if summary:
+        with atomic_open('ngs_analysis_%s.csv' % timestr) as f:
+            f.write(''.join(row + '\n' for row in rows))
+    return failed
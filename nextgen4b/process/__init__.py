@@ -1,6 +1,16 @@
 # Am I doing this right?
-__all__ = ['filter', 'multimer', 'sites']
+__all__ = ['align', 'barcodes', 'bgzf', 'cache', 'fastq', 'filter', 'manifest',
+           'metrics', 'multimer', 'shard', 'sites', 'store']
 
+import nextgen4b.process.align
+import nextgen4b.process.barcodes
+import nextgen4b.process.bgzf
+import nextgen4b.process.cache
+import nextgen4b.process.fastq
 import nextgen4b.process.filter
+import nextgen4b.process.manifest
+import nextgen4b.process.metrics
 import nextgen4b.process.multimer
-import nextgen4b.process.sites
\ No newline at end of file
+import nextgen4b.process.shard
+import nextgen4b.process.sites
+import nextgen4b.process.store
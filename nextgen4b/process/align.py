@@ -0,0 +1,362 @@
+"""
+nextgen4b.process.align
+
+Global alignment of reads against a template. Alignments are returned as
+(score, aligned template, aligned read) tuples, and can be produced either
+by EMBOSS needle or by a built-in NumPy implementation of the same
+algorithm.
+"""
+import multiprocessing
+import os
+import shutil
+import tempfile
+import uuid
+
+import numpy as np
+from Bio import AlignIO, SeqIO
+
+from .fastq import as_seqrecords
+
+__all__ = ['nw_align', 'nw_align_batch', 'needle_align', 'align_seqs',
+           'align_seqs_parallel']
+
+#####################
+# Scoring
+#####################
+
+# EDNAFULL (EMBOSS's default DNA matrix) restricted to A, C, G, T and N.
+# Other IUPAC codes are scored as N.
+_LETTERS = 'ACGTN'
+_SCORES = np.array([[ 5, -4, -4, -4, -2],
+                    [-4,  5, -4, -4, -2],
+                    [-4, -4,  5, -4, -2],
+                    [-4, -4, -4,  5, -2],
+                    [-2, -2, -2, -2, -1]], dtype=float)
+
+_CODES = np.full(256, 4, dtype=np.uint8)
+for _i, _c in enumerate(_LETTERS):
+    _CODES[ord(_c)] = _i
+    _CODES[ord(_c.lower())] = _i
+
+_NEG = -1e9 # Stands in for -inf, without the nan problems
+
+def encode_seq(seq):
+    """
+    Convert a sequence string to an array of indices into the score matrix.
+    """
+    return _CODES[np.frombuffer(seq.encode('ascii'), dtype=np.uint8)]
+
+#####################
+# NumPy Needleman-Wunsch
+#####################
+
+def nw_align(read, template, gapopen=10, gapextend=0.5, band=None):
+    """
+    Globally align a read to a template. Returns a (score, aligned template,
+    aligned read) tuple. See nw_align_batch.
+    """
+    return nw_align_batch([read], template, gapopen=gapopen,
+                          gapextend=gapextend, band=band)[0]
+
+def nw_align_batch(reads, template, gapopen=10, gapextend=0.5, band=None,
+                   chunk_size=256):
+    """
+    Globally align each read string in reads to template, as EMBOSS needle
+    would with its default settings: EDNAFULL scores, affine gap penalties
+    (a gap of length k costs gapopen + (k-1)*gapextend) and end gaps that
+    are neither penalized nor counted in the score.
+
+    Reads of the same length are aligned together, with the dynamic
+    programming vectorized over reads and template positions.
+
+    If band is given, only cells within band diagonals of the region where
+    the read can lie entirely inside the template are filled in. This is
+    faster, and exact for alignments with at most band net insertions or
+    deletions.
+
+    Returns a list of (score, aligned template, aligned read) tuples, in the
+    same order as reads.
+    """
+    reads = [str(r) for r in reads]
+    t_codes = encode_seq(template)
+
+    by_length = {}
+    for i, r in enumerate(reads):
+        by_length.setdefault(len(r), []).append(i)
+
+    alignments = [None] * len(reads)
+    for n, idxs in by_length.items():
+        for start in range(0, len(idxs), chunk_size):
+            chunk = idxs[start:start+chunk_size]
+            chunk_alns = _nw_align_same_length([reads[i] for i in chunk],
+                                               template, t_codes, gapopen,
+                                               gapextend, band)
+            for i, aln in zip(chunk, chunk_alns):
+                alignments[i] = aln
+    return alignments
+
+def _band_limits(n, m, band):
+    """
+    Lowest and highest allowed diagonal (template index - read index).
+    """
+    if band is None:
+        return -n, m
+    return min(0, m - n) - band, max(0, m - n) + band
+
+def _nw_align_same_length(reads, template, t_codes, gapopen, gapextend, band):
+    """
+    Align a list of reads that all have the same length.
+    """
+    n_reads = len(reads)
+    n = len(reads[0])
+    m = len(template)
+    lo, hi = _band_limits(n, m, band)
+
+    if n == 0 or m == 0:
+        return [(0.0, template + '-'*n, '-'*m + r) for r in reads]
+
+    r_codes = np.vstack([encode_seq(r) for r in reads]) # n_reads x n
+    # Traceback pointers for each cell:
+    #   from_f - H came from a gap in the read (horizontal move)
+    #   from_e - D came from a gap in the template (vertical move)
+    #   e_open, f_open - the gap was opened here, rather than extended
+    from_f = np.zeros((n_reads, n+1, m+1), dtype=bool)
+    from_e = np.zeros((n_reads, n+1, m+1), dtype=bool)
+    e_open = np.zeros((n_reads, n+1, m+1), dtype=bool)
+    f_open = np.zeros((n_reads, n+1, m+1), dtype=bool)
+
+    # Row 0: leading gaps in the read are free
+    h_prev = np.full((n_reads, m+1), _NEG)
+    h_prev[:, :max(0, hi)+1] = 0.
+    e_prev = np.full((n_reads, m+1), _NEG)
+    last_col = np.full((n_reads, n+1), _NEG)
+    last_col[:, 0] = h_prev[:, m]
+
+    ext_ramp = gapextend * np.arange(m+1)
+
+    for i in range(1, n+1):
+        h = np.full((n_reads, m+1), _NEG)
+        e = np.full((n_reads, m+1), _NEG)
+        if -i >= lo: # Leading gaps in the template are free
+            h[:, 0] = 0.
+
+        j0 = max(1, i + lo)
+        j1 = min(m, i + hi)
+        if j0 <= j1:
+            cols = slice(j0, j1+1)
+
+            # Vertical moves: gap in the template
+            e_opened = h_prev[:, cols] - gapopen
+            e_extended = e_prev[:, cols] - gapextend
+            e[:, cols] = np.maximum(e_opened, e_extended)
+            e_open[:, i, cols] = e_opened >= e_extended
+
+            # Diagonal moves
+            subs = _SCORES[r_codes[:, i-1]][:, t_codes[j0-1:j1]]
+            diag = h_prev[:, j0-1:j1] + subs
+            d = np.maximum(diag, e[:, cols])
+            from_e[:, i, cols] = e[:, cols] > diag
+
+            # Horizontal moves: gap in the read. Opening a gap from another
+            # horizontal gap never beats extending it, so
+            #   F[j] = max_{k<j} D[k] - gapopen - (j-1-k)*gapextend
+            # which is a running maximum.
+            d_full = np.full((n_reads, j1-j0+2), _NEG)
+            d_full[:, 0] = h[:, j0-1] if j0 == 1 else _NEG
+            d_full[:, 1:] = d
+            ramp = ext_ramp[:j1-j0+2]
+            run_max = np.maximum.accumulate(d_full + ramp, axis=1)
+            f = run_max[:, :-1] - ramp[:-1] - gapopen
+            f_opened = d_full[:, :-1] - gapopen
+            f_open[:, i, cols] = f_opened >= f
+
+            h[:, cols] = np.maximum(d, f)
+            from_f[:, i, cols] = f > d
+
+        last_col[:, i] = h[:, m]
+        h_prev = h
+        e_prev = e
+
+    # Trailing gaps are free, so the best score may be anywhere on the
+    # bottom row or the right-hand column.
+    best = []
+    for k in range(n_reads):
+        j_best = int(np.argmax(h_prev[k]))
+        i_best = int(np.argmax(last_col[k]))
+        if last_col[k, i_best] > h_prev[k, j_best]:
+            best.append((last_col[k, i_best], i_best, m))
+        else:
+            best.append((h_prev[k, j_best], n, j_best))
+
+    alignments = []
+    for k, r in enumerate(reads):
+        score, i, j = best[k]
+        alignments.append((float(score),) +
+                          _traceback(r, template, i, j, from_f[k], from_e[k],
+                                     e_open[k], f_open[k]))
+    return alignments
+
+def _traceback(read, template, i, j, from_f, from_e, e_open, f_open):
+    """
+    Walk back from cell (i, j) to build the aligned template and read.
+    """
+    n = len(read)
+    m = len(template)
+    # Trailing end gaps. Lists are built back to front.
+    t_aln = list(reversed(template[j:])) + ['-'] * (n - i)
+    r_aln = ['-'] * (m - j) + list(reversed(read[i:]))
+
+    state = 'h'
+    while i > 0 and j > 0:
+        if state == 'h':
+            if from_f[i, j]:
+                state = 'f'
+            elif from_e[i, j]:
+                state = 'e'
+            else:
+                state = 'diag'
+        elif state == 'd':
+            state = 'e' if from_e[i, j] else 'diag'
+
+        if state == 'diag':
+            t_aln.append(template[j-1])
+            r_aln.append(read[i-1])
+            i -= 1
+            j -= 1
+            state = 'h'
+        elif state == 'e':
+            t_aln.append('-')
+            r_aln.append(read[i-1])
+            if e_open[i, j]:
+                state = 'h'
+            i -= 1
+        else: # state == 'f'
+            t_aln.append(template[j-1])
+            r_aln.append('-')
+            if f_open[i, j]:
+                state = 'd'
+            j -= 1
+
+    # Leading end gaps
+    t_aln.extend(reversed(template[:j]))
+    r_aln.extend('-' * j)
+    t_aln.extend('-' * i)
+    r_aln.extend(reversed(read[:i]))
+
+    return ''.join(reversed(t_aln)), ''.join(reversed(r_aln))
+
+#####################
+# EMBOSS needle
+#####################
+
+def needle_align(seqs, template, gapopen=10, gapextend=0.5, workdir=None,
+                 cleanup=True):
+    """
+    Align sequence records to template with EMBOSS needle. Returns a list of
+    (score, aligned template, aligned read) tuples, in the same order as
+    seqs.
+
+    Temporary files are written to workdir, or to a private temporary
+    directory if workdir is None, so concurrent runs do not collide.
+
+    Requires needle on the path, and a Bio.AlignIO that reads alignment
+    scores (see readme).
+    """
+    from Bio.Emboss.Applications import NeedleCommandline
+
+    own_workdir = workdir is None
+    if own_workdir:
+        workdir = tempfile.mkdtemp(prefix='nextgen4b_')
+
+    seqs_f_name = os.path.join(workdir, 'tempseq_'+str(uuid.uuid4())+'.fa')
+    out_f_name = os.path.join(workdir, 'temp_'+str(uuid.uuid4())+'.needle')
+    with open(seqs_f_name, 'w') as sh:
+        SeqIO.write(as_seqrecords(seqs), sh, 'fastq')
+
+    needle_cline = NeedleCommandline(asequence='asis::{}'.format(template),
+                                     bsequence=seqs_f_name, gapopen=gapopen,
+                                     gapextend=gapextend, outfile=out_f_name)
+    needle_cline()
+
+    with open(out_f_name) as aln_f:
+        alignments = [(alignment.annotations['score'],
+                       str(alignment[0].seq), str(alignment[1].seq))
+                      for alignment in AlignIO.parse(aln_f, 'emboss')]
+
+    if cleanup:
+        os.remove(seqs_f_name)
+        os.remove(out_f_name)
+        if own_workdir:
+            shutil.rmtree(workdir)
+    return alignments
+
+#####################
+# Backends
+#####################
+
+ALIGNERS = ('needle', 'numpy')
+
+def align_seqs(seqs, template, gapopen=10, gapextend=0.5, aligner='needle',
+               band=None, workdir=None, cleanup=True, processes=1,
+               chunk_size=5000):
+    """
+    Align sequence records to template with the named aligner, one of
+    ALIGNERS. Returns a list of (score, aligned template, aligned read)
+    tuples, in the same order as seqs.
+
+    band is only used by the numpy aligner; workdir and cleanup only by
+    needle. If processes is more than 1, the work is split up by
+    align_seqs_parallel.
+    """
+    if aligner not in ALIGNERS:
+        raise ValueError('Unrecognized aligner `%s`' % aligner)
+
+    if processes > 1 and len(seqs) > chunk_size:
+        return align_seqs_parallel(seqs, template, gapopen=gapopen,
+                                   gapextend=gapextend, aligner=aligner,
+                                   band=band, cleanup=cleanup,
+                                   processes=processes, chunk_size=chunk_size)
+
+    if aligner == 'needle':
+        return needle_align(seqs, template, gapopen=gapopen,
+                            gapextend=gapextend, workdir=workdir,
+                            cleanup=cleanup)
+    else:
+        return nw_align_batch([str(s.seq) for s in seqs], template,
+                              gapopen=gapopen, gapextend=gapextend, band=band)
+
+def align_seqs_parallel(seqs, template, gapopen=10, gapextend=0.5,
+                        aligner='needle', band=None, cleanup=True, processes=2,
+                        chunk_size=5000):
+    """
+    Split seqs into chunks of chunk_size and align them on a pool of
+    processes. Each needle call gets its own temporary directory. Returns
+    a list of (score, aligned template, aligned read) tuples, in the same
+    order as seqs.
+    """
+    chunks = [seqs[i:i+chunk_size] for i in range(0, len(seqs), chunk_size)]
+    if aligner == 'numpy': # Only the sequences need to go to the workers
+        chunks = [[str(s.seq) for s in chunk] for chunk in chunks]
+    jobs = [(chunk, template, gapopen, gapextend, aligner, band, cleanup)
+            for chunk in chunks]
+
+    pool = multiprocessing.Pool(min(processes, len(jobs)))
+    try:
+        results = pool.map(_align_chunk, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    return [aln for chunk_alns in results for aln in chunk_alns]
+
+def _align_chunk(job):
+    """
+    Worker for align_seqs_parallel.
+    """
+    chunk, template, gapopen, gapextend, aligner, band, cleanup = job
+    if aligner == 'needle':
+        return needle_align(chunk, template, gapopen=gapopen,
+                            gapextend=gapextend, cleanup=cleanup)
+    else:
+        return nw_align_batch(chunk, template, gapopen=gapopen,
+                              gapextend=gapextend, band=band)
@@ -0,0 +1,152 @@
+"""
+nextgen4b.process.barcodes
+
+Barcode lookups used to demultiplex reads in a single pass.
+"""
+import itertools
+
+__all__ = ['BarcodeIndex', 'hamming_neighbors']
+
+_ALPHABET = 'ACGTN'
+
+
+def hamming_neighbors(bc, max_mismatches, alphabet=_ALPHABET):
+    """
+    Yield (seq, distance) for every sequence within max_mismatches
+    substitutions of bc (including bc itself, at distance 0).
+    """
+    yield bc, 0
+    for d in range(1, max_mismatches + 1):
+        for positions in itertools.combinations(range(len(bc)), d):
+            choices = [[c for c in alphabet if c != bc[i]] for i in positions]
+            for subs in itertools.product(*choices):
+                seq = list(bc)
+                for i, c in zip(positions, subs):
+                    seq[i] = c
+                yield ''.join(seq), d
+
+
+class BarcodeIndex(object):
+    """
+    Classifies reads by the barcode(s) they start with.
+
+    Barcodes are bucketed by length, so classifying a read costs one dict
+    lookup per distinct barcode length rather than one comparison per
+    experiment. With max_mismatches = 0 the semantics are those of
+    str.startswith: a read is assigned to every experiment whose barcode it
+    starts with, so overlapping barcodes both match and an empty barcode
+    matches every read.
+
+    With max_mismatches = k > 0, every sequence within k substitutions of a
+    barcode is precomputed into the lookup table, so classification is still
+    one lookup per length. Each table entry goes to its nearest barcode;
+    entries equally near to barcodes of different experiments are marked
+    ambiguous, and reads that hit them are not assigned. Exact matches take
+    precedence over corrected ones.
+
+    The number of reads assigned to each experiment is kept in counts, split
+    into exact_counts and corrected_counts. ambiguous_counts holds, for each
+    experiment, the number of reads left unassigned because they were as
+    near its barcode as another's.
+    """
+
+    def __init__(self, bcs, max_mismatches=0):
+        """
+        bcs - dict of barcodes, indexed by experiment ID.
+        max_mismatches - number of substitutions to tolerate in the barcode.
+        """
+        if max_mismatches < 0:
+            raise ValueError('max_mismatches must be at least 0.')
+        self.bcs = dict(bcs)
+        self.max_mismatches = max_mismatches
+        self.counts = {expt: 0 for expt in self.bcs.keys()}
+        self.exact_counts = {expt: 0 for expt in self.bcs.keys()}
+        self.corrected_counts = {expt: 0 for expt in self.bcs.keys()}
+        self.ambiguous_counts = {expt: 0 for expt in self.bcs.keys()}
+        self.n_classified = 0
+        self.n_ambiguous = 0
+
+        self._by_length = {} # length -> {barcode: [expts]}
+        for expt, bc in self.bcs.items():
+            self._by_length.setdefault(len(bc), {}).setdefault(bc, []).append(expt)
+        self._lengths = sorted(self._by_length.keys())
+
+        # length -> {seq: (expts, distance, ambiguous)}, for corrected
+        # matches only; exact matches are looked up in _by_length.
+        self._neighbors = {}
+        self.collisions = [] # (seq, expts) of ambiguous table entries
+        if max_mismatches:
+            for length, by_bc in self._by_length.items():
+                self._neighbors[length] = self._build_neighbors(by_bc)
+
+    def _build_neighbors(self, by_bc):
+        table = {}
+        for bc, expts in by_bc.items():
+            for seq, d in hamming_neighbors(bc, self.max_mismatches):
+                if d == 0 or seq in by_bc:
+                    continue
+                entry = table.get(seq)
+                if entry is None or d < entry[1]:
+                    table[seq] = (list(expts), d, False)
+                elif d == entry[1]:
+                    table[seq] = (entry[0] + list(expts), d, True)
+        for seq, (expts, d, ambiguous) in table.items():
+            if ambiguous:
+                self.collisions.append((seq, expts))
+        return table
+
+    def classify(self, seq):
+        """
+        Return a list of the experiments whose barcode seq starts with.
+        """
+        self.n_classified += 1
+        matches = []
+        for length in self._lengths:
+            expts = self._by_length[length].get(seq[:length])
+            if expts:
+                matches.extend(expts)
+        if matches or not self.max_mismatches:
+            for expt in matches:
+                self.counts[expt] += 1
+                self.exact_counts[expt] += 1
+            return matches
+
+        ambiguous = []
+        for length in self._lengths:
+            entry = self._neighbors[length].get(seq[:length])
+            if entry is not None:
+                if entry[2]:
+                    ambiguous.extend(entry[0])
+                else:
+                    matches.extend(entry[0])
+        if matches:
+            for expt in matches:
+                self.counts[expt] += 1
+                self.corrected_counts[expt] += 1
+        elif ambiguous:
+            self.n_ambiguous += 1
+            for expt in ambiguous:
+                self.ambiguous_counts[expt] += 1
+        return matches
+
+    def log_counts(self, logger):
+        """
+        Write the per-barcode read counts to logger.
+        """
+        for expt, bc in self.bcs.items():
+            if self.max_mismatches:
+                logger.info('Barcode %s (expt ID %s): %i of %i sequences '
+                            '(%i exact, %i corrected, %i ambiguous).',
+                            bc if bc else "''", expt, self.counts[expt],
+                            self.n_classified, self.exact_counts[expt],
+                            self.corrected_counts[expt],
+                            self.ambiguous_counts[expt])
+            else:
+                logger.info('Barcode %s (expt ID %s): %i of %i sequences.',
+                            bc if bc else "''", expt, self.counts[expt],
+                            self.n_classified)
+        if self.collisions:
+            logger.warning('%i sequences are within %i mismatches of more '
+                           'than one barcode; %i reads matching them were '
+                           'not assigned.', len(self.collisions),
+                           self.max_mismatches, self.n_ambiguous)
@@ -0,0 +1,295 @@
+"""
+nextgen4b.process.bgzf
+
+Block-compressed gzip (BGZF), as used by samtools and htslib, for FASTQ
+files that can be read in parallel.
+
+A BGZF file is a series of gzip members of at most 64 kB each, so it can be
+read by any gzip reader, but also entered at the start of any block. A
+position in the file is a virtual offset: the compressed offset of a block,
+shifted left 16 bits, plus an offset into that block's uncompressed data.
+
+BgzfWriter starts blocks at record boundaries where it can, compresses
+blocks on a thread pool, and writes a sidecar index (<file>.fqi) holding the
+virtual offset of every index_interval-th record, so workers can each read
+a different range of records from one file.
+"""
+import collections
+import concurrent.futures
+import io
+import struct
+import zlib
+
+import numpy as np
+
+from .fastq import parse_fastq
+
+__all__ = ['BgzfWriter', 'BgzfReader', 'is_bgzf', 'index_path',
+           'read_index', 'read_records', 'BGZF_BLOCK_SIZE', 'INDEX_SUFFIX']
+
+BGZF_BLOCK_SIZE = 0xff00 # Uncompressed bytes per block, as in htslib
+INDEX_SUFFIX = '.fqi'
+
+_HEADER = struct.Struct('<4BI2BH2BHH') # gzip header with the BC subfield
+_HEADER_SIZE = _HEADER.size # 18
+_EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b00'
+                           '03000000000000000000')
+_INDEX_MAGIC = b'NG4BFQI\x01'
+_INDEX_HEADER = struct.Struct('<8sQQQ') # magic, interval, records, entries
+
+
+def index_path(fpath):
+    return fpath + INDEX_SUFFIX
+
+def _compress_block(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    bsize = _HEADER_SIZE + len(cdata) + 8
+    header = _HEADER.pack(0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'),
+                          ord('C'), 2, bsize - 1)
+    return b''.join([header, cdata,
+                     struct.pack('<II', zlib.crc32(data) & 0xffffffff,
+                                 len(data))])
+
+def is_bgzf(fpath):
+    """
+    True if fpath starts with a BGZF block.
+    """
+    try:
+        with open(fpath, 'rb') as f:
+            header = f.read(_HEADER_SIZE)
+    except IOError:
+        return False
+    if len(header) < _HEADER_SIZE:
+        return False
+    fields = _HEADER.unpack(header)
+    return fields[:4] == (0x1f, 0x8b, 8, 4) and fields[8:11] == (66, 67, 2)
+
+#####################
+# Writing
+#####################
+
+class BgzfWriter(object):
+    """
+    Write a BGZF file. write() takes raw bytes; write_records() takes a list
+    of whole records (str or bytes), and keeps them out of block boundaries
+    where it can, and records their offsets for the index.
+
+    Blocks are compressed on executor (a concurrent.futures executor,
+    which can be shared between writers), or on a new pool of threads
+    threads if executor is None and threads > 1. At most max_pending
+    blocks are held in memory waiting to be written.
+
+    If index_interval is set, close() writes <fpath>.fqi holding the virtual
+    offset of every index_interval-th record.
+    """
+
+    def __init__(self, fpath, level=6, threads=1, executor=None,
+                 index_interval=10000, max_pending=None):
+        self.fpath = fpath
+        self.level = level
+        self.index_interval = index_interval
+        self.n_records = 0
+
+        self._f = open(fpath, 'wb')
+        self._own_executor = executor is None and threads > 1
+        if self._own_executor:
+            executor = concurrent.futures.ThreadPoolExecutor(threads)
+        self._executor = executor
+        if max_pending is None:
+            max_pending = 2 * max(threads, 4)
+        self._max_pending = max_pending
+        self._pending = collections.deque()
+
+        self._block = bytearray()
+        self._n_blocks = 0
+        self._block_offsets = [] # Compressed offset of each written block
+        self._coffset = 0
+        self._index = [] # (block number, offset in block) of indexed records
+
+    def write(self, data):
+        """
+        Write raw bytes, splitting them across blocks as needed.
+        """
+        if isinstance(data, str):
+            data = data.encode('ascii')
+        view = memoryview(data)
+        while len(view):
+            space = BGZF_BLOCK_SIZE - len(self._block)
+            self._block += view[:space]
+            view = view[space:]
+            if len(self._block) >= BGZF_BLOCK_SIZE:
+                self._end_block()
+
+    def write_records(self, records):
+        """
+        Write a list of whole records, starting a new block rather than
+        splitting a record where possible.
+        """
+        interval = self.index_interval
+        for record in records:
+            if isinstance(record, str):
+                record = record.encode('ascii')
+            if len(self._block) + len(record) > BGZF_BLOCK_SIZE:
+                self._end_block()
+            if interval and self.n_records % interval == 0:
+                self._index.append((self._n_blocks, len(self._block)))
+            self.n_records += 1
+            self.write(record)
+
+    def _end_block(self):
+        if not self._block:
+            return
+        data = bytes(self._block)
+        self._block = bytearray()
+        self._n_blocks += 1
+        if self._executor is None:
+            self._write_block(_compress_block(data, self.level))
+            return
+        self._pending.append(self._executor.submit(_compress_block, data,
+                                                   self.level))
+        while len(self._pending) > self._max_pending:
+            self._write_block(self._pending.popleft().result())
+
+    def _write_block(self, block):
+        self._block_offsets.append(self._coffset)
+        self._f.write(block)
+        self._coffset += len(block)
+
+    def flush(self):
+        """
+        End the current block and write out every pending block.
+        """
+        self._end_block()
+        while self._pending:
+            self._write_block(self._pending.popleft().result())
+        self._f.flush()
+
+    def close(self):
+        """
+        Finish the file with an empty EOF block, and write the index.
+        """
+        try:
+            self.flush()
+            self._f.write(_EOF_BLOCK)
+            end = self._coffset
+        finally:
+            self._f.close()
+            if self._own_executor:
+                self._executor.shutdown()
+        if self.index_interval:
+            offsets = self._block_offsets + [end]
+            voffsets = np.array([(offsets[b] << 16) | u
+                                 for b, u in self._index], dtype='<u8')
+            with open(index_path(self.fpath), 'wb') as f:
+                f.write(_INDEX_HEADER.pack(_INDEX_MAGIC, self.index_interval,
+                                           self.n_records, len(voffsets)))
+                f.write(voffsets.tobytes())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+#####################
+# Reading
+#####################
+
+def read_index(fpath):
+    """
+    Return (interval, n_records, virtual offsets) from the index of the
+    BGZF file fpath.
+    """
+    with open(index_path(fpath), 'rb') as f:
+        magic, interval, n_records, n_entries = _INDEX_HEADER.unpack(
+            f.read(_INDEX_HEADER.size))
+        if magic != _INDEX_MAGIC:
+            raise ValueError('%s is not a BGZF record index.'
+                             % index_path(fpath))
+        voffsets = np.frombuffer(f.read(8 * n_entries), dtype='<u8')
+    return interval, n_records, voffsets
+
+
+class BgzfReader(io.RawIOBase):
+    """
+    A binary file reading the uncompressed data of a BGZF file, which can
+    start at any virtual offset (see seek_virtual).
+    """
+
+    def __init__(self, fpath, voffset=0):
+        io.RawIOBase.__init__(self)
+        self.fpath = fpath
+        self._f = open(fpath, 'rb')
+        self._data = b''
+        self._pos = 0
+        self.seek_virtual(voffset)
+
+    def readable(self):
+        return True
+
+    def seek_virtual(self, voffset):
+        coffset, uoffset = int(voffset) >> 16, int(voffset) & 0xffff
+        self._f.seek(coffset)
+        self._data = b''
+        self._pos = 0
+        if uoffset:
+            self._next_block()
+            self._pos = uoffset
+
+    def _next_block(self):
+        header = self._f.read(_HEADER_SIZE)
+        if not header:
+            return False
+        if len(header) < _HEADER_SIZE:
+            raise ValueError('Truncated BGZF block in %s.' % self.fpath)
+        fields = _HEADER.unpack(header)
+        if fields[:4] != (0x1f, 0x8b, 8, 4) or fields[8:11] != (66, 67, 2):
+            raise ValueError('%s is not a BGZF file.' % self.fpath)
+        bsize = fields[-1] + 1
+        rest = self._f.read(bsize - _HEADER_SIZE)
+        self._data = zlib.decompress(rest[:-8], -15)
+        self._pos = 0
+        return True
+
+    def read(self, size=-1):
+        while self._pos >= len(self._data):
+            if not self._next_block():
+                return b''
+        if size is None or size < 0:
+            size = len(self._data) - self._pos
+        out = self._data[self._pos:self._pos+size]
+        self._pos += len(out)
+        return out
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self._f.close()
+        io.RawIOBase.close(self)
+
+
+def read_records(fpath, start=0, stop=None):
+    """
+    Yield FastqRecords start to stop (exclusive) of a BGZF FASTQ file,
+    entering the file at the nearest indexed record before start.
+    """
+    interval, n_records, voffsets = read_index(fpath)
+    if stop is None or stop > n_records:
+        stop = n_records
+    if start >= stop:
+        return
+    entry = min(start // interval, len(voffsets) - 1)
+    with BgzfReader(fpath, voffsets[entry]) as handle:
+        i = entry * interval
+        for record in parse_fastq(handle, chunk_size=BGZF_BLOCK_SIZE):
+            if i >= stop:
+                break
+            if i >= start:
+                yield record
+            i += 1
+
@@ -0,0 +1,181 @@
+"""
+nextgen4b.process.cache
+
+A persistent, size-bounded cache of read alignments, so re-filtering the
+same data with different cutoffs does not need to re-align it.
+"""
+import hashlib
+import itertools
+import re
+import sqlite3
+
+__all__ = ['AlignmentCache']
+
+_OPS_RE = re.compile(r'(\d+)([MID])')
+
+
+def encode_alignment(aln_template, aln_read):
+    """
+    Encode an alignment as run-lengths of M (both aligned), D (gap in the
+    read) and I (gap in the template) columns, e.g. '3D95M2I'.
+    """
+    ops = []
+    for a, b in zip(aln_template, aln_read):
+        if a == '-':
+            ops.append('I')
+        elif b == '-':
+            ops.append('D')
+        else:
+            ops.append('M')
+    return ''.join('%i%s' % (len(list(run)), op)
+                   for op, run in itertools.groupby(ops))
+
+
+def decode_alignment(ops, template, read):
+    """
+    Rebuild the (aligned template, aligned read) strings from an encoding
+    made by encode_alignment.
+    """
+    t_aln = []
+    r_aln = []
+    i = 0 # Position in read
+    j = 0 # Position in template
+    for n, op in _OPS_RE.findall(ops):
+        n = int(n)
+        if op == 'M':
+            t_aln.append(template[j:j+n])
+            r_aln.append(read[i:i+n])
+            i += n
+            j += n
+        elif op == 'D':
+            t_aln.append(template[j:j+n])
+            r_aln.append('-' * n)
+            j += n
+        else:
+            t_aln.append('-' * n)
+            r_aln.append(read[i:i+n])
+            i += n
+    return ''.join(t_aln), ''.join(r_aln)
+
+
+class AlignmentCache(object):
+    """
+    An on-disk (SQLite) store of alignments, keyed by the alignment
+    parameters and the read sequence. Each entry keeps the score and the
+    alignment as a compact run-length encoding.
+
+    When there are more than max_entries alignments, the least recently
+    used are evicted. Cache hits and misses are counted in hits and misses.
+    """
+
+    def __init__(self, path='ngs_alignment_cache.sqlite', max_entries=5000000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self._conn = sqlite3.connect(path, timeout=60)
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS alignments (
+                                  params TEXT NOT NULL,
+                                  read TEXT NOT NULL,
+                                  score REAL NOT NULL,
+                                  ops TEXT NOT NULL,
+                                  last_used INTEGER NOT NULL,
+                                  PRIMARY KEY (params, read)
+                              ) WITHOUT ROWID''')
+        self._conn.execute('''CREATE INDEX IF NOT EXISTS alignments_last_used
+                              ON alignments (last_used)''')
+        self._conn.commit()
+
+        self._n_entries = self._conn.execute(
+            'SELECT COUNT(*) FROM alignments').fetchone()[0]
+        self._clock = self._conn.execute(
+            'SELECT COALESCE(MAX(last_used), 0) FROM alignments').fetchone()[0]
+
+    @staticmethod
+    def params_key(template, gapopen, gapextend, aligner='needle', band=None):
+        """
+        Key for a set of alignment parameters. The aligner and band are
+        included, as they can change gap placement.
+        """
+        params = '|'.join(str(p) for p in
+                          [template, gapopen, gapextend, aligner, band])
+        return hashlib.sha1(params.encode('ascii')).hexdigest()[:16]
+
+    def get_many(self, params, template, reads):
+        """
+        Look up read strings. Returns a dict from read to (score, aligned
+        template, aligned read) tuples, for the reads found in the cache.
+        """
+        found = {}
+        unique_reads = list(set(reads))
+        for start in range(0, len(unique_reads), 500):
+            chunk = unique_reads[start:start+500]
+            rows = self._conn.execute(
+                'SELECT read, score, ops FROM alignments WHERE params = ? '
+                'AND read IN (%s)' % ','.join('?' * len(chunk)),
+                [params] + chunk)
+            for read, score, ops in rows:
+                found[read] = (score,) + decode_alignment(ops, template, read)
+
+        self.hits += len(found)
+        self.misses += len(unique_reads) - len(found)
+
+        if found:
+            self._clock += 1
+            self._conn.executemany(
+                'UPDATE alignments SET last_used = ? WHERE params = ? '
+                'AND read = ?',
+                [(self._clock, params, read) for read in found.keys()])
+            self._conn.commit()
+        return found
+
+    def put_many(self, params, reads, alignments):
+        """
+        Store (score, aligned template, aligned read) tuples for read strings,
+        evicting the least recently used entries if the cache is full.
+        """
+        self._clock += 1
+        rows = [(params, read, aln[0], encode_alignment(aln[1], aln[2]),
+                 self._clock) for read, aln in zip(reads, alignments)]
+        n_before = self._conn.total_changes
+        self._conn.executemany(
+            'INSERT OR IGNORE INTO alignments VALUES (?, ?, ?, ?, ?)', rows)
+        self._n_entries += self._conn.total_changes - n_before
+        self._conn.commit()
+
+        if self._n_entries > self.max_entries:
+            self.evict(self._n_entries - self.max_entries)
+
+    def evict(self, n):
+        """
+        Remove the n least recently used alignments.
+        """
+        self._conn.execute(
+            'DELETE FROM alignments WHERE (params, read) IN (SELECT params, '
+            'read FROM alignments ORDER BY last_used LIMIT ?)', (n,))
+        self._conn.commit()
+        self._n_entries = self._conn.execute(
+            'SELECT COUNT(*) FROM alignments').fetchone()[0]
+
+    def stats(self):
+        """
+        Return a dict of hit/miss statistics.
+        """
+        n_lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / n_lookups if n_lookups else 0.,
+                'entries': self._n_entries}
+
+    def close(self):
+        self._conn.close()
+
+    def __len__(self):
+        return self._n_entries
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,309 @@
+"""
+nextgen4b.process.fastq
+
+A lightweight FASTQ reader. Records are parsed straight from the raw
+(optionally gzipped) bytes into FastqRecord objects, which are much smaller
+and faster to make than Biopython SeqRecords, but provide the parts of the
+SeqRecord interface that the filters use.
+"""
+import gzip
+import io
+import queue
+import threading
+import time
+
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+
+__all__ = ['FastqRecord', 'ThreadedReader', 'read_fastq', 'read_fastq_batches',
+           'parse_fastq', 'as_seqrecords']
+
+_RC_TABLE = str.maketrans('ACGTNacgtn', 'TGCANtgcan')
+
+
+class FastqRecord(object):
+    """
+    A single FASTQ read. seq and qual are strings, and qual holds the raw
+    (Phred+33) quality characters.
+    """
+    __slots__ = ('description', 'seq', 'qual')
+
+    def __init__(self, description, seq, qual):
+        self.description = description
+        self.seq = seq
+        self.qual = qual
+
+    @property
+    def id(self):
+        return self.description.split(' ', 1)[0]
+
+    @property
+    def name(self):
+        return self.id
+
+    @property
+    def letter_annotations(self):
+        return {'phred_quality': [ord(c) - 33 for c in self.qual]}
+
+    def min_quality(self):
+        """
+        Lowest Phred score in the read, or None if the read is empty.
+        """
+        if not self.qual:
+            return None
+        return ord(min(self.qual)) - 33
+
+    def reverse_complement(self):
+        return FastqRecord(self.description,
+                           self.seq.translate(_RC_TABLE)[::-1],
+                           self.qual[::-1])
+
+    def to_seqrecord(self):
+        """
+        Convert to a Biopython SeqRecord.
+        """
+        return SeqRecord(Seq(self.seq), id=self.id, name=self.id,
+                         description=self.description,
+                         letter_annotations=self.letter_annotations)
+
+    def format_fastq(self):
+        return '@%s\n%s\n+\n%s\n' % (self.description, self.seq, self.qual)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return FastqRecord(self.description, self.seq[index],
+                               self.qual[index])
+        return self.seq[index]
+
+    def __len__(self):
+        return len(self.seq)
+
+    def __repr__(self):
+        return 'FastqRecord(%r, %r, %r)' % (self.description, self.seq,
+                                            self.qual)
+
+
+def as_seqrecords(seqs):
+    """
+    Convert any FastqRecords in seqs to SeqRecords, e.g. for SeqIO.write.
+    """
+    return [s.to_seqrecord() if isinstance(s, FastqRecord) else s
+            for s in seqs]
+
+#####################
+# Parsing
+#####################
+
+def open_fastq(fpath):
+    """
+    Open a .fastq or .fastq.gz file for reading as bytes.
+    """
+    if fpath.endswith('.gz'):
+        return gzip.open(fpath, 'rb')
+    elif fpath.endswith('.fastq'):
+        return open(fpath, 'rb')
+    else:
+        raise ValueError('File does not end in .gz or .fastq; confirm file type.')
+
+class ThreadedReader(io.RawIOBase):
+    """
+    A read-only binary file that opens a .fastq or .fastq.gz file and reads
+    (and decompresses) it on a background thread, so decompression overlaps
+    with whatever is consuming the data. zlib releases the GIL while it
+    works, so the two really do run at the same time.
+
+    The thread passes chunks of about chunk_size bytes, cut at line
+    boundaries, through a queue of at most queue_size chunks, which bounds
+    the memory used for read-ahead.
+
+    stats() reports how fast each side ran, and which side spent its time
+    waiting on the other.
+    """
+
+    def __init__(self, fpath, chunk_size=1 << 20, queue_size=8):
+        io.RawIOBase.__init__(self)
+        self.fpath = fpath
+        self.chunk_size = chunk_size
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._chunk = b''
+        self._pos = 0
+        self._done = False
+
+        # Timing, in seconds
+        self._start = time.perf_counter()
+        self._end = None
+        self._bytes = 0
+        self._read_time = 0. # Producer reading/decompressing
+        self._put_wait = 0. # Producer blocked on a full queue
+        self._get_wait = 0. # Consumer blocked on an empty queue
+
+        self._thread = threading.Thread(target=self._produce)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item):
+        start = time.perf_counter()
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        self._put_wait += time.perf_counter() - start
+
+    def _produce(self):
+        try:
+            with open_fastq(self.fpath) as handle:
+                tail = b''
+                while not self._stop.is_set():
+                    start = time.perf_counter()
+                    data = handle.read(self.chunk_size)
+                    self._read_time += time.perf_counter() - start
+                    if not data:
+                        break
+                    self._bytes += len(data)
+                    data = tail + data
+                    cut = data.rfind(b'\n') + 1
+                    tail = data[cut:]
+                    if cut:
+                        self._put(data[:cut])
+                if tail:
+                    self._put(tail)
+        except Exception as e:
+            self._put(e)
+        self._put(None)
+
+    def readable(self):
+        return True
+
+    def _next_chunk(self):
+        start = time.perf_counter()
+        item = self._queue.get()
+        self._get_wait += time.perf_counter() - start
+        if isinstance(item, Exception):
+            self._done = True
+            raise item
+        if item is None:
+            self._done = True
+            self._end = time.perf_counter()
+            return False
+        self._chunk = item
+        self._pos = 0
+        return True
+
+    def read(self, size=-1):
+        if self._pos >= len(self._chunk):
+            if self._done or not self._next_chunk():
+                return b''
+        if size is None or size < 0:
+            size = len(self._chunk)
+        if self._pos == 0 and size >= len(self._chunk):
+            data = self._chunk
+        else:
+            data = self._chunk[self._pos:self._pos+size]
+        self._pos += len(data)
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            while self._thread.is_alive():
+                try:
+                    self._queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            if self._end is None:
+                self._end = time.perf_counter()
+        io.RawIOBase.close(self)
+
+    def stats(self):
+        """
+        Return a dict of throughput statistics for both sides of the queue.
+        Rates are in MB (of uncompressed data) per second of busy time.
+        """
+        end = self._end if self._end is not None else time.perf_counter()
+        elapsed = end - self._start
+        mb = self._bytes / 1e6
+        consumer_time = max(elapsed - self._get_wait, 1e-9)
+        return {'fpath': self.fpath,
+                'mb': mb,
+                'elapsed_s': elapsed,
+                'read_mb_per_s': mb / max(self._read_time, 1e-9),
+                'consumer_mb_per_s': mb / consumer_time,
+                'reader_blocked_s': self._put_wait,
+                'consumer_blocked_s': self._get_wait,
+                'bottleneck': ('reading' if self._get_wait > self._put_wait
+                               else 'consumer')}
+
+def _make_record(header, seq, plus, qual):
+    if not header.startswith(b'@') or not plus.startswith(b'+'):
+        raise ValueError('Malformed FASTQ record: %r' % header)
+    seq = seq.rstrip(b'\r')
+    qual = qual.rstrip(b'\r')
+    if len(seq) != len(qual):
+        raise ValueError('Sequence and quality lengths differ for %r' % header)
+    return FastqRecord(header[1:].rstrip(b'\r').decode('ascii'),
+                       seq.decode('ascii'), qual.decode('ascii'))
+
+def parse_fastq(handle, chunk_size=1 << 20):
+    """
+    Yield FastqRecords from a binary file handle. The input is read in
+    chunks of chunk_size bytes and split into lines in bulk.
+    """
+    pending = [] # Lines of an incomplete record
+    tail = b''
+    while True:
+        chunk = handle.read(chunk_size)
+        if not chunk:
+            break
+        lines = (tail + chunk).split(b'\n')
+        tail = lines.pop()
+        if pending:
+            lines = pending + lines
+        n_full = len(lines) - len(lines) % 4
+        for k in range(0, n_full, 4):
+            yield _make_record(lines[k], lines[k+1], lines[k+2], lines[k+3])
+        pending = lines[n_full:]
+
+    if tail:
+        pending.append(tail)
+    while pending and not pending[-1].strip():
+        pending.pop()
+    if len(pending) == 4:
+        yield _make_record(*pending)
+    elif pending:
+        raise ValueError('Truncated FASTQ record at end of file.')
+
+def read_fastq(fpath, threaded=False):
+    """
+    Yield FastqRecords from a .fastq or .fastq.gz file. If threaded is
+    True, the file is read by a ThreadedReader.
+    """
+    if threaded:
+        handle = ThreadedReader(fpath)
+    else:
+        handle = open_fastq(fpath)
+    with handle:
+        for record in parse_fastq(handle):
+            yield record
+
+def read_fastq_batches(fpath, batch_size=10000):
+    """
+    Yield lists of at most batch_size FastqRecords from a .fastq or
+    .fastq.gz file.
+    """
+    batch = []
+    for record in read_fastq(fpath):
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -5,32 +5,72 @@ TC, 8/11/16
 A collection of functions that read, filter, and output sequence data from
 next-generation sequencing experiments.
 """
+import collections
+import concurrent.futures
+import contextlib
 import gzip
+import io
 import logging
 import os
 import re
+import shutil
 import sys
+import tempfile
 import time
-import uuid
+import traceback
 
-import numpy as np
 import yaml
-from Bio import AlignIO, SeqIO
-from Bio.Emboss.Applications import NeedleCommandline
+from Bio import SeqIO
 from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
 from tqdm import tqdm
 
+from .align import align_seqs
+from .barcodes import BarcodeIndex
+from .cache import AlignmentCache
+from .fastq import FastqRecord, ThreadedReader, parse_fastq, read_fastq
+from .manifest import Manifest, atomic_open, expt_fingerprint
+from .metrics import NullMetrics, PipelineMetrics, file_size
+from .shard import (INDEX_INTERVAL, Shard, load_shard_manifest,
+                    merge_csv_rows, plan_shards, save_shard_manifest,
+                    shard_name)
+from .store import STORE_SUFFIX, StoreWriter, load as load_store
+
 __all__ = ['filter_sample', 'run_all_experiments']
 
 #####################
 # File Management
 #####################
 
-def load_ngs_file(fpath, ftype='fastq'):
+def load_ngs_file(fpath, ftype='fastq', compact=False, threaded=False):
     """
     Load a .fastq file to a SeqIO iterator, un-gzip if necessary.
+
+    If compact is True, yield lightweight FastqRecords from
+    nextgen4b.process.fastq instead of SeqRecords. If threaded is True, the
+    file is read and decompressed on a background thread, and throughput
+    statistics are logged once the iterator is exhausted.
+
+    fpath may also be a Shard from nextgen4b.process.shard, to read part of
+    a file.
     """
+    if isinstance(fpath, Shard):
+        if compact:
+            return fpath.records()
+        return (s.to_seqrecord() for s in fpath.records())
+
+    if threaded:
+        reader = ThreadedReader(fpath)
+        if compact and ftype == 'fastq':
+            f_iter = parse_fastq(reader)
+        else:
+            f_iter = SeqIO.parse(io.TextIOWrapper(io.BufferedReader(reader),
+                                                  encoding='ascii'), ftype)
+        return _log_reader_stats(reader, f_iter)
+
+    if compact and ftype == 'fastq':
+        return read_fastq(fpath)
+
     if fpath.endswith('.gz'):
         seq_f = gzip.open(fpath, 'rt')
     elif fpath.endswith('.fastq'):
@@ -40,19 +80,79 @@ def load_ngs_file(fpath, ftype='fastq'):
     f_iter = SeqIO.parse(seq_f, ftype)
     return f_iter
 
+def _log_reader_stats(reader, f_iter):
+    """
+    Pass through the records in f_iter, then close reader and log its
+    statistics.
+    """
+    text_logger = logging.getLogger(__name__+'.text_logger')
+    try:
+        for s in f_iter:
+            yield s
+    finally:
+        reader.close()
+        text_logger.info('Read %(mb).1f MB from %(fpath)s in %(elapsed_s).1f s. '
+                         'Reading: %(read_mb_per_s).1f MB/s, blocked '
+                         '%(reader_blocked_s).1f s; consumer: '
+                         '%(consumer_mb_per_s).1f MB/s, blocked '
+                         '%(consumer_blocked_s).1f s. Bottleneck: '
+                         '%(bottleneck)s.', reader.stats())
+
 #####################
 # Main Filter Code
 #####################
 
-def filter_sample(f_name, pe_name, bcs, templates, f_filt_seqs, r_filt_seqs):
+def filter_sample(f_name, pe_name, bcs, templates, f_filt_seqs, r_filt_seqs,
+                  stream=False, batch_size=10000, lockstep=False,
+                  compact=False, threaded=False, expts=None, metrics=None,
+                  bc_mismatches=0, **aln_kwargs):
     """
     Output filtered sequences as dictionary, indexed by barcode.
     Sequences will be aligned to the provided template.
     Parts of the template not represented will be '-'
+
+    If stream is True, reads are filtered one at a time by
+    iter_filter_sample rather than stage-by-stage as lists.
+
+    If lockstep is True, the forward and paired-end files are assumed to list
+    reads in the same order, and mates are found by walking both files
+    together once, before demultiplexing, rather than by indexing every
+    paired-end read.
+
+    If expts is given, only those experiments are filtered past
+    demultiplexing (which still uses every barcode in bcs).
+
+    bc_mismatches is the number of substitutions to tolerate in barcodes
+    when demultiplexing (see BarcodeIndex).
+
+    If metrics is a PipelineMetrics from nextgen4b.process.metrics, the time
+    and reads in and out of each stage are recorded in it.
+
+    compact and threaded are passed on to load_ngs_file. Any other keyword
+    arguments are passed on to alignment_filter.
     """
+    if expts is None:
+        expts = list(bcs.keys())
+
+    if stream:
+        bc_seqs = {expt: [] for expt in expts}
+        for expt, seqs in iter_filter_sample(f_name, pe_name, bcs, templates,
+                                             f_filt_seqs, r_filt_seqs,
+                                             batch_size=batch_size,
+                                             lockstep=lockstep,
+                                             compact=compact,
+                                             threaded=threaded,
+                                             expts=expts, metrics=metrics,
+                                             bc_mismatches=bc_mismatches,
+                                             **aln_kwargs):
+            bc_seqs[expt].extend(seqs)
+        return bc_seqs
+
     # setup loggers
     text_logger = logging.getLogger(__name__+'.text_logger')
     csv_logger = logging.getLogger(__name__+'.csv_logger')
+    if metrics is None:
+        metrics = NullMetrics()
 
     text_logger.info('Started filtering routine for %s', f_name)
 
@@ -62,43 +162,73 @@ def filter_sample(f_name, pe_name, bcs, templates, f_filt_seqs, r_filt_seqs):
 
     # Load as generators, then filter
     text_logger.info('Loading Files')
-    f_seqs = load_ngs_file(f_name)
-    for regex in f_res:
-        f_seqs = filter_seqs(f_seqs, regex)
-    pe_seqs = load_ngs_file(pe_name)
-    for regex in pe_res:
-        pe_seqs = filter_seqs(pe_seqs, regex)
+    f_seqs = metrics.timed_iter(load_ngs_file(f_name, compact=compact,
+                                              threaded=threaded), 'read')
+    metrics.stage('read').bytes_in += file_size(f_name)
+    with metrics.timed('regex') as stage:
+        for regex in f_res:
+            f_seqs = filter_seqs(f_seqs, regex)
+        if f_res:
+            stage.count(metrics.stage('read').reads_out, len(f_seqs))
+    pe_seqs = metrics.timed_iter(load_ngs_file(pe_name, compact=compact,
+                                               threaded=threaded), 'read_pe')
+    metrics.stage('read_pe').bytes_in += file_size(pe_name)
+    with metrics.timed('pe_index') as stage:
+        if lockstep:
+            # Walk both files once, keeping the mates of the forward reads
+            # that are left; mates failing pe_res are kept as None
+            pairs = list(pair_mates_lockstep(f_seqs, pe_seqs, pe_res=pe_res))
+            f_seqs = [f_seq for f_seq, _ in pairs]
+            mates = {get_coords(f_seq): mate for f_seq, mate in pairs}
+        else:
+            for regex in pe_res:
+                pe_seqs = iter_filter_seqs(pe_seqs, regex)
+            mates = index_mates(pe_seqs)
+        stage.count(metrics.stage('read_pe').reads_out, len(mates))
 
     # Barcode Filtering/Demux
-    bc_seqs = barcodeDemux(f_seqs, bcs)
+    with metrics.timed('demux') as stage:
+        bc_seqs = barcodeDemux(f_seqs, bcs, max_mismatches=bc_mismatches)
+        stage.count(len(f_seqs) if isinstance(f_seqs, list)
+                    else metrics.stage('read').reads_out,
+                    sum(len(seqs) for seqs in bc_seqs.values()))
 
     # Sequence-based filtering
-    for expt in bcs.keys():
+    for expt in expts:
         text_logger.info('Starting post-demux filtering for expt ID %s', expt)
+        expt_metrics = metrics.for_expt(expt)
         csv_data = [expt, len(bc_seqs[expt])]
         # Filter based on PE matches, only return the copied sequence
         # Assumes the first RE in f_res will terminate the copied sequence
         # copiedFuncGenerator's output should return all sequence before the adapter
-        seqs = filter_pe_mismatch(bc_seqs[expt], pe_seqs,
-                                  gen_copied_seq_function(f_res))
+        with expt_metrics.timed('pe_match') as stage:
+            seqs = filter_pe_mismatch(bc_seqs[expt], mates,
+                                      gen_copied_seq_function(f_res))
+            stage.count(len(bc_seqs[expt]), len(seqs))
         csv_data.append(len(seqs))
 
-        seqs = [trim_lig_adapter(s, f_res) for s in seqs] # Trim CS2 before filtering on quality (bad Qs at end of seqs)
+        with expt_metrics.timed('trim') as stage:
+            seqs = [trim_lig_adapter(s, f_res) for s in seqs] # Trim CS2 before filtering on quality (bad Qs at end of seqs)
+            stage.count(len(seqs), len(seqs))
 
         # Quality filter
-        if len(seqs) > 0:
-            seqs = quality_filter(seqs) # Quality Filtering (needs to only have copied sequence)
-        else:
-            text_logger.info("""No sequences left, skipped quality score
-                             filtering for expt ID %s.""", expt)
-            bc_seqs[expt] = seqs
+        with expt_metrics.timed('quality') as stage:
+            n_in = len(seqs)
+            if len(seqs) > 0:
+                seqs = quality_filter(seqs) # Quality Filtering (needs to only have copied sequence)
+            else:
+                text_logger.info("""No sequences left, skipped quality score
+                                 filtering for expt ID %s.""", expt)
+                bc_seqs[expt] = seqs
+            stage.count(n_in, len(seqs))
         csv_data.append(len(seqs))
 
         # Align filter
         if len(seqs) > 0:
             # Do alignment-based filtering
             full_template = '{}{}'.format(bcs[expt], templates[expt])
-            seqs = alignment_filter(seqs, full_template) # Do alignment-based filtering
+            seqs = alignment_filter(seqs, full_template, metrics=expt_metrics,
+                                    **aln_kwargs) # Do alignment-based filtering
         else:
             text_logger.info("""No sequences left, skipped align filtering for
                              expt ID %s.***""", expt)
@@ -106,18 +236,155 @@ def filter_sample(f_name, pe_name, bcs, templates, f_filt_seqs, r_filt_seqs):
         csv_data.append(len(seqs))
 
         # Length filtering
-        if len(seqs) > 0:
-            seqs = len_filter(seqs, l_barcode=len(bcs[expt])) # Length Filtering
-        else:
-            text_logger.info("""No sequences left, skipped length filtering for
-                             expt ID %s***""", expt)
-            bc_seqs[expt] = seqs
+        with expt_metrics.timed('length') as stage:
+            n_in = len(seqs)
+            if len(seqs) > 0:
+                seqs = len_filter(seqs, l_barcode=len(bcs[expt])) # Length Filtering
+            else:
+                text_logger.info("""No sequences left, skipped length filtering for
+                                 expt ID %s***""", expt)
+                bc_seqs[expt] = seqs
+            stage.count(n_in, len(seqs))
         csv_data.append(len(seqs))
 
         csv_logger.info(','.join([str(n) for n in csv_data]))
         bc_seqs[expt] = seqs
 
-    return bc_seqs
+    return {expt: bc_seqs[expt] for expt in expts}
+
+
+def iter_filter_sample(f_name, pe_name, bcs, templates, f_filt_seqs,
+                       r_filt_seqs, batch_size=10000, lockstep=False,
+                       compact=False, threaded=False, expts=None,
+                       metrics=None, bc_mismatches=0, **aln_kwargs):
+    """
+    Streaming version of filter_sample. Yields (expt, seqs) tuples, where
+    seqs is a list of at most batch_size aligned, filtered sequences.
+
+    Each forward read is passed through regex filtering, barcode demuxing,
+    paired-end matching, adapter trimming and quality filtering in a single
+    pass. Reads that survive are queued per experiment and aligned (then
+    length filtered) a batch at a time, so memory use is bounded by
+    batch_size rather than by the size of the run. Unless lockstep is True,
+    the paired-end sequences are held in memory in a mate index. If expts is
+    given, reads demultiplexed to other experiments are dropped. Barcodes
+    are matched with up to bc_mismatches substitutions.
+
+    The same per-stage counts as filter_sample are sent to the csv logger
+    once the input is exhausted. If metrics is a PipelineMetrics, per-stage
+    timings are recorded in it; the per-read stages are timed read by read,
+    which adds some overhead. Any other keyword arguments are passed on to
+    alignment_filter.
+    """
+    text_logger = logging.getLogger(__name__+'.text_logger')
+    csv_logger = logging.getLogger(__name__+'.csv_logger')
+    if metrics is None:
+        metrics = NullMetrics()
+
+    text_logger.info('Started streaming filtering routine for %s', f_name)
+
+    f_res = compile_res(f_filt_seqs)
+    pe_res = compile_res(r_filt_seqs)
+    copied_func = gen_copied_seq_function(f_res)
+
+    f_seqs = metrics.timed_iter(load_ngs_file(f_name, compact=compact,
+                                              threaded=threaded), 'read')
+    metrics.stage('read').bytes_in += file_size(f_name)
+    if f_res:
+        for regex in f_res:
+            f_seqs = iter_filter_seqs(f_seqs, regex)
+        f_seqs = metrics.timed_iter(f_seqs, 'regex')
+    pe_seqs = metrics.timed_iter(load_ngs_file(pe_name, compact=compact,
+                                               threaded=threaded), 'read_pe')
+    metrics.stage('read_pe').bytes_in += file_size(pe_name)
+    if lockstep:
+        pairs = pair_mates_lockstep(f_seqs, pe_seqs, pe_res=pe_res)
+    else:
+        text_logger.info('Indexing paired-end reads')
+        for regex in pe_res:
+            pe_seqs = iter_filter_seqs(pe_seqs, regex)
+        pairs = pair_mates_indexed(f_seqs, pe_seqs)
+    pairs = metrics.timed_iter(pairs, 'pe_index')
+
+    if expts is None:
+        expts = list(bcs.keys())
+
+    # [demux, PE match, quality, alignment, length] counts for each expt
+    counts = {expt: [0, 0, 0, 0, 0] for expt in expts}
+    batches = {expt: [] for expt in expts}
+    bc_index = BarcodeIndex(bcs, max_mismatches=bc_mismatches)
+
+    demux_stage = metrics.stage('demux')
+    stages = {expt: [metrics.for_expt(expt).stage(name)
+                     for name in ['pe_match', 'trim', 'quality']]
+              for expt in expts}
+
+    for s, mate in pairs:
+        demux_stage.start()
+        matches = bc_index.classify(str(s.seq))
+        demux_stage.stop(1, len(matches))
+        for expt in matches:
+            if expt not in counts:
+                continue
+            counts[expt][0] += 1
+            pe_stage, trim_stage, quality_stage = stages[expt]
+
+            pe_stage.start()
+            matched = mate_matches(s, mate, copied_func)
+            pe_stage.stop(1, matched)
+            if not matched:
+                continue
+            counts[expt][1] += 1
+
+            trim_stage.start()
+            trimmed = trim_lig_adapter(s, f_res)
+            trim_stage.stop(1, 1)
+
+            quality_stage.start()
+            passed = passes_quality(trimmed)
+            quality_stage.stop(1, passed)
+            if not passed:
+                continue
+            counts[expt][2] += 1
+
+            batches[expt].append(trimmed)
+            if len(batches[expt]) >= batch_size:
+                yield expt, _align_and_len_filter(batches[expt], expt, bcs,
+                                                  templates, counts,
+                                                  aln_kwargs, metrics)
+                batches[expt] = []
+
+    bc_index.log_counts(text_logger)
+    if f_res: # timed_iter counts only the reads that passed
+        metrics.stage('regex').reads_in = metrics.stage('read').reads_out
+    for expt in expts:
+        if batches[expt]:
+            yield expt, _align_and_len_filter(batches[expt], expt, bcs,
+                                              templates, counts, aln_kwargs,
+                                              metrics)
+            batches[expt] = []
+        csv_logger.info(','.join([str(n) for n in [expt] + counts[expt]]))
+
+    text_logger.info('Finished streaming filtering routine for %s', f_name)
+
+
+def _align_and_len_filter(seqs, expt, bcs, templates, counts, aln_kwargs,
+                          metrics):
+    """
+    Align and length filter one batch of iter_filter_sample, updating the
+    alignment and length counts for expt.
+    """
+    expt_metrics = metrics.for_expt(expt)
+    full_template = '{}{}'.format(bcs[expt], templates[expt])
+    seqs = alignment_filter(seqs, full_template, metrics=expt_metrics,
+                            **aln_kwargs)
+    counts[expt][3] += len(seqs)
+    with expt_metrics.timed('length') as stage:
+        n_in = len(seqs)
+        seqs = [s for s in seqs if passes_length(s, l_barcode=len(bcs[expt]))]
+        stage.count(n_in, len(seqs))
+    counts[expt][4] += len(seqs)
+    return seqs
 
 #####################
 # F/R Regex Filtering
@@ -137,6 +404,20 @@ def filter_seqs(seqs, q_re):
     text_logger.info('Finished regex filter. Kept %i sequences.', len(out_l))
     return out_l
 
+def iter_filter_seqs(seqs, q_re):
+    """
+    Generator version of filter_seqs. Yields items that match a regex object.
+    """
+    text_logger = logging.getLogger(__name__+'.text_logger')
+
+    n_kept = 0
+    for s in seqs:
+        if q_re.search(str(s.seq)):
+            n_kept += 1
+            yield s
+    text_logger.info('Finished regex filter %s. Kept %i sequences.',
+                     q_re.pattern, n_kept)
+
 def compile_res(seqs):
     """
     Compile regex for each string in a list, return list of regex objects.
@@ -149,23 +430,27 @@ def compile_res(seqs):
 # Barcode Filtering
 #####################
 
-def barcodeDemux(seqs, bcs):
+def barcodeDemux(seqs, bcs, max_mismatches=0):
     """
     Takes lists of sequence objects, dict of barcodes (indexed by expt. ID)
     Demuxes based on the barcode the sequences start with
-    Discards sequences that don't start with a barcode exact match
+    Discards sequences that don't start with a barcode match, allowing up to
+    max_mismatches substitutions (0 means an exact match)
     Assumes forward read -> sequences start with a barcode
     """
     text_logger = logging.getLogger(__name__+'.text_logger')
     text_logger.info('Started barcode demuxing.')
 
-    n_seqs = 0
-    bc_filtered_data = {}
-    for expt in bcs.keys():
-        bc_filtered_data[expt] = [s for s in seqs if str(s.seq).startswith(bcs[expt])]
-        n_seqs += len(bc_filtered_data[expt])
+    bc_index = BarcodeIndex(bcs, max_mismatches=max_mismatches)
+    bc_filtered_data = {expt: [] for expt in bcs.keys()}
+    for s in seqs:
+        for expt in bc_index.classify(str(s.seq)):
+            bc_filtered_data[expt].append(s)
+    n_seqs = sum(bc_index.counts.values())
 
-    text_logger.info('Finished barcode demuxing. Kept %i of %i sequences.', n_seqs, len(seqs))
+    bc_index.log_counts(text_logger)
+    text_logger.info('Finished barcode demuxing. Kept %i of %i sequences.',
+                     n_seqs, bc_index.n_classified)
 
     return bc_filtered_data
 
@@ -188,16 +473,82 @@ def trim_lig_adapter(s, f_res):
 def gen_copied_seq_function(f_res):
     return lambda s: get_copied_seq(s, f_res)
 
-def filter_pe_mismatch(f_seqs, pe_seqs, copied_func):
+_RC_TABLE = str.maketrans('ACGTNacgtn', 'TGCANtgcan')
+
+def reverse_complement_str(seq):
+    return seq.translate(_RC_TABLE)[::-1]
+
+def index_mates(pe_seqs):
+    """
+    Map the coordinates of each paired-end read to its sequence, for O(1)
+    mate lookups.
+    """
+    return {get_coords(s): str(s.seq) for s in pe_seqs}
+
+def pair_mates_indexed(f_seqs, pe_seqs):
+    """
+    Yield (forward read, mate sequence) tuples, looking mates up in an index
+    of pe_seqs. The mate is None if no paired-end read has the same
+    coordinates. pe_seqs may also be an index from index_mates.
+    """
+    if isinstance(pe_seqs, dict):
+        mates = pe_seqs
+    else:
+        mates = index_mates(pe_seqs)
+    for s in f_seqs:
+        yield s, mates.get(get_coords(s))
+
+def pair_mates_lockstep(f_seqs, pe_seqs, pe_res=()):
+    """
+    Yield (forward read, mate sequence) tuples, walking the forward and
+    paired-end reads together. Assumes both come from files with the same
+    read order, which is how they come off the sequencer.
+
+    f_seqs may already be filtered, but pe_seqs must not be, as mates are
+    found by skipping ahead to the next read with matching coordinates.
+    Instead, mates that do not match every regex in pe_res are returned as
+    None.
+    """
+    pe_iter = iter(pe_seqs)
+    for s in f_seqs:
+        coords = get_coords(s)
+        for pe in pe_iter:
+            if get_coords(pe) == coords:
+                break
+        else:
+            raise ValueError('No mate found for %s; forward and paired-end '
+                             'reads are not in the same order.' % coords)
+        mate = str(pe.seq)
+        if all(regex.search(mate) for regex in pe_res):
+            yield s, mate
+        else:
+            yield s, None
+
+def mate_matches(s, mate, copied_func):
+    """
+    Return True if the copied part of forward read s is found in the reverse
+    complement of its mate's sequence.
+    """
+    if mate is None:
+        return False
+    return str(copied_func(s).seq) in reverse_complement_str(mate)
+
+def filter_pe_mismatch(f_seqs, pe_seqs, copied_func, lockstep=False,
+                       pe_res=()):
     """
     Args:
         f_seqs - sequences from forward reads. Presumably filtered for the
                  required adatper(s).
         pe_seqs - the paired end sequences of f_seqs. Also presumably filtered
-                  for the required adapter(s).
+                  for the required adapter(s). May also be a mate index from
+                  index_mates.
         copied_func - takes a sequence, should ouptut the DNA that we expect
                       to have been copied, i.e. that should be on the paired
                       end read.
+        lockstep - if True, find mates with pair_mates_lockstep. pe_seqs
+                   must then be the unfiltered paired end reads, in the same
+                   order as the reads f_seqs were taken from.
+        pe_res - regexes that mates must match, used only with lockstep.
 
     Outputs a list of forward sequences that pass two filters:
         * Have a coordinate match in the paired end reads
@@ -212,23 +563,25 @@ def filter_pe_mismatch(f_seqs, pe_seqs, copied_func):
     aln_ct = 0 # number of sequences that have paired end sequence matches
     matched_seq_list = []
 
-    # Get coordinate list
-    pe_coord_list = [get_coords(s) for s in pe_seqs]
-    for s in f_seqs:
-        if get_coords(s) in pe_coord_list: # Filter based on paired-end presence
+    if lockstep:
+        pairs = pair_mates_lockstep(f_seqs, pe_seqs, pe_res=pe_res)
+    else:
+        pairs = pair_mates_indexed(f_seqs, pe_seqs)
+
+    for s, mate in pairs:
+        if mate is not None: # Filter based on paired-end presence
             co_ct += 1
-            copied = copied_func(s) # Get the part of the sequence that was actually copied
-            if str(pe_seqs[0].reverse_complement().seq).find(str(copied.seq)): # Filter on PE match
+            if mate_matches(s, mate, copied_func): # Filter on PE match
                 aln_ct += 1
                 matched_seq_list.append(s)
 
         proc_ct += 1
         if not (proc_ct % 5000):
-            text_logger.info("Processed %i out of %i", proc_ct, len(f_seqs))
+            text_logger.info("Processed %i sequences", proc_ct)
 
     text_logger.info("Finished Paired-End Filtering")
     text_logger.info("""Kept %i of %i forward sequences after coordinate
-                     filtering""", co_ct, len(f_seqs))
+                     filtering""", co_ct, proc_ct)
     text_logger.info("""Kept %i of %i forward sequences after paired-end sequence
                      matching""", aln_ct, co_ct)
 
@@ -238,12 +591,18 @@ def filter_pe_mismatch(f_seqs, pe_seqs, copied_func):
 # Q-score Filtering
 #####################
 
+def passes_quality(s, q_cutoff=20):
+    """
+    Return True if no base in s has a quality score below q_cutoff.
+    """
+    if isinstance(s, FastqRecord):
+        return not s.qual or s.min_quality() >= q_cutoff
+    return all(q >= q_cutoff for q in s.letter_annotations['phred_quality'])
+
 def quality_filter(seqs, q_cutoff=20):
     text_logger = logging.getLogger(__name__+'.text_logger')
     text_logger.info('Started Quality Score Filtering')
-    out_l = [s for s in seqs
-             if not any(s.letter_annotations['phred_quality']
-                        < np.ones(len(s.letter_annotations['phred_quality']))*q_cutoff)]
+    out_l = [s for s in seqs if passes_quality(s, q_cutoff=q_cutoff)]
     text_logger.info('Finished Quality Score Filtering. Kept %i of %i sequences.',
                      len(out_l), len(seqs))
     return out_l
@@ -252,6 +611,14 @@ def quality_filter(seqs, q_cutoff=20):
 # Length Filtering
 #####################
 
+def passes_length(s, l_cutoff=70, u_cutoff=150, l_barcode=0):
+    """
+    Return True if s has length between l_cutoff and u_cutoff (not counting
+    the barcode).
+    """
+    return (len(s.seq) >= (l_cutoff + l_barcode)) and \
+           (len(s.seq) <= (u_cutoff + l_barcode))
+
 def len_filter(seqs, l_cutoff=70, u_cutoff=150, l_barcode=0):
     """
     Return only sequence objects that have length between l_cutoff and
@@ -259,8 +626,9 @@ def len_filter(seqs, l_cutoff=70, u_cutoff=150, l_barcode=0):
     """
     text_logger = logging.getLogger(__name__+'.text_logger')
     text_logger.info('Started Length Filtering')
-    out_l = [s for s in seqs if (len(s.seq) >= (l_cutoff + l_barcode)) and
-             (len(s.seq) <= (u_cutoff + l_barcode))]
+    out_l = [s for s in seqs if passes_length(s, l_cutoff=l_cutoff,
+                                              u_cutoff=u_cutoff,
+                                              l_barcode=l_barcode)]
     text_logger.info('Finished Length Filtering. Kept %i of %i sequences.',
                      len(out_l), len(seqs))
     return out_l
@@ -270,54 +638,164 @@ def len_filter(seqs, l_cutoff=70, u_cutoff=150, l_barcode=0):
 #####################
 
 def alignment_filter(seqs, template, gapopen=10, gapextend=0.5, lo_cutoff=300,
-                     hi_cutoff=1000, cleanup=True):
+                     hi_cutoff=1000, cleanup=True, aligner='needle', band=None,
+                     processes=1, chunk_size=5000, dedup=False, collapse=False,
+                     cache=None, metrics=None):
+    """
+    Align sequences to template and return the aligned sequences that pass
+    cull_alignments' score and gap rules.
+
+    aligner is 'needle' to use EMBOSS needle, or 'numpy' to use the built-in
+    aligner in nextgen4b.process.align, which can also be banded.
+
+    If processes is more than 1, sequences are aligned in chunks of
+    chunk_size on a pool of that many processes.
+
+    If dedup is True, identical sequences are aligned and culled once, and
+    the result is copied back to every read with that sequence. If collapse
+    is also True, only the first read with each sequence is returned, with
+    the number of reads it stands for in annotations['count'] (which is not
+    kept by FASTA output).
+
+    cache may be an AlignmentCache, or the path to one. Reads already in the
+    cache are not re-aligned.
+
+    If metrics is given, the alignment and cull stages are timed in it.
+    """
     text_logger = logging.getLogger(__name__+'.text_logger')
     text_logger.info('Started alignment-based filtering')
     start_n_seqs = len(seqs)
+    if metrics is None:
+        metrics = NullMetrics()
+
+    with metrics.timed('alignment') as stage:
+        if dedup:
+            groups = group_identical_seqs(seqs)
+            to_align = [seqs[idxs[0]] for idxs in groups]
+            text_logger.info('Found %i unique of %i sequences', len(to_align),
+                             start_n_seqs)
+        else:
+            to_align = seqs
+
+        # Generate alignment command, run the alignment
+        text_logger.info("""Began %s alignment routine with settings:\ngapopen:
+                        %i\ngapextend: %i\nlo_cutoff: %i\nhi_cutoff: %i""",
+                     aligner, gapopen, gapextend, lo_cutoff, hi_cutoff)
+        aln_kwargs = dict(gapopen=gapopen, gapextend=gapextend, aligner=aligner,
+                          band=band, cleanup=cleanup, processes=processes,
+                          chunk_size=chunk_size)
+        if cache is None:
+            alignments = align_seqs(to_align, template, **aln_kwargs)
+        elif isinstance(cache, AlignmentCache):
+            alignments = cached_align_seqs(to_align, template, cache,
+                                           **aln_kwargs)
+        else:
+            with AlignmentCache(cache) as aln_cache:
+                alignments = cached_align_seqs(to_align, template, aln_cache,
+                                               **aln_kwargs)
+        text_logger.info('Finished %s alignment routine', aligner)
+        stage.count(start_n_seqs, len(alignments))
+
+    with metrics.timed('cull') as stage:
+        passed = [passes_alignment_cutoffs(aln[0], aln[1], lo_cutoff=lo_cutoff,
+                                           hi_cutoff=hi_cutoff)
+                  for aln in alignments]
+
+        if not dedup:
+            new_seqs = [aligned_record(s, aln) for s, aln, ok
+                        in zip(seqs, alignments, passed) if ok]
+        elif collapse:
+            new_seqs = [aligned_record(seqs[idxs[0]], aln, count=len(idxs))
+                        for idxs, aln, ok in zip(groups, alignments, passed)
+                        if ok]
+        else:
+            # Expand back out in the original read order
+            read_alns = [None] * start_n_seqs
+            for idxs, aln, ok in zip(groups, alignments, passed):
+                if ok:
+                    for i in idxs:
+                        read_alns[i] = aln
+            new_seqs = [aligned_record(s, aln) for s, aln
+                        in zip(seqs, read_alns) if aln is not None]
+        stage.count(len(alignments), len(new_seqs))
 
-    # Save the template and sequences as temporary fasta files
-    # Probably some hacking that can be done in the NeedleCommandline stuff
-    seqs_f_name = 'tempseq.fa'
-
-    with open(seqs_f_name, 'w') as sh:
-        SeqIO.write(seqs, sh, 'fastq')
-
-    # Generate alignment command, run the alignment
-    text_logger.info("""Began EMBOSS needle routine with settings:\ngapopen:
-                    %i\ngapextend: %i\nlo_cutoff: %i\nhi_cutoff: %i""",
-                 gapopen, gapextend, lo_cutoff, hi_cutoff)
-    ofilen = 'temp_'+str(uuid.uuid4())+'.needle'
-    needle_cline = NeedleCommandline(asequence='asis::{}'.format(template),
-                                     bsequence=seqs_f_name, gapopen=gapopen,
-                                     gapextend=gapextend, outfile=ofilen)
-    needle_cline()
-    text_logger.info('Finished EMBOSS needle routine')
-
-    aln_data = AlignIO.parse(open(ofilen), "emboss")
-    new_seqs = cull_alignments(aln_data, lo_cutoff=lo_cutoff,
-                               hi_cutoff=hi_cutoff)
-
-    # Exit routine
-    if cleanup:
-        text_logger.info('Cleaning up temp files')
-        os.remove(seqs_f_name)
-        os.remove(ofilen)
     text_logger.info("""Finished alignment-based filtering. Kept %i of %i
                      sequences.""", len(new_seqs), start_n_seqs)
     return new_seqs
 
 
+def cached_align_seqs(seqs, template, cache, **aln_kwargs):
+    """
+    align_seqs, but only for the sequences not found in cache. New
+    alignments are added to the cache.
+    """
+    text_logger = logging.getLogger(__name__+'.text_logger')
+
+    params = AlignmentCache.params_key(template, aln_kwargs.get('gapopen', 10),
+                                       aln_kwargs.get('gapextend', 0.5),
+                                       aln_kwargs.get('aligner', 'needle'),
+                                       aln_kwargs.get('band'))
+    reads = [str(s.seq) for s in seqs]
+    found = cache.get_many(params, template, reads)
+
+    missing = [i for i, r in enumerate(reads) if r not in found]
+    if missing:
+        new_alns = align_seqs([seqs[i] for i in missing], template,
+                              **aln_kwargs)
+        cache.put_many(params, [reads[i] for i in missing], new_alns)
+        found.update(zip([reads[i] for i in missing], new_alns))
+
+    text_logger.info('Alignment cache: %(hits)i hits, %(misses)i misses '
+                     '(%(hit_rate).1f%% hit rate), %(entries)i entries',
+                     dict(cache.stats(), hit_rate=100*cache.stats()['hit_rate']))
+    return [found[r] for r in reads]
+
+
+def group_identical_seqs(seqs):
+    """
+    Group the indices of seqs by sequence. Returns a list of index lists,
+    ordered by the first appearance of each sequence.
+    """
+    groups = {}
+    for i, s in enumerate(seqs):
+        groups.setdefault(str(s.seq), []).append(i)
+    return list(groups.values())
+
+
+def aligned_record(s, alignment, count=None):
+    """
+    Make a SeqRecord of the aligned read from an (score, aligned template,
+    aligned read) tuple, keeping the score (and count, if given) in its
+    annotations.
+    """
+    score, _, aln_read = alignment
+    annotations = {'alnscore': score}
+    if count is not None:
+        annotations['count'] = count
+    return SeqRecord(Seq(aln_read), id=s.id, name=s.name,
+                     description=s.description, annotations=annotations)
+
+
+def passes_alignment_cutoffs(score, aln_template, lo_cutoff=300, hi_cutoff=650):
+    """
+    Return True if an alignment's score lies between the cutoffs and the
+    template has no gaps.
+    """
+    # Template should have no gaps, and should contain the whole
+    # non-template sequence
+    return (score > lo_cutoff) and (score < hi_cutoff) and \
+           not aln_template.count('-') > 0
+
+
 def cull_alignments(aln_data, lo_cutoff=300, hi_cutoff=650):
     new_seqs = []
 
     for alignment in aln_data:
-        if (alignment.annotations['score'] > lo_cutoff) \
-            and (alignment.annotations['score'] < hi_cutoff):
-            # Template should have no gaps, and should contain the whole
-            # non-template sequence
-            if not str(alignment[0].seq).count('-') > 0:
-                new_seqs.append(alignment[1])
-                new_seqs[-1].annotations['alnscore'] = alignment.annotations['score']
+        if passes_alignment_cutoffs(alignment.annotations['score'],
+                                    str(alignment[0].seq),
+                                    lo_cutoff=lo_cutoff, hi_cutoff=hi_cutoff):
+            new_seqs.append(alignment[1])
+            new_seqs[-1].annotations['alnscore'] = alignment.annotations['score']
     return new_seqs
 
 #####################
@@ -335,17 +813,95 @@ def setup_logger(name, file_name, log_format, level=logging.INFO):
     return logger
 
 
-def run_all_experiments(yf_name, save_intermediates=True):
+class _ListHandler(logging.Handler):
+    """
+    Logging handler that keeps formatted messages in a list.
+    """
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(self.format(record))
+
+
+def _swap_handlers(logger, handlers):
+    """
+    Replace the handlers on logger, returning the old ones.
+    """
+    old_handlers = logger.handlers[:]
+    for handler in old_handlers:
+        logger.removeHandler(handler)
+    for handler in handlers:
+        logger.addHandler(handler)
+    return old_handlers
+
+
+def get_run_settings(expt_yaml, run):
+    """
+    Get barcodes and templates for all experiments in a run, as dicts
+    indexed by experiment ID.
+    """
+    bcs = {}
+    templates = {}
+    for expt in expt_yaml['ngsruns'][run]['experiments']:
+        bcs[expt] = expt_yaml['experiments'][expt]['barcode']
+        templates[expt] = expt_yaml['experiments'][expt]['template_seq']
+    return bcs, templates
+
+
+def run_all_experiments(yf_name, save_intermediates=True, stream=False,
+                        run_processes=None, manifest='ngs_manifest.json',
+                        resume=True, log_metrics=False, shards=1,
+                        shard_interval=INDEX_INTERVAL, **filter_kwargs):
     """
     Filters all sequences noted in the passed YAML file.
+
+    If stream is True, each run is filtered with iter_filter_sample and
+    aligned sequences are written out batch by batch as they are produced.
+    Any other keyword arguments are passed on to filter_sample or
+    iter_filter_sample.
+
+    If run_processes is more than 1, runs are filtered in parallel on a pool
+    of that many processes (see filter_runs_parallel). If shards is more
+    than 1, runs are instead filtered one at a time, each split into that
+    many shards which are filtered on run_processes processes (by default,
+    one per shard; see filter_run_sharded); this helps when one run holds
+    most of the reads. Shards start on every shard_interval-th read (see
+    plan_shards), so a run with fewer than shards * shard_interval reads
+    gets fewer shards; lower it to shard small runs. A processes keyword
+    argument is passed on as usual, and sets the alignment pool within each
+    run or shard (see alignment_filter).
+
+    Finished outputs are recorded in the checkpoint manifest file manifest,
+    along with a fingerprint of their input files, YAML settings and filter
+    parameters (see nextgen4b.process.manifest). If resume is True, outputs
+    whose fingerprint is unchanged are not filtered again. Pass
+    manifest=None to turn this off.
+
+    If log_metrics is True, the time and throughput of each filtering
+    stage, and the peak memory use of the process by its end, are written
+    as JSON lines to ngs_metrics_<time>.jsonl (see
+    nextgen4b.process.metrics).
+
+    If misinc=True is passed, the per-position misincorporation table for
+    each experiment (<expt>_<run>_misinc_data.csv, as written by
+    nextgen4b.analyze.analyze_all_experiments) is counted as the reads are
+    filtered, so save_intermediates can be False.
+
+    Returns a dict of the runs that failed, mapped to their tracebacks.
     """
     # Setup text_logger
+    timestr = time.strftime("%Y%m%d-%H%M%S")
     text_logger = setup_logger(__name__+'.text_logger',
-                               'ngs_%s.log' % time.strftime("%Y%m%d-%H%M%S"),
+                               'ngs_%s.log' % timestr,
                                '%(asctime)s %(message)s')
     csv_logger = setup_logger(__name__+'.csv_logger',
-                              'ngs_filter_%s.csv' % time.strftime("%Y%m%d-%H%M%S"),
+                              'ngs_filter_%s.csv' % timestr,
                               '%(message)s')
+    if log_metrics:
+        setup_logger(__name__+'.metrics_logger',
+                     'ngs_metrics_%s.jsonl' % timestr, '%(message)s')
 
     # Load YAML file
     with open(yf_name) as expt_f:
@@ -355,30 +911,678 @@ def run_all_experiments(yf_name, save_intermediates=True):
     runs = expt_yaml['ngsruns']
     text_logger.info('Found NGS Runs: '+', '.join(runs))
 
-    for run in tqdm(runs.keys()):
-        text_logger.info('Performing routine for NGS Run '+run)
-        expts = runs[run]['experiments']
-        text_logger.info('Found experiments '+', '.join(expts))
+    # Work out which outputs need (re)making
+    output_format = filter_kwargs.get('output_format', 'fasta')
+    if manifest is not None and save_intermediates:
+        manifest = Manifest(manifest)
+    else:
+        manifest = None
+    run_expts, fingerprints = plan_runs(expt_yaml, manifest, resume,
+                                        filter_kwargs)
+
+    def finish_run(run, counts):
+        if manifest is not None:
+            for expt, n_seqs in counts.items():
+                key, details = fingerprints[run][expt]
+                outputs = aln_output_names(run, expt, output_format)
+                if filter_kwargs.get('misinc', False):
+                    outputs.append(misinc_output_name(run, expt))
+                manifest.record(run, expt, key, details, outputs, n_seqs)
+            manifest.save()
+
+    if shards > 1:
+        failed = {}
+        for run in tqdm(run_expts.keys()):
+            bcs, templates = get_run_settings(expt_yaml, run)
+            try:
+                counts = filter_run_sharded(
+                    run, runs[run], bcs, templates, shards,
+                    run_processes=run_processes, interval=shard_interval,
+                    timestr=timestr,
+                    save_intermediates=save_intermediates, stream=stream,
+                    expts=run_expts[run], log_metrics=log_metrics,
+                    **filter_kwargs)
+            except Exception: # Includes the failed shard's traceback
+                failed[run] = traceback.format_exc()
+                continue
+            finish_run(run, counts)
+    elif run_processes is not None and run_processes > 1:
+        failed = filter_runs_parallel(expt_yaml, run_processes, timestr,
+                                      run_expts=run_expts,
+                                      on_finish=finish_run,
+                                      save_intermediates=save_intermediates,
+                                      stream=stream, log_metrics=log_metrics,
+                                      **filter_kwargs)
+    else:
+        failed = {}
+        for run in tqdm(run_expts.keys()):
+            bcs, templates = get_run_settings(expt_yaml, run)
+            try:
+                counts = filter_run(run, runs[run], bcs, templates,
+                                    save_intermediates=save_intermediates,
+                                    stream=stream, expts=run_expts[run],
+                                    log_metrics=log_metrics, **filter_kwargs)
+            except Exception:
+                failed[run] = traceback.format_exc()
+                continue
+            finish_run(run, counts)
+
+    for run, tb in failed.items():
+        text_logger.error('Filtering failed for run %s:\n%s', run, tb)
+    if failed:
+        text_logger.error('%i of %i runs failed: %s', len(failed), len(runs),
+                          ', '.join(failed.keys()))
+    return failed
+
+
+def plan_runs(expt_yaml, manifest=None, resume=True, filter_kwargs=None):
+    """
+    Fingerprint the outputs of every run in expt_yaml, and decide which
+    need filtering.
+
+    Returns (run_expts, fingerprints). run_expts is an ordered dict of runs
+    with out-of-date outputs, mapped to the lists of experiments to filter.
+    fingerprints maps run, then experiment, to (key, details) tuples from
+    expt_fingerprint. If manifest is None, every experiment is filtered and
+    nothing is fingerprinted.
+    """
+    text_logger = logging.getLogger(__name__+'.text_logger')
+    if filter_kwargs is None:
+        filter_kwargs = {}
+
+    run_expts = collections.OrderedDict()
+    fingerprints = {}
+    for run, run_data in expt_yaml['ngsruns'].items():
+        bcs, templates = get_run_settings(expt_yaml, run)
+        if manifest is None:
+            run_expts[run] = list(bcs.keys())
+            continue
+
+        fingerprints[run] = {}
+        stale = []
+        for expt in bcs.keys():
+            fingerprints[run][expt] = expt_fingerprint(run_data, expt, bcs,
+                                                       templates,
+                                                       filter_kwargs)
+            if resume and manifest.is_current(run, expt,
+                                              fingerprints[run][expt][0]):
+                text_logger.info('Output for run %s, expt ID %s is up to '
+                                 'date, skipping', run, expt)
+            else:
+                stale.append(expt)
+        if stale:
+            run_expts[run] = stale
+        else:
+            text_logger.info('All outputs for run %s are up to date, '
+                             'skipping', run)
+    return run_expts, fingerprints
 
-        # Get barcodes, templates for all experiments in the run
-        bcs = {}
-        templates = {}
-        for expt in expts:
-            bcs[expt] = expt_yaml['experiments'][expt]['barcode']
-            templates[expt] = expt_yaml['experiments'][expt]['template_seq']
 
-        # Do filtering
-        text_logger.info('Starting filtering for run %s', run)
-        aln_seqs = filter_sample(runs[run]['f_read_name'],
-                                 runs[run]['pe_read_name'],
+OUTPUT_FORMATS = ('fasta', 'store', 'both')
+
+def aln_output_names(run, expt, output_format='fasta'):
+    """
+    Names of the aligned sequence outputs for an experiment in a run:
+    aln_seqs_<run>_<expt>.fa and/or aln_seqs_<run>_<expt>.alnstore.
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError('output_format must be one of %s, not %r.'
+                         % (', '.join(OUTPUT_FORMATS), output_format))
+    base = 'aln_seqs_%s_%s' % (run, expt)
+    names = []
+    if output_format in ('fasta', 'both'):
+        names.append(base + '.fa')
+    if output_format in ('store', 'both'):
+        names.append(base + STORE_SUFFIX)
+    return names
+
+
+def misinc_output_name(run, expt):
+    """
+    Name of the misincorporation table for an experiment in a run.
+    """
+    return '%s_%s_misinc_data.csv' % (expt, run)
+
+
+@contextlib.contextmanager
+def aln_output_writer(run, expt, output_format='fasta', counts=False,
+                      meta=None):
+    """
+    Open the aligned sequence outputs for an experiment in a run, yielding a
+    function that writes a batch of aligned reads to each of them. Outputs
+    are written atomically, and only moved into place if the with block
+    finishes without an error.
+
+    If counts is True, the store (if any) keeps a count column. meta is
+    kept in the store's header.
+    """
+    writers = []
+    store = None
+    with contextlib.ExitStack() as stack:
+        for name in aln_output_names(run, expt, output_format):
+            if name.endswith(STORE_SUFFIX):
+                store_f = stack.enter_context(atomic_open(name, 'wb'))
+                store = StoreWriter(store_f, counts=counts, meta=meta)
+                writers.append(store.write)
+            else:
+                fasta_f = stack.enter_context(atomic_open(name))
+                writers.append(lambda seqs: SeqIO.write(seqs, fasta_f,
+                                                        'fasta'))
+
+        def write(seqs):
+            for writer in writers:
+                writer(seqs)
+
+        yield write
+        if store is not None:
+            store.close()
+
+
+def filter_run(run, run_data, bcs, templates, save_intermediates=True,
+               stream=False, expts=None, log_metrics=False,
+               output_format='fasta', misinc=False, **filter_kwargs):
+    """
+    Filter one run from the YAML file, writing aligned sequences for each
+    experiment to aln_seqs_<run>_<expt>.fa. If expts is given, only those
+    experiments are filtered. If log_metrics is True, per-stage metrics are
+    sent to the metrics logger.
+
+    output_format is 'fasta', 'store' to write a memory-mappable
+    aln_seqs_<run>_<expt>.alnstore instead (see nextgen4b.process.store),
+    or 'both'.
+
+    If misinc is True, the aligned sequences of each experiment are also fed
+    to a MisincAccumulator (see nextgen4b.analyze.analyze), which is saved
+    to <expt>_<run>_misinc_data.csv.
+
+    Files are written atomically, so are either complete or not there at
+    all. Returns a dict of the number of sequences written for each
+    experiment.
+    """
+    text_logger = logging.getLogger(__name__+'.text_logger')
+    if expts is None:
+        expts = list(bcs.keys())
+    aln_output_names(run, '', output_format) # Check it early
+    if log_metrics:
+        filter_kwargs['metrics'] = PipelineMetrics(run)
+    text_logger.info('Performing routine for NGS Run '+run)
+    text_logger.info('Found experiments '+', '.join(bcs.keys()))
+
+    # Do filtering
+    text_logger.info('Starting filtering for run %s (expt IDs %s)', run,
+                     ', '.join(expts))
+    if stream:
+        counts = stream_run(run, run_data, bcs, templates,
+                            save_intermediates=save_intermediates,
+                            expts=expts, output_format=output_format,
+                            misinc=misinc, **filter_kwargs)
+    else:
+        aln_seqs = filter_sample(run_data['f_read_name'],
+                                 run_data['pe_read_name'],
                                  bcs, templates,
-                                 runs[run]['filter_seqs']['forward'],
-                                 runs[run]['filter_seqs']['reverse'])
+                                 run_data['filter_seqs']['forward'],
+                                 run_data['filter_seqs']['reverse'],
+                                 expts=expts, **filter_kwargs)
+        counts = {expt: len(aln_seqs[expt]) for expt in expts}
+        if save_intermediates:
+            for expt in expts:
+                with aln_output_writer(run, expt, output_format,
+                                       counts=filter_kwargs.get('collapse',
+                                                                False),
+                                       meta=_store_meta(run, expt, bcs,
+                                                        templates)) as write:
+                    write(aln_seqs[expt])
+        if misinc:
+            accs = _misinc_accumulators(expts, templates)
+            for expt in expts:
+                accs[expt].add(aln_seqs[expt])
+            _save_misincs(run, accs)
+    if log_metrics:
+        filter_kwargs['metrics'].emit(
+            logging.getLogger(__name__+'.metrics_logger'))
+    text_logger.info('Finished filtering for run %s', run)
+    return counts
+
+
+def filter_runs_parallel(expt_yaml, run_processes, timestr, run_expts=None,
+                         on_finish=None, **run_kwargs):
+    """
+    Filter every run in expt_yaml on a pool of run_processes processes.
+
+    Each run logs to its own ngs_<timestr>_<run>.log and gets its own scratch
+    directory for temporary files. The csv (and metrics) logger rows from
+    each run are collected and written out in YAML order once all runs are
+    done. A run that raises is reported, but does not stop the others.
+
+    If run_expts is given, only the runs and experiments in it (a dict of
+    run to list of experiments, see plan_runs) are filtered. on_finish, if
+    given, is called in this process with the run and the dict returned by
+    filter_run as each run succeeds.
+
+    Keyword arguments are passed to filter_run, so must be picklable (pass
+    an alignment cache as a path, for instance); processes among them sets
+    the alignment pool within each run.
+
+    Returns a dict of the runs that failed, mapped to their tracebacks.
+    """
+    text_logger = logging.getLogger(__name__+'.text_logger')
+    csv_logger = logging.getLogger(__name__+'.csv_logger')
+    metrics_logger = logging.getLogger(__name__+'.metrics_logger')
+
+    runs = expt_yaml['ngsruns']
+    if run_expts is None:
+        run_expts = {run: None for run in runs.keys()}
+    jobs = []
+    for run in runs.keys():
+        if run not in run_expts:
+            continue
+        bcs, templates = get_run_settings(expt_yaml, run)
+        jobs.append((run, runs[run], bcs, templates,
+                     'ngs_%s_%s.log' % (timestr, run),
+                     dict(run_kwargs, expts=run_expts[run])))
+
+    csv_rows = {}
+    metrics_rows = {}
+    failed = {}
+    text_logger.info('Filtering %i runs on %i processes', len(jobs),
+                     run_processes)
+    with concurrent.futures.ProcessPoolExecutor(run_processes) as executor:
+        futures = [executor.submit(_filter_run_worker, job) for job in jobs]
+        for future in tqdm(concurrent.futures.as_completed(futures),
+                           total=len(futures)):
+            try:
+                run, rows, m_rows, counts, tb = future.result()
+            except Exception: # The worker itself died
+                tb = traceback.format_exc()
+                run = jobs[futures.index(future)][0]
+                rows = []
+                m_rows = []
+            csv_rows[run] = rows
+            metrics_rows[run] = m_rows
+            if tb is None:
+                text_logger.info('Finished filtering for run %s', run)
+                if on_finish is not None:
+                    on_finish(run, counts)
+            else:
+                failed[run] = tb
+
+    # Deterministic output order, whatever order the runs finished in
+    for run in runs.keys():
+        for row in csv_rows.get(run, []):
+            csv_logger.info(row)
+        for row in metrics_rows.get(run, []):
+            metrics_logger.info(row)
+
+    return failed
+
+
+def _filter_run_worker(job):
+    """
+    Worker for filter_runs_parallel. Returns (run, csv rows, metrics rows,
+    sequence counts, traceback), where traceback is None if the run
+    succeeded.
+    """
+    run, run_data, bcs, templates, log_name, run_kwargs = job
+
+    text_logger = logging.getLogger(__name__+'.text_logger')
+    csv_logger = logging.getLogger(__name__+'.csv_logger')
+    metrics_logger = logging.getLogger(__name__+'.metrics_logger')
+
+    text_handler = logging.FileHandler(log_name)
+    text_handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    csv_handler = _ListHandler()
+    csv_handler.setFormatter(logging.Formatter('%(message)s'))
+    metrics_handler = _ListHandler()
+    metrics_handler.setFormatter(logging.Formatter('%(message)s'))
+    old_text_handlers = _swap_handlers(text_logger, [text_handler])
+    old_csv_handlers = _swap_handlers(csv_logger, [csv_handler])
+    old_metrics_handlers = _swap_handlers(metrics_logger, [metrics_handler])
+    text_logger.setLevel(logging.INFO)
+    csv_logger.setLevel(logging.INFO)
+    metrics_logger.setLevel(logging.INFO)
+
+    scratch_dir = tempfile.mkdtemp(prefix='ngs_%s_' % run, dir='.')
+    old_tempdir = tempfile.tempdir
+    tempfile.tempdir = scratch_dir
+
+    counts = None
+    tb = None
+    try:
+        counts = filter_run(run, run_data, bcs, templates, **run_kwargs)
+    except Exception:
+        tb = traceback.format_exc()
+        text_logger.error('Filtering failed for run %s:\n%s', run, tb)
+    finally:
+        tempfile.tempdir = old_tempdir
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+        _swap_handlers(text_logger, old_text_handlers)
+        _swap_handlers(csv_logger, old_csv_handlers)
+        _swap_handlers(metrics_logger, old_metrics_handlers)
+        text_handler.close()
+
+    return run, csv_handler.records, metrics_handler.records, counts, tb
+
+
+#####################
+# Sharded Runs
+#####################
+
+def filter_run_sharded(run, run_data, bcs, templates, shards,
+                       run_processes=None, interval=INDEX_INTERVAL, expts=None,
+                       save_intermediates=True, log_metrics=False,
+                       output_format='fasta', timestr=None, misinc=False,
+                       **filter_kwargs):
+    """
+    Filter one run split into shards record-aligned pieces (see
+    nextgen4b.process.shard), on a pool of run_processes processes (default:
+    one per shard; 1 to filter them one at a time in this process), then
+    merge the aligned sequences into the usual aln_seqs_<run>_<expt> outputs
+    and sum the csv logger counts.
+
+    Shards start on every interval-th read (see plan_shards), so a run with
+    fewer than shards * interval reads gets fewer shards, and a warning is
+    logged. Each shard logs to its own ngs_<timestr>_<run>.shard<i>.log, and
+    writes its aligned sequences to a store under its own name, which is
+    removed once merged. Shards are cheapest with lockstep=True and BGZF
+    inputs; otherwise every shard reads more than its share of the input
+    (see plan_shards), and a warning is logged. If collapse is set,
+    identical reads from different shards are kept as separate entries
+    (with their own counts). If misinc is True, misincorporations are
+    counted as the shards are merged (see filter_run).
+
+    Other keyword arguments are passed on to filter_run. Returns a dict of
+    the number of sequences for each experiment.
+    """
+    text_logger = logging.getLogger(__name__+'.text_logger')
+    csv_logger = logging.getLogger(__name__+'.csv_logger')
+    metrics_logger = logging.getLogger(__name__+'.metrics_logger')
+    if expts is None:
+        expts = list(bcs.keys())
+    aln_output_names(run, '', output_format) # Check it early
+    if timestr is None:
+        timestr = time.strftime("%Y%m%d-%H%M%S")
+
+    plan = plan_shards(run_data['f_read_name'], run_data['pe_read_name'],
+                       shards, lockstep=filter_kwargs.get('lockstep', False),
+                       interval=interval)
+    _warn_shard_costs(plan, shards)
+    if run_processes is None:
+        run_processes = len(plan)
+    jobs = []
+    for i, (f_shard, pe_shard) in enumerate(plan):
+        name = shard_name(run, i)
+        jobs.append((name, dict(run_data, f_read_name=f_shard,
+                                pe_read_name=pe_shard),
+                     bcs, templates, 'ngs_%s_%s.log' % (timestr, name),
+                     dict(filter_kwargs, expts=expts, save_intermediates=True,
+                          log_metrics=log_metrics, output_format='store')))
+    text_logger.info('Filtering run %s as %i shards on %i processes', run,
+                     len(jobs), run_processes)
+
+    if run_processes == 1:
+        results = [_filter_run_worker(job) for job in jobs]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(run_processes) as executor:
+            results = list(executor.map(_filter_run_worker, jobs))
+    names = [result[0] for result in results]
+    for name, _, _, _, tb in results:
+        if tb is not None:
+            _remove_shard_outputs(names, expts)
+            raise RuntimeError('Shard %s of run %s failed:\n%s'
+                               % (name, run, tb))
+
+    for row in merge_csv_rows([result[1] for result in results]):
+        csv_logger.info(row)
+    for result in results:
+        for row in result[2]:
+            metrics_logger.info(row)
+    counts = merge_shard_outputs(run, names, expts, bcs, templates,
+                                 output_format, save=save_intermediates,
+                                 collapse=filter_kwargs.get('collapse', False),
+                                 misinc=misinc)
+    text_logger.info('Merged %i shards of run %s', len(names), run)
+    return counts
+
+
+def _warn_shard_costs(plan, shards):
+    """
+    Log a warning if plan has fewer than the shards asked for, or has shards
+    that have to read more than their own part of the input (see
+    plan_shards).
+    """
+    text_logger = logging.getLogger(__name__+'.text_logger')
+    if len(plan) < shards:
+        text_logger.warning('%s is too short for %i shards at its index '
+                             'interval, so it is split into %i.',
+                             plan[0][0].path, shards, len(plan))
+    if len(plan) < 2:
+        return
+    for shard in plan[0]:
+        if shard.stop is None: # The whole file, for mates found by index
+            text_logger.warning('Without lockstep, each of %i shards reads '
+                                'and indexes all of %s.', len(plan),
+                                shard.path)
+        elif shard.fmt == 'gzip':
+            text_logger.warning('%s is gzipped but not BGZF, so each of %i '
+                                'shards decompresses it from the start up to '
+                                'its own records.', shard.path, len(plan))
+
+
+def write_shard_manifest(yf_name, run, shards, fpath=None,
+                         output_format='fasta', interval=INDEX_INTERVAL,
+                         **filter_kwargs):
+    """
+    Plan shards for one run in a YAML file and describe them in a JSON
+    manifest (by default <run>.shards.json), so each shard can be filtered
+    separately with run_shard, for instance on different machines sharing
+    a working directory, and then merged with merge_shards. Shards start on
+    every interval-th read (see plan_shards). Keyword arguments are passed
+    on to filter_run, so must be JSON-serializable.
+
+    Returns the path to the manifest.
+    """
+    with open(yf_name) as expt_f:
+        expt_yaml = yaml.load(expt_f)
+    run_data = expt_yaml['ngsruns'][run]
+    bcs, templates = get_run_settings(expt_yaml, run)
+    aln_output_names(run, '', output_format) # Check it early
+    if fpath is None:
+        fpath = '%s.shards.json' % run
+    plan = plan_shards(run_data['f_read_name'], run_data['pe_read_name'],
+                       shards, lockstep=filter_kwargs.get('lockstep', False),
+                       interval=interval)
+    _warn_shard_costs(plan, shards)
+    save_shard_manifest(fpath, run, run_data, bcs, templates, plan,
+                        filter_kwargs=dict(filter_kwargs,
+                                           output_format=output_format))
+    return fpath
+
+
+def run_shard(manifest_path, index):
+    """
+    Filter shard number index from a manifest written by
+    write_shard_manifest, logging to ngs_<time>_<run>.shard<i>.log. The
+    aligned sequences go to a store, and the csv (and metrics) logger rows
+    to <run>.shard<i>.csv (and .jsonl), for merge_shards.
+    """
+    manifest = load_shard_manifest(manifest_path)
+    shard = manifest['shards'][index]
+    run_kwargs = dict(manifest['filter_kwargs'], expts=manifest['expts'],
+                      save_intermediates=True, output_format='store',
+                      misinc=False)
+    run_data = dict(manifest['run_data'], f_read_name=shard['f_read'],
+                    pe_read_name=shard['pe_read'])
+    log_name = 'ngs_%s_%s.log' % (time.strftime("%Y%m%d-%H%M%S"),
+                                  shard['name'])
+    _, rows, m_rows, _, tb = _filter_run_worker((shard['name'], run_data,
+                                                 manifest['bcs'],
+                                                 manifest['templates'],
+                                                 log_name, run_kwargs))
+    if tb is not None:
+        raise RuntimeError('Shard %s failed:\n%s' % (shard['name'], tb))
+    with atomic_open(shard['name'] + '.csv') as f:
+        f.write(''.join(row + '\n' for row in rows))
+    if m_rows:
+        with atomic_open(shard['name'] + '.jsonl') as f:
+            f.write(''.join(row + '\n' for row in m_rows))
+
+
+def merge_shards(manifest_path, save_intermediates=True):
+    """
+    Merge the outputs of every shard in a manifest (see run_shard) into the
+    run's aln_seqs_<run>_<expt> outputs, and send the summed counts to the
+    csv logger. Returns a dict of the number of sequences for each
+    experiment.
+    """
+    csv_logger = logging.getLogger(__name__+'.csv_logger')
+    metrics_logger = logging.getLogger(__name__+'.metrics_logger')
+    manifest = load_shard_manifest(manifest_path)
+    names = [shard['name'] for shard in manifest['shards']]
+    row_lists = []
+    for name in names:
+        with open(name + '.csv') as f:
+            row_lists.append(f.read().splitlines())
+    for row in merge_csv_rows(row_lists):
+        csv_logger.info(row)
+    for name in names:
+        if os.path.exists(name + '.jsonl'):
+            with open(name + '.jsonl') as f:
+                for row in f.read().splitlines():
+                    metrics_logger.info(row)
+
+    filter_kwargs = manifest['filter_kwargs']
+    counts = merge_shard_outputs(manifest['run'], names, manifest['expts'],
+                                 manifest['bcs'], manifest['templates'],
+                                 filter_kwargs.get('output_format', 'fasta'),
+                                 save=save_intermediates,
+                                 collapse=filter_kwargs.get('collapse', False),
+                                 misinc=filter_kwargs.get('misinc', False))
+    for name in names:
+        for suffix in ('.csv', '.jsonl'):
+            if os.path.exists(name + suffix):
+                os.remove(name + suffix)
+    return counts
+
+
+def merge_shard_outputs(run, names, expts, bcs, templates,
+                        output_format='fasta', save=True, collapse=False,
+                        misinc=False):
+    """
+    Concatenate the aligned sequence stores of the shards names, in order,
+    into the outputs for run, then remove them. If save is False, no
+    aligned sequences are written. If misinc is True, each experiment's
+    misincorporation table is counted from the stores and saved. Returns a
+    dict of the number of sequences for each experiment.
+    """
+    accs = _misinc_accumulators(expts, templates) if misinc else {}
+    counts = {}
+    for expt in expts:
+        stores = [aln_output_names(name, expt, 'store')[0] for name in names]
+        counts[expt] = 0
+        with contextlib.ExitStack() as stack:
+            write = None
+            if save:
+                write = stack.enter_context(
+                    aln_output_writer(run, expt, output_format,
+                                      counts=collapse,
+                                      meta=_store_meta(run, expt, bcs,
+                                                       templates)))
+            for store_name in stores:
+                reads = load_store(store_name)
+                counts[expt] += len(reads)
+                if misinc:
+                    accs[expt].add(reads)
+                if write is not None:
+                    for batch in _stored_records(reads):
+                        write(batch)
+    _save_misincs(run, accs)
+    _remove_shard_outputs(names, expts)
+    return counts
+
+
+def _stored_records(reads, batch_size=10000):
+    """
+    Yield lists of SeqRecords, like those made by aligned_record, from
+    AlignedReads.
+    """
+    ids = reads.ids()
+    batch = []
+    for i, seq in enumerate(reads.iter_strings()):
+        annotations = {'alnscore': float(reads.scores[i])}
+        if reads.counts is not None:
+            annotations['count'] = int(reads.counts[i])
+        seq_id = ids[i].split(' ')[0]
+        batch.append(SeqRecord(Seq(seq), id=seq_id, name=seq_id,
+                               description=ids[i], annotations=annotations))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _remove_shard_outputs(names, expts):
+    for name in names:
+        for expt in expts:
+            for fname in aln_output_names(name, expt, 'store'):
+                if os.path.exists(fname):
+                    os.remove(fname)
+
+
+def stream_run(run, run_data, bcs, templates, save_intermediates=True,
+               expts=None, output_format='fasta', misinc=False,
+               **filter_kwargs):
+    """
+    Filter one run from the YAML file with iter_filter_sample, appending each
+    batch of aligned sequences to aln_seqs_<run>_<expt>.fa (and/or .alnstore,
+    see filter_run) as it arrives. If misinc is True, each batch is also
+    added to the experiment's misincorporation counts.
+
+    Each file is written under a temporary name and only moved into place
+    once the whole run has been filtered. Returns a dict of the number of
+    sequences written for each experiment.
+    """
+    if expts is None:
+        expts = list(bcs.keys())
+    counts = {expt: 0 for expt in expts}
+    accs = _misinc_accumulators(expts, templates) if misinc else {}
+    with contextlib.ExitStack() as stack:
+        writers = {}
         if save_intermediates:
-            for expt in aln_seqs.keys():
-                with open('aln_seqs_%s_%s.fa' % (run, expt), 'w') as out_f:
-                    SeqIO.write(aln_seqs[expt], out_f, 'fasta')
-        text_logger.info('Finished filtering for run %s', run)
+            writers = {expt: stack.enter_context(
+                           aln_output_writer(run, expt, output_format,
+                                             counts=filter_kwargs.get(
+                                                 'collapse', False),
+                                             meta=_store_meta(run, expt, bcs,
+                                                              templates)))
+                       for expt in expts}
+        for expt, seqs in iter_filter_sample(run_data['f_read_name'],
+                                             run_data['pe_read_name'],
+                                             bcs, templates,
+                                             run_data['filter_seqs']['forward'],
+                                             run_data['filter_seqs']['reverse'],
+                                             expts=expts, **filter_kwargs):
+            counts[expt] += len(seqs)
+            if save_intermediates:
+                writers[expt](seqs)
+            if misinc:
+                accs[expt].add(seqs)
+    _save_misincs(run, accs)
+    return counts
+
+
+def _store_meta(run, expt, bcs, templates):
+    return {'run': run, 'expt': expt, 'barcode': bcs[expt],
+            'template_seq': templates[expt]}
+
+def _misinc_accumulators(expts, templates):
+    # Imported here, as nextgen4b.analyze.analyze imports this module
+    from ..analyze.analyze import MisincAccumulator
+    return {expt: MisincAccumulator(templates[expt]) for expt in expts}
+
+def _save_misincs(run, accs):
+    for expt, acc in accs.items():
+        acc.save(misinc_output_name(run, expt))
 
 if __name__ == '__main__':
     if len(sys.argv) > 1:
@@ -0,0 +1,133 @@
+"""
+nextgen4b.process.manifest
+
+A checkpoint manifest for run_all_experiments. For each (run, experiment),
+the manifest records a fingerprint of everything the aligned output depends
+on: the input FASTQ files, the relevant YAML fields and the filter
+parameters. Outputs whose fingerprint has not changed can be skipped when
+filtering is re-run.
+"""
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+
+__all__ = ['Manifest', 'fingerprint_file', 'expt_fingerprint', 'atomic_open']
+
+# Filter keyword arguments that change how fast filtering runs, but not what
+# it outputs, so are left out of fingerprints.
+_NON_RESULT_KWARGS = frozenset(['batch_size', 'cache', 'chunk_size',
+                                'cleanup', 'compact', 'lockstep',
+                                'log_metrics', 'metrics', 'processes',
+                                'save_intermediates', 'stream', 'threaded'])
+
+
+def fingerprint_file(fpath, block_size=1 << 20):
+    """
+    Fingerprint a file by its size, modification time and a hash of its
+    first and last block_size bytes. This is cheap even for large files,
+    and catches replaced, truncated and appended-to files. Returns None if
+    fpath does not exist.
+    """
+    if not os.path.exists(fpath):
+        return None
+    stat = os.stat(fpath)
+    sha = hashlib.sha1()
+    with open(fpath, 'rb') as f:
+        sha.update(f.read(block_size))
+        if stat.st_size > block_size:
+            f.seek(max(stat.st_size - block_size, block_size))
+            sha.update(f.read(block_size))
+    return {'size': stat.st_size,
+            'mtime': int(stat.st_mtime),
+            'sha1': sha.hexdigest()}
+
+
+def expt_fingerprint(run_data, expt, bcs, templates, filter_kwargs):
+    """
+    Fingerprint the output of one experiment in a run. bcs and templates
+    hold every experiment in the run, since the other barcodes take part in
+    demultiplexing.
+
+    Returns a (key, details) tuple, where key is a hash of details.
+    """
+    params = {k: repr(v) for k, v in filter_kwargs.items()
+              if k not in _NON_RESULT_KWARGS}
+    details = {'f_read': fingerprint_file(run_data['f_read_name']),
+               'pe_read': fingerprint_file(run_data['pe_read_name']),
+               'f_read_name': run_data['f_read_name'],
+               'pe_read_name': run_data['pe_read_name'],
+               'filter_seqs': run_data['filter_seqs'],
+               'barcode': bcs[expt],
+               'template_seq': templates[expt],
+               'run_barcodes': sorted(bcs.values()),
+               'params': params}
+    key = hashlib.sha1(json.dumps(details, sort_keys=True)
+                       .encode('utf-8')).hexdigest()
+    return key, details
+
+
+@contextlib.contextmanager
+def atomic_open(fpath, mode='w'):
+    """
+    Open a temporary file next to fpath for writing, and move it to fpath
+    only once the with block exits without an error, so a partially written
+    file never appears under fpath.
+    """
+    fd, tmp_path = tempfile.mkstemp(prefix='.%s.' % os.path.basename(fpath),
+                                    suffix='.tmp',
+                                    dir=os.path.dirname(fpath) or '.')
+    try:
+        # mkstemp makes the file private; give it the usual permissions
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0o666 & ~umask)
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.replace(tmp_path, fpath)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class Manifest(object):
+    """
+    A JSON file of finished outputs, indexed by run then experiment. Each
+    entry holds the output paths, its fingerprint key and details, and the
+    number of sequences written.
+    """
+
+    def __init__(self, path='ngs_manifest.json'):
+        self.path = path
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+        else:
+            self.entries = {}
+
+    def is_current(self, run, expt, key):
+        """
+        True if the outputs for (run, expt) were made from inputs with this
+        fingerprint key, and are still on disk.
+        """
+        entry = self.entries.get(run, {}).get(expt)
+        return (entry is not None and entry['key'] == key
+                and all(os.path.exists(f) for f in entry['outputs']))
+
+    def record(self, run, expt, key, details, outputs, n_seqs=None):
+        """
+        Mark the outputs (a list of paths) for (run, expt) as up to date.
+        """
+        self.entries.setdefault(run, {})[expt] = {'key': key,
+                                                  'details': details,
+                                                  'outputs': outputs,
+                                                  'n_seqs': n_seqs}
+
+    def save(self):
+        """
+        Atomically write the manifest to disk.
+        """
+        with atomic_open(self.path) as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
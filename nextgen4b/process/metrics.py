@@ -0,0 +1,243 @@
+"""
+nextgen4b.process.metrics
+
+Per-stage performance metrics for the filter pipeline. For each stage of
+each run and experiment, PipelineMetrics records the wall and CPU time
+spent, the reads in and out, the bytes read and the peak memory use of
+the process so far, and writes them out as JSON lines.
+"""
+import collections
+import contextlib
+import json
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+
+__all__ = ['PipelineMetrics', 'NullMetrics', 'StageMetrics', 'peak_rss_mb']
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory of this process so far, in MB, or None if it
+    cannot be found on this platform.
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss / 2.**20 # bytes
+    return rss / 2.**10 # kB
+
+
+def file_size(fpath):
+    """
+    Size of fpath in bytes, or 0 if it does not exist or is not a path
+    (a Shard, say).
+    """
+    try:
+        return os.path.getsize(fpath)
+    except (OSError, TypeError):
+        return 0
+
+
+class StageMetrics(object):
+    """
+    Totals for one stage. Times are exclusive: time spent in a nested stage
+    (say, reading a file while a lazy filter pulls reads from it) is
+    counted only against the nested stage.
+
+    start() and stop() bracket each piece of work, and are cheap enough to
+    call once per read.
+
+    process_peak_rss_mb is the peak memory use of the whole process by the
+    end of the stage, not of the stage alone: it never goes down, so a
+    stage after a memory-hungry one reports that stage's peak too.
+    """
+
+    def __init__(self, run, expt, stage, stack):
+        self.run = run
+        self.expt = expt
+        self.stage = stage
+        self.wall_s = 0.
+        self.cpu_s = 0.
+        self.reads_in = 0
+        self.reads_out = 0
+        self.bytes_in = 0
+        self.process_peak_rss_mb = None
+        self._stack = stack # Shared by every stage in the pipeline
+
+    def start(self):
+        self._stack.append([time.perf_counter(), time.process_time(), 0., 0.])
+
+    def stop(self, reads_in=0, reads_out=0):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        wall0, cpu0, child_wall, child_cpu = self._stack.pop()
+        wall -= wall0
+        cpu -= cpu0
+        self.wall_s += wall - child_wall
+        self.cpu_s += cpu - child_cpu
+        self.reads_in += reads_in
+        self.reads_out += reads_out
+        if self._stack:
+            self._stack[-1][2] += wall
+            self._stack[-1][3] += cpu
+
+    def count(self, reads_in, reads_out):
+        self.reads_in += reads_in
+        self.reads_out += reads_out
+
+    def sample_rss(self):
+        rss = peak_rss_mb()
+        if rss is not None:
+            self.process_peak_rss_mb = max(rss,
+                                           self.process_peak_rss_mb or 0.)
+
+    def as_dict(self):
+        return {'run': self.run,
+                'expt': self.expt,
+                'stage': self.stage,
+                'wall_s': round(self.wall_s, 6),
+                'cpu_s': round(self.cpu_s, 6),
+                'reads_in': self.reads_in,
+                'reads_out': self.reads_out,
+                'reads_per_s': (round(self.reads_in / self.wall_s, 1)
+                                if self.wall_s > 0 else None),
+                'bytes_in': self.bytes_in,
+                'process_peak_rss_mb': (
+                    round(self.process_peak_rss_mb, 1)
+                    if self.process_peak_rss_mb is not None else None)}
+
+
+class PipelineMetrics(object):
+    """
+    Collects StageMetrics for a run, indexed by (experiment, stage name).
+    Stages that come before demultiplexing have experiment None.
+
+    Timings cover this process only, so the CPU time and memory of any
+    alignment worker processes are not included.
+    """
+
+    def __init__(self, run=None, expt=None, _stages=None, _stack=None):
+        self.run = run
+        self.expt = expt
+        self._stages = (collections.OrderedDict() if _stages is None
+                        else _stages)
+        self._stack = [] if _stack is None else _stack
+
+    def for_expt(self, expt):
+        """
+        A view of these metrics whose stages are recorded against expt.
+        """
+        return PipelineMetrics(self.run, expt, self._stages, self._stack)
+
+    def stage(self, name):
+        key = (self.expt, name)
+        if key not in self._stages:
+            self._stages[key] = StageMetrics(self.run, self.expt, name,
+                                             self._stack)
+        return self._stages[key]
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        """
+        Time the body of a with block against stage name. The stage is
+        yielded so that read counts can be added to it.
+        """
+        stage = self.stage(name)
+        stage.start()
+        try:
+            yield stage
+        finally:
+            stage.stop()
+            stage.sample_rss()
+
+    def timed_iter(self, iterable, name):
+        """
+        Pass through the items of iterable, timing each step against stage
+        name and counting each item as one read in and out.
+        """
+        stage = self.stage(name)
+        it = iter(iterable)
+        while True:
+            stage.start()
+            try:
+                item = next(it)
+            except StopIteration:
+                stage.stop()
+                break
+            except BaseException:
+                stage.stop()
+                raise
+            stage.stop(1, 1)
+            yield item
+        stage.sample_rss()
+
+    def records(self):
+        """
+        Return a list of dicts, one per stage, in the order the stages were
+        first seen.
+        """
+        return [stage.as_dict() for stage in self._stages.values()]
+
+    def emit(self, logger):
+        """
+        Write one JSON line per stage to logger.
+        """
+        timestamp = time.strftime('%Y-%m-%dT%H:%M:%S')
+        for stage in self._stages.values():
+            if stage.process_peak_rss_mb is None:
+                stage.sample_rss()
+            logger.info(json.dumps(dict(stage.as_dict(), time=timestamp),
+                                   sort_keys=True))
+
+
+class _NullStage(object):
+    """
+    Stand-in for StageMetrics that records nothing.
+    """
+    reads_in = reads_out = bytes_in = 0
+
+    def start(self):
+        pass
+
+    def stop(self, reads_in=0, reads_out=0):
+        pass
+
+    def count(self, reads_in, reads_out):
+        pass
+
+    def __setattr__(self, name, value):
+        pass
+
+
+class NullMetrics(object):
+    """
+    Stand-in for PipelineMetrics that records nothing, used when metrics
+    are turned off.
+    """
+    _stage = _NullStage()
+
+    def for_expt(self, expt):
+        return self
+
+    def stage(self, name):
+        return self._stage
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        yield self._stage
+
+    def timed_iter(self, iterable, name):
+        return iterable
+
+    def records(self):
+        return []
+
+    def emit(self, logger):
+        pass
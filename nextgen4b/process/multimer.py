@@ -9,18 +9,79 @@ incidence of nucleotides at each of the count sites.
 """
 
 from Bio import SeqIO, Seq, SeqRecord
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
-import sys, os, argparse
+import sys, os, argparse, json
+import concurrent.futures
+
+from .manifest import atomic_open
+from .store import STORE_SUFFIX, AlignedReads, is_store, load
     
+def extract_motif_matrices(reads, mot_idxs, ct_idxs, bad_chars=['A','-']):
+    """
+    Extract motif and count site letters from AlignedReads (see
+    nextgen4b.process.store) as arrays.
+
+    Returns (mot_words, nt_words, weights): uint8 arrays of the motif and
+    count site letters of each read whose motif has none of bad_chars in
+    it, and the number of reads each row stands for. Reads too short to
+    reach every site (rows padded with zeros by load_reads) are skipped.
+    """
+    mot_idxs = np.asarray(mot_idxs, dtype=np.intp)
+    ct_idxs = np.asarray(ct_idxs, dtype=np.intp)
+    max_idx = max(mot_idxs.max(), ct_idxs.max())
+    if reads.width <= max_idx:
+        return (np.zeros((0, len(mot_idxs)), dtype=np.uint8),
+                np.zeros((0, len(ct_idxs)), dtype=np.uint8),
+                np.zeros(0, dtype=np.int64))
+
+    mot_words = np.asarray(reads.seqs[:, mot_idxs])
+    keep = np.asarray(reads.seqs[:, max_idx]) != 0
+    for c in bad_chars:
+        if len(c) == 1:
+            keep &= ~(mot_words == ord(c)).any(axis=1)
+        else: # Substrings; rare, so done the slow way
+            keep &= np.array([c not in m for m in
+                              _decode_rows(mot_words)], dtype=bool)
+    return (mot_words[keep], np.asarray(reads.seqs[:, ct_idxs])[keep],
+            reads.weights()[keep].astype(np.int64))
+
+def load_reads(f_name):
+    """
+    Load an aligned read store, or a .fasta file whose reads may differ in
+    length. Shorter FASTA reads are padded with zeros to the longest.
+    """
+    if is_store(f_name):
+        return load(f_name)
+    rows = [str(s.seq).encode('ascii') for s in SeqIO.parse(f_name, 'fasta')]
+    width = max([len(row) for row in rows] + [0])
+    seqs = np.zeros((len(rows), width), dtype=np.uint8)
+    for i, row in enumerate(rows):
+        seqs[i, :len(row)] = np.frombuffer(row, dtype=np.uint8)
+    return AlignedReads(seqs, np.full(len(rows), np.nan, dtype=np.float32))
+
+def _decode_rows(words, weights=None):
+    """
+    List of the rows of a uint8 letter array as strings, each repeated by
+    its weight if weights are given.
+    """
+    if weights is not None:
+        words = np.repeat(words, weights, axis=0)
+    n, k = words.shape
+    if k == 0:
+        return [''] * n
+    text = np.ascontiguousarray(words).tobytes().decode('ascii')
+    return [text[i:i+k] for i in range(0, len(text), k)]
+
 def extract_motifs_and_bases(f_name, mot_idxs, ct_idxs, bad_chars=['A','-']):
     """
-    Open a .fasta file, extract a given set of bases as a motif 
-    and a given set of bases as counted nts.
+    Open a .fasta file (or aligned read store), extract a given set of bases
+    as a motif and a given set of bases as counted nts.
     
     Arguments:
-    f_name          -- The name of the .fasta file to process
+    f_name          -- The name of the .fasta or .alnstore file to process
     mot_idxs        -- The 0-indexed indices of the letters that make up a 
                         motif, in order
     ct_idxs         -- The 0-indexed indices of the letters to be counted 
@@ -29,51 +90,249 @@ def extract_motifs_and_bases(f_name, mot_idxs, ct_idxs, bad_chars=['A','-']):
     Keywords:
     bad_chars       -- Discard motifs that include these characters
     """
-    
-    seqs = SeqIO.parse(f_name, 'fasta')
-    mot = []
-    nts = []
-    max_idx = max(max(mot_idxs), max(ct_idxs))
-     
-    for s in seqs:
-        # construct motif for each sequence
-        if len(s) > max_idx:
-            m = ''.join([s[idx] for idx in mot_idxs])
-            
-            # if it's acceptable, record the motif and count sites
-            if all([c not in m for c in bad_chars]):
-                mot.append(m)
-                nts.append([s[idx] for idx in ct_idxs])
-                
+    mot_words, nt_words, weights = extract_motif_matrices(
+        load_reads(f_name), mot_idxs, ct_idxs, bad_chars=bad_chars)
+    mot = _decode_rows(mot_words, weights)
+    nts = [list(n) for n in _decode_rows(nt_words, weights)]
     return mot, nts
 
+############
+# Accumulating Counts
+############
+
+class MotifAccumulator(object):
+    """
+    Running counts of the letters at each count site for each motif, which
+    can be fed reads a batch at a time, saved to and loaded from a
+    compressed .npz file, and merged with other accumulators for the same
+    sites. Merging is associative, so files or shards can be counted
+    separately (on a process pool, or different machines) and reduced into
+    one table.
+    """
+
+    def __init__(self, mot_idxs, ct_idxs, bad_chars=['A','-'],
+                 letter_order=['C','G','T','A']):
+        self.mot_idxs = list(mot_idxs)
+        self.ct_idxs = list(ct_idxs)
+        self.bad_chars = list(bad_chars)
+        self.letter_order = list(letter_order)
+        self.motifs = []
+        self.totals = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros((0, len(self.ct_idxs), len(self.letter_order)),
+                               dtype=np.int64)
+
+    @property
+    def n_reads(self):
+        return int(self.totals.sum())
+
+    def add(self, mot_words, nt_words, weights=None):
+        """
+        Add reads, as arrays from extract_motif_matrices.
+        """
+        motifs, totals, counts = count_motif_sites(
+            mot_words, nt_words, weights, letter_order=self.letter_order)
+        self._add_table(motifs, totals, counts)
+
+    def add_reads(self, reads, batch_size=1000000):
+        """
+        Add AlignedReads, batch_size reads at a time.
+        """
+        for start in range(0, len(reads), batch_size):
+            stop = start + batch_size
+            batch = AlignedReads(reads.seqs[start:stop],
+                                 reads.scores[start:stop],
+                                 None if reads.counts is None
+                                 else reads.counts[start:stop])
+            self.add(*extract_motif_matrices(batch, self.mot_idxs,
+                                             self.ct_idxs, self.bad_chars))
+
+    def add_file(self, f_name):
+        """
+        Add the reads in a .fasta file or aligned read store.
+        """
+        self.add_reads(load_reads(f_name))
+
+    def merge(self, other):
+        """
+        Add the counts from another accumulator for the same sites to this
+        one, and return this one.
+        """
+        if self._params() != other._params():
+            raise ValueError('Cannot merge motif counts for different sites '
+                             '(%s vs %s).' % (self._params(), other._params()))
+        self._add_table(other.motifs, other.totals, other.counts)
+        return self
+
+    def _add_table(self, motifs, totals, counts):
+        if not len(motifs):
+            return
+        if not len(self.motifs):
+            self.motifs = list(motifs)
+            self.totals = np.array(totals, dtype=np.int64)
+            self.counts = np.array(counts, dtype=np.int64)
+            return
+        all_motifs = np.array(self.motifs + list(motifs), dtype=object)
+        unique, inverse = np.unique(all_motifs, return_inverse=True)
+        new_totals = np.zeros(len(unique), dtype=np.int64)
+        np.add.at(new_totals, inverse,
+                  np.concatenate([self.totals, totals]))
+        new_counts = np.zeros((len(unique),) + self.counts.shape[1:],
+                              dtype=np.int64)
+        np.add.at(new_counts, inverse,
+                  np.concatenate([self.counts, counts]))
+        self.motifs = list(unique)
+        self.totals = new_totals
+        self.counts = new_counts
+
+    def _params(self):
+        return {'mot_idxs': self.mot_idxs, 'ct_idxs': self.ct_idxs,
+                'bad_chars': self.bad_chars,
+                'letter_order': self.letter_order}
+
+    def to_df(self):
+        """
+        The counts as a dataframe, laid out as by gen_mot_counts_df.
+        """
+        return motif_counts_df(self.motifs, self.totals, self.counts,
+                               self.ct_idxs, letter_order=self.letter_order)
+
+    def save(self, fpath):
+        """
+        Write the counts to a compressed .npz file.
+        """
+        with atomic_open(fpath, 'wb') as f:
+            np.savez_compressed(f, params=json.dumps(self._params()),
+                                motifs=np.array(self.motifs, dtype=np.str_),
+                                totals=self.totals, counts=self.counts)
+
+    @classmethod
+    def load(cls, fpath):
+        with np.load(fpath) as data:
+            acc = cls(**json.loads(str(data['params'])))
+            acc.motifs = [str(m) for m in data['motifs']]
+            acc.totals = data['totals'].astype(np.int64)
+            acc.counts = data['counts'].astype(np.int64)
+        return acc
+
+
+def merge_accumulators(accs):
+    """
+    Reduce a list of MotifAccumulators (or paths to saved ones) into a new
+    one, leaving those passed in unchanged. Returns None for an empty list.
+    """
+    total = None
+    for acc in accs:
+        if not isinstance(acc, MotifAccumulator):
+            acc = MotifAccumulator.load(acc)
+        if total is None:
+            total = MotifAccumulator(**acc._params())
+        total.merge(acc)
+    return total
+
 ############
 # Output Generators
 ############
 
+def encode_words(words):
+    """
+    Turn a list of strings into an (n, length) uint8 array of ASCII codes.
+    Strings shorter than the longest are padded with zeros, which drop off
+    again when rows are viewed as bytes (as count_motif_sites does).
+    """
+    if not len(words):
+        return np.zeros((0, 0), dtype=np.uint8)
+    length = max(len(w) for w in words)
+    if all(len(w) == length for w in words):
+        return np.frombuffer(''.join(words).encode('ascii'),
+                             dtype=np.uint8).reshape(len(words), length)
+    mat = np.zeros((len(words), length), dtype=np.uint8)
+    for i, w in enumerate(words):
+        mat[i, :len(w)] = np.frombuffer(w.encode('ascii'), dtype=np.uint8)
+    return mat
+
+def count_motif_sites(mot_words, nt_words, weights=None,
+                      letter_order=['C','G','T','A']):
+    """
+    Count the letters at each count site for each distinct motif.
+
+    Inputs:
+    - mot_words: (n, motif length) uint8 array of motif letters
+    - nt_words: (n, number of count sites) uint8 array of counted letters
+    - weights: number of reads each row stands for (default all ones)
+
+    Returns (motifs, totals, counts): the sorted distinct motifs (strings),
+    the number of reads with each, and an int64 array of shape
+    (motifs, count sites, letters) of the number of reads with each letter
+    in letter_order at each site. Letters not in letter_order are not
+    counted.
+    """
+    n = mot_words.shape[0]
+    n_sites = nt_words.shape[1] if nt_words.ndim == 2 else 0
+    n_letters = len(letter_order)
+    if weights is None:
+        weights = np.ones(n, dtype=np.int64)
+    if n == 0:
+        return ([], np.zeros(0, dtype=np.int64),
+                np.zeros((0, n_sites, n_letters), dtype=np.int64))
+
+    if mot_words.shape[1]:
+        keys = np.ascontiguousarray(mot_words).view(
+            'S%i' % mot_words.shape[1]).ravel()
+        unique, mot_ids = np.unique(keys, return_inverse=True)
+        motifs = [u.decode('ascii') for u in unique]
+    else:
+        motifs = ['']
+        mot_ids = np.zeros(n, dtype=np.intp)
+    n_mots = len(motifs)
+    totals = np.bincount(mot_ids, weights=weights,
+                         minlength=n_mots).astype(np.int64)
+
+    # Letter codes 0..n_letters-1, and n_letters for anything else
+    lookup = np.full(256, n_letters, dtype=np.intp)
+    for i, letter in enumerate(letter_order):
+        lookup[ord(letter)] = i
+    codes = lookup[nt_words]
+    bins = ((mot_ids[:, None] * n_sites + np.arange(n_sites)) * (n_letters + 1)
+            + codes)
+    counts = np.bincount(bins.ravel(),
+                         weights=np.repeat(weights, n_sites),
+                         minlength=n_mots * n_sites * (n_letters + 1))
+    counts = counts.reshape(n_mots, n_sites, n_letters + 1)[:, :, :n_letters]
+    return motifs, totals, counts.astype(np.int64)
+
+def motif_counts_df(motifs, totals, counts, ct_idxs,
+                    letter_order=['C','G','T','A']):
+    """
+    Lay out the output of count_motif_sites as a dataframe, as
+    gen_mot_counts_df does.
+    """
+    df = pd.DataFrame({'motif': motifs, 'total': totals})
+    for i, c_idx in enumerate(ct_idxs):
+        for j, letter in enumerate(letter_order):
+            df['%s_%i_counts' % (letter, c_idx)] = counts[:, i, j]
+    return df
+
 def gen_mot_counts_df(mot, nts, ct_idxs, letter_order=['C','G','T','A']):
     """
     Generate dataframe listing number of base incorporations for each motif.
+    Motifs are listed in sorted order.
 
     Inputs:
     - mot: list of motifs present in the sample
     - nts: list of incorporations present in the sample
     - ct_idxs: list of sites where the bases in `nts` were taken from
     """
-    unique_mots = list(set(mot))
-    mot_cts = [mot.count(m) for m in unique_mots]
-    
-    # Build df
-    df = pd.DataFrame({'motif': unique_mots, 'total': mot_cts})
-    for i, c_idx in enumerate(ct_idxs):
-        site_letters = [l[i] for l in nts] # Letters at each site
-        for letter in letter_order:
-            # Get desired letter count for each motif
-            site_mot_ct = [[site_letters[i] for i in range(len(mot))
-                            if mot[i] == m].count(letter) for m in unique_mots]
-            df['%s_%i_counts' % (letter, c_idx)] = site_mot_ct
-    
-    return df
+    if any(len(n) != len(ct_idxs) for n in nts):
+        raise ValueError('Every entry of nts must have one letter for each '
+                         'of the %i count sites.' % len(ct_idxs))
+    mot_words = encode_words(mot)
+    nt_words = encode_words([''.join(n) for n in nts])
+    if not len(mot):
+        nt_words = nt_words.reshape(0, len(ct_idxs))
+    motifs, totals, counts = count_motif_sites(mot_words, nt_words,
+                                               letter_order=letter_order)
+    return motif_counts_df(motifs, totals, counts, ct_idxs,
+                           letter_order=letter_order)
     
 def gen_mot_lists(mot, nts, site_idx=0,
                   set1=['C', 'G', 'T'], set2=['A']):
@@ -92,28 +351,23 @@ def gen_mot_lists(mot, nts, site_idx=0,
 # File Generators
 ############
 
-def output_motif_lists(fname, mot_idxs, ct_idxs, bad_chars=['A','-'],
-                       reverse_comp_motifs=False, pad='AA'):
-    mot, nts = extract_motifs_and_bases(fname, mot_idxs, ct_idxs,
-                                        bad_chars=bad_chars)
+OUTMODES = ['meme', 'counts', 'csv']
+ACC_SUFFIX = '.motacc.npz'
+
+def _out_base(fname):
+    return ''.join(fname.split('.')[:-1])
+
+def _write_motif_lists(fname, mot, nts, pad='AA'):
     l1, l2 = gen_mot_lists(mot, nts, site_idx=0)
-    n1, n2 = [''.join(f.split('.')[:-1]) + s for s in ['_set1.fasta', '_set2.fasta']]
+    n1, n2 = [_out_base(fname) + s for s in ['_set1.fasta', '_set2.fasta']]
     
     SeqIO.write([SeqRecord.SeqRecord(Seq.Seq(pad + s), id=str(i),
                  description='') for i, s in  enumerate(l1)], n1, 'fasta')
     SeqIO.write([SeqRecord.SeqRecord(Seq.Seq(pad + s), id=str(i),
                  description='') for i, s in  enumerate(l2)], n2, 'fasta')
-    
-def output_motif_counts(fname, mot_idxs, ct_idxs, bad_chars=['A','-']):
-    mot, nts = extract_motifs_and_bases(fname, mot_idxs, ct_idxs,
-                                        bad_chars=bad_chars)
-    df = gen_mot_counts_df(mot, nts, ct_idxs)
-    df.to_csv(''.join(fname.split('.')[:-1])+'_motifs.csv')
-    
-def output_motif_csv(fname, mot_idxs, ct_idxs, bad_chars=['A','-']):
-    mot, nts = extract_motifs_and_bases(fname, mot_idxs, ct_idxs,
-                                        bad_chars=bad_chars)
-    with open(''.join(fname.split('.')[:-1])+'_mot.csv', 'w') as o_f:
+
+def _write_motif_csv(fname, mot, nts, ct_idxs):
+    with open(_out_base(fname)+'_mot.csv', 'w') as o_f:
         o_f.write(','.join(['motif']+['site_'+str(ct)
                                      for ct in ct_idxs]) + '\n')
         for m, n in zip(mot, nts):
@@ -121,6 +375,79 @@ def output_motif_csv(fname, mot_idxs, ct_idxs, bad_chars=['A','-']):
             for base in n:
                 o_f.write(',%s' % base)
             o_f.write('\n')
+
+def output_motifs(fname, mot_idxs, ct_idxs, outmodes=['counts'],
+                  bad_chars=['A','-'], pad='AA', save_accumulator=False):
+    """
+    Extract motifs from a file once, and write each of the outputs in
+    outmodes from that extraction:
+
+    meme    -- <base>_set1.fasta and <base>_set2.fasta, motif lists for MEME
+    counts  -- <base>_motifs.csv, counts at each site for each motif
+    csv     -- <base>_mot.csv, the motif and count site letters of each read
+
+    If save_accumulator is True, the counts are also saved as
+    <base>.motacc.npz for merging later. Returns the file's
+    MotifAccumulator.
+    """
+    for mode in outmodes:
+        if mode not in OUTMODES:
+            raise ValueError('Unknown output mode %s (must be one of %s).'
+                             % (mode, ', '.join(OUTMODES)))
+    mot_words, nt_words, weights = extract_motif_matrices(
+        load_reads(fname), mot_idxs, ct_idxs, bad_chars=bad_chars)
+    acc = MotifAccumulator(mot_idxs, ct_idxs, bad_chars=bad_chars)
+    acc.add(mot_words, nt_words, weights)
+
+    if 'counts' in outmodes:
+        acc.to_df().to_csv(_out_base(fname)+'_motifs.csv')
+    if 'meme' in outmodes or 'csv' in outmodes:
+        mot = _decode_rows(mot_words, weights)
+        nts = [list(n) for n in _decode_rows(nt_words, weights)]
+        if 'meme' in outmodes:
+            _write_motif_lists(fname, mot, nts, pad=pad)
+        if 'csv' in outmodes:
+            _write_motif_csv(fname, mot, nts, ct_idxs)
+    if save_accumulator:
+        acc.save(_out_base(fname) + ACC_SUFFIX)
+    return acc
+
+def output_motif_lists(fname, mot_idxs, ct_idxs, bad_chars=['A','-'],
+                       reverse_comp_motifs=False, pad='AA'):
+    output_motifs(fname, mot_idxs, ct_idxs, outmodes=['meme'],
+                  bad_chars=bad_chars, pad=pad)
+    
+def output_motif_counts(fname, mot_idxs, ct_idxs, bad_chars=['A','-']):
+    output_motifs(fname, mot_idxs, ct_idxs, outmodes=['counts'],
+                  bad_chars=bad_chars)
+    
+def output_motif_csv(fname, mot_idxs, ct_idxs, bad_chars=['A','-']):
+    output_motifs(fname, mot_idxs, ct_idxs, outmodes=['csv'],
+                  bad_chars=bad_chars)
+
+def output_all_motifs(fnames, mot_idxs, ct_idxs, outmodes=['counts'],
+                      bad_chars=['A','-'], pad='AA', processes=None,
+                      save_accumulators=False):
+    """
+    Run output_motifs on each of fnames, on a pool of processes processes
+    (default: one per CPU; 1 to run in this process), and return the
+    MotifAccumulator of all of them merged.
+    """
+    kwargs = {'outmodes': outmodes, 'bad_chars': bad_chars, 'pad': pad,
+              'save_accumulator': save_accumulators}
+    total = MotifAccumulator(mot_idxs, ct_idxs, bad_chars=bad_chars)
+    if processes == 1 or len(fnames) < 2:
+        for f in tqdm(fnames):
+            total.merge(output_motifs(f, mot_idxs, ct_idxs, **kwargs))
+        return total
+
+    with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+        futures = [pool.submit(output_motifs, f, mot_idxs, ct_idxs, **kwargs)
+                   for f in fnames]
+        for future in tqdm(concurrent.futures.as_completed(futures),
+                           total=len(futures)):
+            total.merge(future.result())
+    return total
     
 ############
 # Do it.
@@ -134,32 +461,59 @@ def get_all_fnames(directory='.', suffix='.fa'):
                 if os.path.isfile(f) and f.endswith(suffix)]
     return fnames
 
+def get_all_aln_fnames(directory='.', suffix='.fa'):
+    """
+    Find all aligned read files in the given directory: files with the given
+    suffix, plus aligned read stores that have no such file alongside them.
+    """
+    fnames = get_all_fnames(directory, suffix=suffix)
+    for f in get_all_fnames(directory, suffix=STORE_SUFFIX):
+        if f[:-len(STORE_SUFFIX)] + suffix not in fnames:
+            fnames.append(f)
+    return fnames
+
 
 if __name__ == '__main__':
     # Parse stuff
     parser = argparse.ArgumentParser(
         description='Get motifs and errors from all .fa files in directory.')
     parser.add_argument('-M', '--motifsites', nargs='+', type=int, metavar='M',
-                        help='Sites to look for motif bases', required=True)
+                        help='Sites to look for motif bases')
     parser.add_argument('-C', '--countsites', nargs='+', type=int, metavar='C',
-                        help='Sites to count bases at', required=True)
+                        help='Sites to count bases at')
     parser.add_argument('-B', '--badchars', nargs='*', type=str, metavar='B',
                         default=['A', '-'],
                         help='Remove motifs with these characters')
-    parser.add_argument('-O', '--outmode', choices=['meme', 'counts', 'csv'],
-                        default='counts')
+    parser.add_argument('-O', '--outmode', nargs='+', choices=OUTMODES,
+                        default=['counts'],
+                        help='Outputs to write for each file')
+    parser.add_argument('-P', '--processes', type=int, default=None,
+                        help='Files to process at once (default: one per CPU)')
+    parser.add_argument('-S', '--save-accumulators', action='store_true',
+                        help='Also save each file\'s counts as <file>%s'
+                        % ACC_SUFFIX)
+    parser.add_argument('-T', '--total', metavar='NAME',
+                        help='Write counts over all files to NAME_motifs.csv '
+                        'and NAME%s' % ACC_SUFFIX)
+    parser.add_argument('--merge', nargs='+', metavar='ACC',
+                        help='Instead of reading .fa files, merge saved '
+                        'counts (e.g. from other machines) into --total')
     args = parser.parse_args(sys.argv[1:])
     
     # Do work
-    found_files = get_all_fnames(suffix='.fa')
-    
-    for f in tqdm(found_files):
-        if args.outmode == 'meme':
-            output_motif_lists(f, args.motifsites, args.countsites,
-                               bad_chars=args.badchars, pad='AA')
-        if args.outmode == 'counts':
-            output_motif_counts(f, args.motifsites, args.countsites,
-                               bad_chars=args.badchars)
-        if args.outmode == 'csv':
-            output_motif_csv(f, args.motifsites, args.countsites,
-                             bad_chars=args.badchars)
\ No newline at end of file
+    if args.merge:
+        if not args.total:
+            parser.error('--merge needs --total.')
+        total = merge_accumulators(args.merge)
+    else:
+        if not args.motifsites or not args.countsites:
+            parser.error('--motifsites and --countsites are required.')
+        found_files = get_all_aln_fnames(suffix='.fa')
+        total = output_all_motifs(found_files, args.motifsites,
+                                  args.countsites, outmodes=args.outmode,
+                                  bad_chars=args.badchars, pad='AA',
+                                  processes=args.processes,
+                                  save_accumulators=args.save_accumulators)
+    if args.total and total is not None:
+        total.to_df().to_csv(args.total + '_motifs.csv')
+        total.save(args.total + ACC_SUFFIX)
@@ -0,0 +1,293 @@
+"""
+nextgen4b.process.shard
+
+Splitting one run's FASTQ files into record-aligned shards, so a single
+large run can be filtered on several processes (or machines) and the
+results merged afterwards (see filter_run_sharded in
+nextgen4b.process.filter).
+
+A shard is a range of records in one file. To find where a range starts,
+each file gets an index of the offset of every interval-th record: BGZF
+files written by nextgen4b already have one (see nextgen4b.process.bgzf),
+and plain and gzipped files are scanned once, with the index cached next to
+the file in <file>.shardidx.json. BGZF and plain shards are opened by
+seeking straight to their start. A gzip stream cannot be entered part way
+through, so a gzipped shard is found by decompressing (without parsing) up
+to its start; write inputs as BGZF to avoid that.
+"""
+import collections
+import gzip
+import json
+import os
+
+import numpy as np
+
+from .bgzf import BgzfReader, index_path, is_bgzf, read_index
+from .fastq import open_fastq, parse_fastq
+from .manifest import atomic_open, fingerprint_file
+
+__all__ = ['Shard', 'file_format', 'record_index', 'plan_shards',
+           'save_shard_manifest', 'load_shard_manifest', 'merge_csv_rows']
+
+INDEX_INTERVAL = 10000 # Records between offsets in a scanned index
+_INDEX_SUFFIX = '.shardidx.json'
+
+
+def file_format(fpath):
+    """
+    How shards of fpath are read: 'bgzf' for a BGZF file with a record
+    index, 'gzip' for any other gzipped file, or 'plain'.
+    """
+    if is_bgzf(fpath) and os.path.exists(index_path(fpath)):
+        return 'bgzf'
+    if fpath.endswith('.gz'):
+        return 'gzip'
+    return 'plain'
+
+
+class Shard(object):
+    """
+    Records start to stop (exclusive; None for the end of the file) of a
+    FASTQ file. offset is where record first (at or before start) begins:
+    a byte offset into the uncompressed data for plain and gzipped files,
+    or a virtual offset for BGZF files.
+
+    Shards can be passed to load_ngs_file in place of a file name.
+    """
+
+    def __init__(self, path, start=0, stop=None, offset=0, first=0,
+                 fmt=None):
+        self.path = path
+        self.start = start
+        self.stop = stop
+        self.offset = offset
+        self.first = first
+        self.fmt = fmt if fmt is not None else file_format(path)
+
+    def _open(self):
+        if self.fmt == 'bgzf':
+            return BgzfReader(self.path, self.offset)
+        if self.fmt == 'gzip':
+            handle = gzip.open(self.path, 'rb')
+        else:
+            handle = open(self.path, 'rb')
+        handle.seek(self.offset)
+        return handle
+
+    def records(self):
+        """
+        Yield the shard's records as FastqRecords.
+        """
+        i = self.first
+        with self._open() as handle:
+            for record in parse_fastq(handle):
+                if self.stop is not None and i >= self.stop:
+                    break
+                if i >= self.start:
+                    yield record
+                i += 1
+
+    def to_dict(self):
+        return {'path': self.path, 'start': self.start, 'stop': self.stop,
+                'offset': int(self.offset), 'first': self.first,
+                'fmt': self.fmt}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['path'], d['start'], d['stop'], d['offset'], d['first'],
+                   d['fmt'])
+
+    def __str__(self):
+        return '%s[%i:%s]' % (self.path, self.start,
+                              '' if self.stop is None else self.stop)
+
+    def __repr__(self):
+        return 'Shard(%r, %r, %r, %r, %r, %r)' % (self.path, self.start,
+                                                  self.stop, self.offset,
+                                                  self.first, self.fmt)
+
+#####################
+# Record Index
+#####################
+
+def _scan_offsets(fpath, interval):
+    """
+    Read through a plain or gzipped FASTQ file, returning the number of
+    records and the uncompressed offset of every interval-th record.
+    """
+    step = 4 * interval # Lines between indexed records
+    offsets = [0]
+    n_lines = 0
+    pos = 0
+    with open_fastq(fpath) as f:
+        while True:
+            chunk = f.read(1 << 22)
+            if not chunk:
+                break
+            newlines = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8)
+                                      == ord('\n'))
+            # Line number n_lines + k + 1 starts after newline k
+            k = len(offsets) * step - n_lines - 1
+            while k < len(newlines):
+                offsets.append(pos + int(newlines[k]) + 1)
+                k += step
+            n_lines += len(newlines)
+            pos += len(chunk)
+            last = chunk
+        if pos and not last.endswith(b'\n'):
+            n_lines += 1 # Last line has no newline
+    n_records = n_lines // 4
+    offsets = [o for i, o in enumerate(offsets) if i * interval < n_records]
+    return n_records, offsets
+
+def record_index(fpath, interval=INDEX_INTERVAL):
+    """
+    Return (interval, n_records, offsets) for fpath, where offsets[i] is the
+    offset of record i * interval (see Shard). A BGZF file's own index is
+    used if it has one; otherwise the file is scanned, and the result
+    cached in <fpath>.shardidx.json.
+    """
+    if file_format(fpath) == 'bgzf':
+        bgzf_interval, n_records, voffsets = read_index(fpath)
+        return bgzf_interval, n_records, [int(v) for v in voffsets]
+
+    cache_path = fpath + _INDEX_SUFFIX
+    fingerprint = fingerprint_file(fpath)
+    if os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cached = json.load(f)
+        if (cached['fingerprint'] == fingerprint
+                and cached['interval'] == interval):
+            return interval, cached['n_records'], cached['offsets']
+
+    n_records, offsets = _scan_offsets(fpath, interval)
+    try:
+        with atomic_open(cache_path) as f:
+            json.dump({'fingerprint': fingerprint, 'interval': interval,
+                       'n_records': n_records, 'offsets': offsets}, f)
+    except OSError:
+        pass # Read-only directory; just don't cache
+    return interval, n_records, offsets
+
+def _shard_at(fpath, fmt, index, start, stop):
+    interval, _, offsets = index
+    if not offsets:
+        return Shard(fpath, start, stop, 0, 0, fmt)
+    entry = min(start // interval, len(offsets) - 1)
+    return Shard(fpath, start, stop, offsets[entry], entry * interval, fmt)
+
+def plan_shards(f_name, pe_name, n_shards, lockstep=False,
+                interval=INDEX_INTERVAL):
+    """
+    Split a run's forward read file into at most n_shards shards of about
+    the same number of records. Returns a list of (forward, paired-end)
+    Shard tuples.
+
+    If lockstep is True, the files must list mates in the same order, and
+    each paired-end shard covers the same records as its forward shard.
+    Otherwise mates are found by coordinates, so every paired-end shard is
+    the whole paired-end file, which each shard then reads and indexes in
+    full.
+
+    Shards of BGZF files start by seeking straight to their records. A
+    plain gzip stream cannot be entered part way through, so shard k of n
+    first decompresses about k/n of the file to reach its records; the
+    shards together decompress it about n/2 times over. Convert gzipped
+    inputs to BGZF (see nextgen4b.process.bgzf) before sharding them.
+    """
+    if n_shards < 1:
+        raise ValueError('n_shards must be at least 1.')
+    f_fmt = file_format(f_name)
+    f_index = record_index(f_name, interval)
+    n_records = f_index[1]
+
+    # Start shards on indexed records, so no records are skipped over
+    step = f_index[0]
+    bounds = set(min(n_records, step * int(round(k * n_records /
+                                                 float(n_shards * step))))
+                 for k in range(n_shards))
+    bounds = sorted(bounds | set([n_records]))
+    if len(bounds) < 2: # No records
+        bounds = [0, n_records]
+
+    if lockstep:
+        pe_fmt = file_format(pe_name)
+        pe_index = record_index(pe_name, interval)
+        if pe_index[1] != n_records:
+            raise ValueError('%s has %i reads and %s has %i, so they cannot '
+                             'be read in lockstep.' % (f_name, n_records,
+                                                       pe_name, pe_index[1]))
+
+    shards = []
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        f_shard = _shard_at(f_name, f_fmt, f_index, start, stop)
+        if lockstep:
+            pe_shard = _shard_at(pe_name, pe_fmt, pe_index, start, stop)
+        else:
+            pe_shard = Shard(pe_name)
+        shards.append((f_shard, pe_shard))
+    return shards
+
+#####################
+# Manifests and Merging
+#####################
+
+def shard_name(run, i):
+    return '%s.shard%03i' % (run, i)
+
+def save_shard_manifest(fpath, run, run_data, bcs, templates, shards,
+                        expts=None, filter_kwargs=None):
+    """
+    Write a JSON description of a sharded run, from which each shard can be
+    filtered on its own (possibly on another machine with the same files
+    and working directory) and the results merged (see run_shard and
+    merge_shards in nextgen4b.process.filter). filter_kwargs must be
+    JSON-serializable.
+    """
+    manifest = {'run': run,
+                'run_data': run_data,
+                'bcs': bcs,
+                'templates': templates,
+                'expts': list(expts) if expts is not None else list(bcs),
+                'filter_kwargs': filter_kwargs or {},
+                'shards': [{'name': shard_name(run, i),
+                            'f_read': f_shard.to_dict(),
+                            'pe_read': pe_shard.to_dict()}
+                           for i, (f_shard, pe_shard) in enumerate(shards)]}
+    try:
+        text = json.dumps(manifest, indent=1, sort_keys=True)
+    except TypeError as e:
+        raise ValueError('Shard manifest settings must be JSON-serializable '
+                         '(%s).' % e)
+    with atomic_open(fpath) as f:
+        f.write(text)
+
+def load_shard_manifest(fpath):
+    """
+    Read a manifest written by save_shard_manifest, with its shards as
+    Shard objects.
+    """
+    with open(fpath) as f:
+        manifest = json.load(f)
+    for shard in manifest['shards']:
+        shard['f_read'] = Shard.from_dict(shard['f_read'])
+        shard['pe_read'] = Shard.from_dict(shard['pe_read'])
+    return manifest
+
+def merge_csv_rows(row_lists):
+    """
+    Sum csv logger rows of per-experiment counts (expt,n,n,...) from each
+    shard into one row per experiment, in the order they first appear.
+    """
+    totals = collections.OrderedDict()
+    for rows in row_lists:
+        for row in rows:
+            fields = row.split(',')
+            counts = [int(n) for n in fields[1:]]
+            if fields[0] in totals:
+                totals[fields[0]] = [a + b for a, b in
+                                     zip(totals[fields[0]], counts)]
+            else:
+                totals[fields[0]] = counts
+    return [','.join([expt] + [str(n) for n in counts])
+            for expt, counts in totals.items()]
@@ -1,8 +1,12 @@
-from Bio import SeqIO
+import numpy as np
 import yaml
 import sys
 import os
 
+from .store import load
+
+_DASH = ord('-')
+
 def replace_deletions(word, seq, idxs, del_letter='d'):
     """
     Replace any '-' in word with del_letter if the nucleotides next to it in
@@ -21,11 +25,71 @@ def replace_deletions(word, seq, idxs, del_letter='d'):
 
     return ''.join(new_word)
 
+def site_matrix(reads, sites, keep_dashes=True, mark_deletions=False,
+                del_letter='d'):
+    """
+    Pull out the bases at the (0-start) indices in sites from every read in
+    reads (AlignedReads from nextgen4b.process.store), as a single array
+    operation.
+
+    Returns (words, weights): words is an (n_words, len(sites)) uint8 array
+    of ASCII letters, and weights the number of reads each row stands for
+    (from the store's counts, or all ones). keep_dashes and mark_deletions
+    are as in get_positions.
+    """
+    sites = np.asarray(sites, dtype=np.intp)
+    seqs = reads.seqs
+    words = np.array(seqs[:, sites], dtype=np.uint8) # Copy, so writable
+    weights = reads.weights()
+
+    dashes = words == _DASH
+    if keep_dashes:
+        if mark_deletions and dashes.any():
+            if len(sites) and (sites.min() < 1 or sites.max() >= reads.width - 1):
+                raise ValueError('Cannot mark deletions at the first or last '
+                                 'position of a read.')
+            flanked = ((np.asarray(seqs[:, sites - 1]) != _DASH)
+                       & (np.asarray(seqs[:, sites + 1]) != _DASH))
+            words[dashes & flanked] = ord(del_letter)
+    else:
+        keep = ~dashes.any(axis=1)
+        words = words[keep]
+        weights = weights[keep]
+    return words, weights
+
+def words_to_strings(words, weights=None):
+    """
+    Convert a uint8 word matrix from site_matrix to a list of strings, each
+    repeated by its weight if weights are given.
+    """
+    if weights is not None and (weights != 1).any():
+        words = np.repeat(words, weights, axis=0)
+    n, k = words.shape
+    if k == 0:
+        return [''] * n
+    text = np.ascontiguousarray(words).tobytes().decode('ascii')
+    return [text[i:i+k] for i in range(0, len(text), k)]
+
+def count_words(words, weights=None):
+    """
+    Count the distinct rows of a uint8 word matrix from site_matrix,
+    weighted by weights if given. Returns a dict of word to count.
+    """
+    n, k = words.shape
+    if weights is None:
+        weights = np.ones(n, dtype=np.int64)
+    if k == 0:
+        return {'': int(np.sum(weights))} if n else {}
+    keys = np.ascontiguousarray(words).view('S%i' % k).ravel()
+    unique, inverse = np.unique(keys, return_inverse=True)
+    counts = np.bincount(inverse, weights=weights, minlength=len(unique))
+    return {u.decode('ascii'): int(c) for u, c in zip(unique, counts)}
+
 def get_positions(f_name, sites, keep_dashes=True, mark_deletions=False):
     """
     Reads in a fasta file of sequences (usually produced by nextgen_main.py)
-    at location f_name, and pulls out the bases at the (0-start) indices in
-    sites.
+    or an aligned read store at location f_name, and pulls out the bases at
+    the (0-start) indices in sites.
 
     Input:
         - f_name: str
@@ -42,21 +106,43 @@ def get_positions(f_name, sites, keep_dashes=True, mark_deletions=False):
         both sides) will be marked (with a 'd', but this should be
         customizable?)
     """
+    words, weights = site_matrix(load(f_name), sites, keep_dashes=keep_dashes,
+                                 mark_deletions=mark_deletions)
+    return words_to_strings(words, weights)
 
-    words = []
-    with open(f_name) as f:
-        seq_iter = SeqIO.parse(f, 'fasta')
-        for s in seq_iter:
-            selected_letters = ''.join([str(s.seq[i]) for i in sites])
-            if '-' not in selected_letters:
-                words.append(selected_letters)
-            elif keep_dashes:
-                if mark_deletions:
-                    words.append(replace_deletions(selected_letters, s, sites))
-                else:
-                    words.append(selected_letters)
-
-    return words
+def count_positions(f_name, sites, keep_dashes=True, mark_deletions=False):
+    """
+    Like get_positions, but return a dict of the number of times each word
+    occurs rather than the words themselves.
+    """
+    words, weights = site_matrix(load(f_name), sites, keep_dashes=keep_dashes,
+                                 mark_deletions=mark_deletions)
+    return count_words(words, weights)
+
+def get_positions_multi(f_names, site_sets, output='words', keep_dashes=True,
+                        mark_deletions=False):
+    """
+    Extract several sets of sites from several files, loading each file
+    only once.
+
+    site_sets is a dict of lists of sites, indexed by name. output is
+    'words' (as from get_positions) or 'counts' (as from count_positions).
+    Returns a dict of results indexed by (f_name, site set name).
+    """
+    if output not in ('words', 'counts'):
+        raise ValueError("output must be 'words' or 'counts', not %r."
+                         % output)
+    results = {}
+    for f_name in f_names:
+        reads = load(f_name)
+        for name, sites in site_sets.items():
+            words, weights = site_matrix(reads, sites, keep_dashes=keep_dashes,
+                                         mark_deletions=mark_deletions)
+            if output == 'words':
+                results[(f_name, name)] = words_to_strings(words, weights)
+            else:
+                results[(f_name, name)] = count_words(words, weights)
+    return results
 
 if __name__ == '__main__':
     in_name = sys.argv[1]
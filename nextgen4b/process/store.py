@@ -0,0 +1,311 @@
+"""
+nextgen4b.process.store
+
+A binary, memory-mappable store of aligned reads, used in place of (or
+alongside) the aln_seqs_<run>_<expt>.fa files written by the filter.
+
+Aligned reads are all as long as the template, so they are kept as a
+fixed-width uint8 matrix of ASCII characters, one row per read, followed by
+columns of alignment scores (float32) and optionally read counts (uint32),
+and the read descriptions. A small JSON header gives the shape and the
+offset of each section. The matrix and columns are opened with
+numpy.memmap, so loading is near instant and the pages are shared between
+processes reading the same file.
+"""
+import json
+import shutil
+import struct
+import tempfile
+from array import array
+
+import numpy as np
+from Bio import SeqIO
+
+__all__ = ['AlignedReads', 'StoreWriter', 'write_store', 'is_store', 'load',
+           'iter_reads', 'store_to_fasta', 'STORE_SUFFIX']
+
+STORE_SUFFIX = '.alnstore'
+
+_MAGIC = b'NG4BALN\x01'
+_HEADER_SIZE = 4096 # Fixed, so the header can be written last
+_FORMAT_VERSION = 1
+
+
+def is_store(fpath):
+    """
+    True if fpath is an aligned read store (rather than, say, FASTA).
+    """
+    try:
+        with open(fpath, 'rb') as f:
+            return f.read(len(_MAGIC)) == _MAGIC
+    except IOError:
+        return False
+
+
+class StoreWriter(object):
+    """
+    Writes aligned reads to a binary file object, a batch at a time. The
+    file must be seekable, and is finished by close(). Reads are SeqRecords
+    (or anything with seq, description and annotations) whose sequences all
+    have the same length; the score is taken from annotations['alnscore'],
+    and the count, if counts is True, from annotations['count'] (default 1).
+
+    meta is a dict of extra information kept in the header.
+    """
+
+    def __init__(self, f, width=None, counts=False, meta=None):
+        self._f = f
+        self.width = width
+        self.counts = counts
+        self.meta = meta if meta is not None else {}
+        self.n_reads = 0
+
+        self._scores = array('f')
+        self._counts = array('I')
+        self._ids = tempfile.TemporaryFile()
+        self._ids_nbytes = 0
+
+        self._f.write(b'\0' * _HEADER_SIZE)
+
+    def write(self, seqs):
+        """
+        Append a batch of aligned reads.
+        """
+        rows = [str(s.seq) for s in seqs]
+        if not rows:
+            return
+        if self.width is None:
+            self.width = len(rows[0])
+        for s, row in zip(seqs, rows):
+            if len(row) != self.width:
+                raise ValueError('Aligned read %s has length %i, not %i; '
+                                 'aligned reads must all be the same length.'
+                                 % (s.id, len(row), self.width))
+        self._f.write(''.join(rows).encode('ascii'))
+
+        self._scores.extend(s.annotations.get('alnscore', np.nan)
+                            for s in seqs)
+        if self.counts:
+            self._counts.extend(s.annotations.get('count', 1) for s in seqs)
+        ids = ('\n'.join(s.description for s in seqs) + '\n').encode('utf-8')
+        self._ids.write(ids)
+        self._ids_nbytes += len(ids)
+        self.n_reads += len(rows)
+
+    def close(self):
+        """
+        Write the columns and header. Does not close the underlying file.
+        """
+        if self.width is None:
+            self.width = 0
+        pos = _HEADER_SIZE + self.n_reads * self.width
+        pos = self._pad(pos)
+
+        header = {'format': 'nextgen4b aligned reads',
+                  'version': _FORMAT_VERSION,
+                  'n_reads': self.n_reads,
+                  'width': self.width,
+                  'seqs_offset': _HEADER_SIZE,
+                  'scores_offset': pos,
+                  'counts_offset': None,
+                  'meta': self.meta}
+        self._f.write(self._scores.tobytes())
+        pos += 4 * self.n_reads
+        if self.counts:
+            header['counts_offset'] = pos
+            self._f.write(self._counts.tobytes())
+            pos += 4 * self.n_reads
+
+        header['ids_offset'] = pos
+        header['ids_nbytes'] = self._ids_nbytes
+        self._ids.seek(0)
+        shutil.copyfileobj(self._ids, self._f)
+        self._ids.close()
+
+        header = json.dumps(header).encode('utf-8')
+        if len(_MAGIC) + 8 + len(header) > _HEADER_SIZE:
+            raise ValueError('Store header is too large; use less metadata.')
+        self._f.seek(0)
+        self._f.write(_MAGIC + struct.pack('<Q', len(header)) + header)
+        self._f.seek(0, 2)
+
+    def _pad(self, pos):
+        """
+        Pad the file to a multiple of 8 bytes, so columns are aligned.
+        """
+        n_pad = -pos % 8
+        self._f.write(b'\0' * n_pad)
+        return pos + n_pad
+
+
+def write_store(fpath, seqs, counts=False, meta=None):
+    """
+    Write a list of aligned reads to a new store at fpath.
+    """
+    with open(fpath, 'wb') as f:
+        writer = StoreWriter(f, counts=counts, meta=meta)
+        writer.write(seqs)
+        writer.close()
+
+
+class AlignedReads(object):
+    """
+    Aligned reads from a store (see load).
+
+    seqs is an (n_reads, width) uint8 array of ASCII characters, scores a
+    float32 array of alignment scores and counts a uint32 array of read
+    counts, or None if the reads were not collapsed. For a store, these are
+    read-only memory maps.
+    """
+
+    def __init__(self, seqs, scores, counts=None, ids=None, meta=None,
+                 fpath=None):
+        self.seqs = seqs
+        self.scores = scores
+        self.counts = counts
+        self.meta = meta if meta is not None else {}
+        self.fpath = fpath
+        self._ids = ids
+        self._ids_span = None # (offset, length) of the ids in a store
+
+    @classmethod
+    def from_store(cls, fpath):
+        with open(fpath, 'rb') as f:
+            if f.read(len(_MAGIC)) != _MAGIC:
+                raise ValueError('%s is not an aligned read store.' % fpath)
+            header_len, = struct.unpack('<Q', f.read(8))
+            header = json.loads(f.read(header_len).decode('utf-8'))
+        if header['version'] > _FORMAT_VERSION:
+            raise ValueError('%s has store format version %i; this version '
+                             'of nextgen4b reads up to version %i.'
+                             % (fpath, header['version'], _FORMAT_VERSION))
+
+        n = header['n_reads']
+        width = header['width']
+        if n == 0: # Empty files can't be mapped
+            seqs = np.zeros((0, width), dtype=np.uint8)
+            scores = np.zeros(0, dtype=np.float32)
+            counts = (np.zeros(0, dtype=np.uint32)
+                      if header['counts_offset'] is not None else None)
+        else:
+            seqs = np.memmap(fpath, dtype=np.uint8, mode='r',
+                             offset=header['seqs_offset'], shape=(n, width))
+            scores = np.memmap(fpath, dtype=np.float32, mode='r',
+                               offset=header['scores_offset'], shape=(n,))
+            counts = None
+            if header['counts_offset'] is not None:
+                counts = np.memmap(fpath, dtype=np.uint32, mode='r',
+                                   offset=header['counts_offset'], shape=(n,))
+        reads = cls(seqs, scores, counts, meta=header['meta'], fpath=fpath)
+        reads._ids_span = (header['ids_offset'], header['ids_nbytes'])
+        return reads
+
+    @classmethod
+    def from_fasta(cls, fpath):
+        """
+        Read a FASTA file of aligned reads into memory. Scores are NaN.
+        """
+        rows = []
+        ids = []
+        with open(fpath) as f:
+            for s in SeqIO.parse(f, 'fasta'):
+                rows.append(str(s.seq))
+                ids.append(s.description)
+        width = len(rows[0]) if rows else 0
+        if any(len(row) != width for row in rows):
+            raise ValueError('Reads in %s are not all the same length, so '
+                             'are not aligned reads.' % fpath)
+        seqs = np.frombuffer(''.join(rows).encode('ascii'),
+                             dtype=np.uint8).reshape(len(rows), width)
+        scores = np.full(len(rows), np.nan, dtype=np.float32)
+        return cls(seqs, scores, ids=ids, fpath=fpath)
+
+    @property
+    def width(self):
+        return self.seqs.shape[1]
+
+    def __len__(self):
+        return self.seqs.shape[0]
+
+    def weights(self):
+        """
+        Number of reads each row stands for: counts, or all ones.
+        """
+        if self.counts is not None:
+            return np.asarray(self.counts)
+        return np.ones(len(self), dtype=np.uint32)
+
+    def ids(self):
+        """
+        List of read descriptions.
+        """
+        if self._ids is None:
+            offset, nbytes = self._ids_span
+            with open(self.fpath, 'rb') as f:
+                f.seek(offset)
+                blob = f.read(nbytes).decode('utf-8')
+            self._ids = blob.split('\n')[:-1]
+        return self._ids
+
+    def iter_strings(self, chunk_size=65536):
+        """
+        Yield each aligned read as a string.
+        """
+        width = self.width
+        for start in range(0, len(self), chunk_size):
+            block = self.seqs[start:start+chunk_size].tobytes().decode('ascii')
+            for i in range(0, len(block), width):
+                yield block[i:i+width]
+            if width == 0:
+                for _ in range(min(chunk_size, len(self) - start)):
+                    yield ''
+
+    def iter_expanded(self):
+        """
+        Yield each aligned read as a string, as many times as its count.
+        """
+        if self.counts is None:
+            for seq in self.iter_strings():
+                yield seq
+        else:
+            for seq, count in zip(self.iter_strings(), self.counts):
+                for _ in range(count):
+                    yield seq
+
+    def write_fasta(self, handle):
+        """
+        Write the reads to a text file handle in FASTA format.
+        """
+        for desc, seq in zip(self.ids(), self.iter_strings()):
+            handle.write('>%s\n' % desc)
+            for i in range(0, len(seq), 60):
+                handle.write(seq[i:i+60] + '\n')
+
+
+def load(fpath):
+    """
+    Load aligned reads from either a store or a FASTA file.
+    """
+    if is_store(fpath):
+        return AlignedReads.from_store(fpath)
+    return AlignedReads.from_fasta(fpath)
+
+
+def iter_reads(fpath):
+    """
+    Iterate over the reads in a store (as strings, repeated by their
+    counts) or a FASTA file (as SeqRecords). Either way this is a one-pass
+    iterator, with no length and no indexing; use list() on it, or load for
+    the store's arrays, when those are needed.
+    """
+    if is_store(fpath):
+        return load(fpath).iter_expanded()
+    return SeqIO.parse(fpath, 'fasta')
+
+
+def store_to_fasta(fpath, out_path):
+    """
+    Export a store to a FASTA file.
+    """
+    with open(out_path, 'w') as out_f:
+        load(fpath).write_fasta(out_f)
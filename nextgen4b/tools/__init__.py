@@ -3,8 +3,11 @@ Ted Cybulski
 11/22/2016 (Althought this existed earlier...)
 """
 
-from nextgen4b.tools.demux import demux_dataset
+from nextgen4b.tools.demux import demux_dataset, demux_paired
 from nextgen4b.tools.experiment_yaml import generate_exp_dict
+from nextgen4b.tools.synthetic import write_synthetic_run
 
 __all__ = ['demux_dataset',
-           'generate_exp_dict']
\ No newline at end of file
+           'demux_paired',
+           'generate_exp_dict',
+           'write_synthetic_run']
@@ -1,84 +1,400 @@
+import concurrent.futures
+import contextlib
 import gzip
+import itertools
 import logging
 import sys
 import time
+from array import array
 
+import numpy as np
 import yaml
-from Bio import SeqIO
 
+from ..process.barcodes import BarcodeIndex
+from ..process.bgzf import BgzfWriter
+from ..process.fastq import FastqRecord
 from ..process.filter import get_coords, load_ngs_file
 
-def demux_by_barcode(yfname, ffname, fsuffix='R1'):
-    logging.info('Started forward sequence demuxing of '+ffname)
-    # Load YAML
+UNDETERMINED = 'Undetermined' # Experiment ID for reads without a barcode
+
+#####################
+# Output
+#####################
+
+class DemuxWriter(object):
+    """
+    A gzipped FASTQ output that buffers formatted records in memory and
+    writes them out in blocks of about buffer_size bytes, so that many
+    outputs can be written at once without a write call per read.
+
+    If bgzf is True, the output is block-compressed (see
+    nextgen4b.process.bgzf), with blocks compressed on executor if given,
+    and a record index written next to it.
+    """
+
+    def __init__(self, fpath, buffer_size=1 << 20, compresslevel=6,
+                 bgzf=False, executor=None):
+        self.fpath = fpath
+        self.buffer_size = buffer_size
+        self.n_written = 0
+        if bgzf:
+            self._f = BgzfWriter(fpath, level=compresslevel, executor=executor)
+        else:
+            self._f = gzip.open(fpath, 'wt', compresslevel=compresslevel)
+        self._bgzf = bgzf
+        self._buffer = []
+        self._buffered = 0
+
+    def write(self, s):
+        """
+        Write one record (a FastqRecord or SeqRecord).
+        """
+        if isinstance(s, FastqRecord):
+            text = s.format_fastq()
+        else:
+            text = s.format('fastq')
+        self._buffer.append(text)
+        self._buffered += len(text)
+        self.n_written += 1
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self._bgzf:
+            self._f.write_records(self._buffer)
+        else:
+            self._f.write(''.join(self._buffer))
+        self._buffer = []
+        self._buffered = 0
+
+    def close(self):
+        self.flush()
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def demux_output_name(expt, suffix):
+    return expt+'_'+suffix+'.fastq.gz'
+
+@contextlib.contextmanager
+def open_writers(expts, suffix, buffer_size=1 << 20, compresslevel=6,
+                 bgzf=False, threads=1):
+    """
+    Open a DemuxWriter for each experiment, and close them all on exit.
+    BGZF outputs share a pool of threads threads for compression.
+    """
+    with contextlib.ExitStack() as stack:
+        executor = None
+        if bgzf and threads > 1:
+            executor = stack.enter_context(
+                concurrent.futures.ThreadPoolExecutor(threads))
+        yield {expt: stack.enter_context(
+                   DemuxWriter(demux_output_name(expt, suffix),
+                               buffer_size=buffer_size,
+                               compresslevel=compresslevel, bgzf=bgzf,
+                               executor=executor))
+               for expt in expts}
+
+def log_written(writers):
+    for expt, writer in writers.items():
+        logging.info('Wrote %i sequences from experiment %s to %s',
+                     writer.n_written, expt, writer.fpath)
+
+#####################
+# Demultiplexing
+#####################
+
+def load_barcodes(yfname):
+    """
+    Return a dict of barcodes, indexed by experiment ID, from a YAML file.
+    """
     yf = open(yfname)
     expt_yaml = yaml.load(yf)
     yf.close()
     logging.info('Loaded YAML file: '+yfname)
-    
-    outfiles = {}
-    experimentList = expt_yaml['experiments'].keys()
-    logging.info('Found experiments: '+', '.join(experimentList))
-    
-    # Generate forward files
-    for expt in experimentList:
-        logging.info('Started processing experiment '+expt)
-        outfilename = expt+'_'+fsuffix+'.fastq.gz'
-        bc = expt_yaml['experiments'][expt]['barcode']
-        
-        outfiles[expt] = outfilename
-        
-        fastqf = load_ngs_file(ffname)
-        bciterator = (s for s in fastqf if str(s.seq).startswith(bc))
-        of = gzip.open(outfilename,'wb')
-        SeqIO.write(bciterator, of, "fastq")
-        of.close()
-        logging.info('Finished writing sequences from experiment '+expt+' to '+outfilename)
-    logging.info('Finished forward-strand demuxing of '+ffname)
-
-
-def demux_PE_by_barcode(yfname, pefname, fsuffix='R1', pesuffix='R2'):
+    return {expt: expt_yaml['experiments'][expt]['barcode']
+            for expt in expt_yaml['experiments'].keys()}
+
+def demux_by_barcode(yfname, ffname, fsuffix='R1', buffer_size=1 << 20,
+                     max_mismatches=0, **writer_kwargs):
+    """
+    Split the forward reads in ffname into one gzipped FASTQ file per
+    experiment in the YAML file, named <expt>_<fsuffix>.fastq.gz, by the
+    barcode each read starts with, allowing up to max_mismatches
+    substitutions. The input is read once, and every output is written as
+    it goes. Other keyword arguments (compresslevel, bgzf, threads) are
+    passed on to open_writers.
+
+    Returns a dict of output file names, indexed by experiment ID.
+    """
+    logging.info('Started forward sequence demuxing of '+ffname)
+    bcs = load_barcodes(yfname)
+    logging.info('Found experiments: '+', '.join(bcs.keys()))
+
+    bc_index = BarcodeIndex(bcs, max_mismatches=max_mismatches)
+    with open_writers(bcs.keys(), fsuffix, buffer_size,
+                      **writer_kwargs) as writers:
+        for s in load_ngs_file(ffname, compact=True):
+            for expt in bc_index.classify(s.seq):
+                writers[expt].write(s)
+
+    log_written(writers)
+    bc_index.log_counts(logging.getLogger())
+    logging.info('Finished forward-strand demuxing of %s. Assigned %i of %i '
+                 'sequences.', ffname, sum(bc_index.counts.values()),
+                 bc_index.n_classified)
+    return {expt: writer.fpath for expt, writer in writers.items()}
+
+#####################
+# Paired-End Demultiplexing
+#####################
+
+class MateIndex(object):
+    """
+    A compact map from read coordinates to the experiment(s) a read was
+    assigned to, for finding the experiment of each paired-end read.
+
+    Coordinates are stored as 64-bit hashes in a sorted numpy array, next
+    to a uint16 array of group IDs, where a group is the tuple of
+    experiments a read was assigned to. That is 10 bytes per read, rather
+    than the hundred or more a dict of coordinate strings takes. Hashes that
+    collide between reads in different groups are treated as unassigned,
+    so a collision never sends a read to the wrong experiment. Reads that
+    were not assigned to any experiment are not stored. The hashes are from
+    hash(), so an index is only valid in the process that made it.
+
+    If merge_repeats is True, a read may be added more than once (say, once
+    for each experiment whose output it was written to), and is assigned to
+    every experiment it was added with. Reads in different groups that share
+    a hash are then merged rather than unassigned, so this should only be
+    used when repeats are expected.
+    """
+
+    def __init__(self, merge_repeats=False):
+        self.groups = [()] # Group 0 is unassigned
+        self.merge_repeats = merge_repeats
+        self.n_collisions = 0
+        self._group_ids = {(): 0}
+        self._hashes = array('q')
+        self._ids = array('H')
+        self._sorted = None
+
+    def add(self, s, expts):
+        """
+        Record that read s was assigned to expts, a list of experiment IDs.
+        """
+        if not expts:
+            return
+        self._hashes.append(hash(get_coords(s)))
+        self._ids.append(self._group_id(tuple(expts)))
+        self._sorted = None
+
+    def _group_id(self, group):
+        if group not in self._group_ids:
+            if len(self.groups) > 0xFFFF:
+                raise ValueError('Too many distinct barcode matches to index.')
+            self._group_ids[group] = len(self.groups)
+            self.groups.append(group)
+        return self._group_ids[group]
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def _freeze(self):
+        hashes = np.frombuffer(self._hashes, dtype=np.int64)
+        ids = np.frombuffer(self._ids, dtype=np.uint16)
+        order = np.argsort(hashes, kind='mergesort')
+        hashes = hashes[order]
+        ids = ids[order]
+        if self.merge_repeats:
+            hashes, ids = self._merge_repeats(hashes, ids)
+
+        dup = (hashes[1:] == hashes[:-1]) & (ids[1:] != ids[:-1])
+        if dup.any():
+            clash = np.zeros(len(hashes), dtype=bool)
+            clash[1:] |= dup
+            clash[:-1] |= dup
+            # Unassign every read sharing a clashing hash
+            clash = np.isin(hashes, hashes[clash])
+            self.n_collisions = int(clash.sum())
+            ids[clash] = 0
+        self._sorted = (hashes, ids)
+
+    def _merge_repeats(self, hashes, ids):
+        """
+        Collapse runs of equal (sorted) hashes into one entry, assigned to
+        the union of their groups' experiments.
+        """
+        starts = np.flatnonzero(np.r_[True, hashes[1:] != hashes[:-1]])
+        ends = np.r_[starts[1:], len(hashes)]
+        merged = ids[starts].copy()
+        for k in np.flatnonzero(ends - starts > 1):
+            expts = []
+            for i in ids[starts[k]:ends[k]]:
+                expts.extend(e for e in self.groups[i] if e not in expts)
+            merged[k] = self._group_id(tuple(expts))
+        return hashes[starts], merged
+
+    def lookup(self, seqs):
+        """
+        Return a list of the experiment tuple each read in seqs was assigned
+        to, or () if none.
+        """
+        if self._sorted is None:
+            self._freeze()
+        hashes, ids = self._sorted
+        if not len(hashes):
+            return [()] * len(seqs)
+        query = np.fromiter((hash(get_coords(s)) for s in seqs),
+                            dtype=np.int64, count=len(seqs))
+        pos = np.minimum(np.searchsorted(hashes, query), len(hashes) - 1)
+        found = np.where(hashes[pos] == query, ids[pos], 0)
+        return [self.groups[i] for i in found]
+
+
+def mates_are_ordered(ffname, pefname, n_check=1000):
+    """
+    True if the first n_check reads of ffname and pefname are mates in the
+    same order, so the files can be walked in lockstep.
+    """
+    f_reads = itertools.islice(load_ngs_file(ffname, compact=True), n_check)
+    pe_reads = itertools.islice(load_ngs_file(pefname, compact=True), n_check)
+    for s, mate in itertools.zip_longest(f_reads, pe_reads):
+        if s is None or mate is None or get_coords(s) != get_coords(mate):
+            return False
+    return True
+
+def demux_paired(yfname, ffname, pefname, fsuffix='R1', pesuffix='R2',
+                 lockstep=None, buffer_size=1 << 20, batch_size=100000,
+                 max_mismatches=0, **writer_kwargs):
+    """
+    Split forward and paired-end reads into per-experiment gzipped FASTQ
+    files by the barcode on the forward read, allowing up to max_mismatches
+    substitutions in the barcode. Reads without a barcode, and
+    paired-end reads whose mate was not assigned to an experiment, go to
+    Undetermined_<suffix>.fastq.gz.
+
+    If lockstep is True, the two files must hold mates in the same order,
+    and are read side by side. If False, the forward reads are indexed by
+    coordinates (see MateIndex) as they are demultiplexed, and the
+    paired-end reads are looked up in batches of batch_size. If None, the
+    start of the files is checked to pick a mode.
+
+    Other keyword arguments (compresslevel, bgzf, threads) are passed on to
+    open_writers.
+
+    Returns a (forward, paired-end) tuple of dicts of output file names,
+    indexed by experiment ID.
+    """
+    logging.info('Started paired demuxing of %s and %s', ffname, pefname)
+    bcs = load_barcodes(yfname)
+    logging.info('Found experiments: '+', '.join(bcs.keys()))
+    if lockstep is None:
+        lockstep = mates_are_ordered(ffname, pefname)
+    logging.info('Pairing mates %s.',
+                 'in lockstep' if lockstep else 'by coordinate index')
+
+    expts = list(bcs.keys()) + [UNDETERMINED]
+    bc_index = BarcodeIndex(bcs, max_mismatches=max_mismatches)
+    undetermined = (UNDETERMINED,)
+    with open_writers(expts, fsuffix, buffer_size,
+                      **writer_kwargs) as f_writers, \
+         open_writers(expts, pesuffix, buffer_size,
+                      **writer_kwargs) as pe_writers:
+        f_reads = load_ngs_file(ffname, compact=True)
+        pe_reads = load_ngs_file(pefname, compact=True)
+        if lockstep:
+            for s, mate in itertools.zip_longest(f_reads, pe_reads):
+                if s is None or mate is None:
+                    raise ValueError('%s and %s hold different numbers of '
+                                     'reads.' % (ffname, pefname))
+                if get_coords(s) != get_coords(mate):
+                    raise ValueError('Reads %s and %s are not mates; the '
+                                     'files are not in the same order, so '
+                                     'use lockstep=False.' % (s.id, mate.id))
+                for expt in bc_index.classify(s.seq) or undetermined:
+                    f_writers[expt].write(s)
+                    pe_writers[expt].write(mate)
+        else:
+            mate_index = MateIndex()
+            for s in f_reads:
+                matches = bc_index.classify(s.seq)
+                mate_index.add(s, matches)
+                for expt in matches or undetermined:
+                    f_writers[expt].write(s)
+            logging.info('Indexed %i forward read coordinates.',
+                         len(mate_index))
+            demux_mates_indexed(pe_reads, mate_index, pe_writers, batch_size)
+
+    log_written(f_writers)
+    log_written(pe_writers)
+    bc_index.log_counts(logging.getLogger())
+    logging.info('Finished paired demuxing. Assigned %i of %i read pairs.',
+                 sum(bc_index.counts.values()), bc_index.n_classified)
+    return ({expt: w.fpath for expt, w in f_writers.items()},
+            {expt: w.fpath for expt, w in pe_writers.items()})
+
+def demux_mates_indexed(pe_reads, mate_index, pe_writers, batch_size=100000):
+    """
+    Write each paired-end read to the outputs of the experiments its mate
+    was assigned to in mate_index, or to the undetermined output.
+    """
+    while True:
+        batch = list(itertools.islice(pe_reads, batch_size))
+        if not batch:
+            break
+        for mate, group in zip(batch, mate_index.lookup(batch)):
+            for expt in group or (UNDETERMINED,):
+                pe_writers[expt].write(mate)
+    if mate_index.n_collisions:
+        logging.warning('%i forward reads had clashing coordinate hashes; '
+                        'their mates were left undetermined.',
+                        mate_index.n_collisions)
+
+def demux_PE_by_barcode(yfname, pefname, fsuffix='R1', pesuffix='R2',
+                        buffer_size=1 << 20, **writer_kwargs):
+    """
+    Deprecated: use demux_paired, which splits both files in one pass
+    without reading the forward outputs back. Kept for outputs written by
+    demux_by_barcode alone.
+
+    Split paired-end reads by the experiment of their mates in forward
+    read files already written by demux_by_barcode.
+    """
     logging.info('Started paired-end sequence demuxing of '+pefname)
-    yf = open(yfname)
-    expt_yaml = yaml.load(yf)
-    yf.close()
-    logging.info('Loaded YAML file: '+yfname)
-    
-    coordsToExperiment = {}
-    experimentList = expt_yaml['experiments'].keys()
-    logging.info('Found experiments: '+', '.join(experimentList))
-    
-    logging.info('Generating forward seq coordinate dictionary')
-    # Generate coordinate ID to experiments
-    for expt in experimentList:
-        outfilename = expt+'_'+fsuffix+'.fastq.gz' # Assumes these things were generated by above code. Should be improved...
-        bcf = load_ngs_file(outfilename)
-        coords = ((get_coords(s), expt) for s in bcf)
-        coordsToExperiment.update(coords)
+    bcs = load_barcodes(yfname)
+
+    # A read is in several outputs if barcodes are prefixes of each other
+    mate_index = MateIndex(merge_repeats=True)
+    for expt in bcs.keys():
+        for s in load_ngs_file(demux_output_name(expt, fsuffix), compact=True):
+            mate_index.add(s, [expt])
         logging.info('Processed sequences for experiment '+expt)
-    logging.info('Generated forward dictionary, found '+str(len(coordsToExperiment.keys()))+' sequences.')
-        
-    # Generate paired-end files
-    logging.info('Finding experiment for each paired-end sequence.')
-    pes = load_ngs_file(pefname)
-    pe_files = {expt: gzip.open(expt+'_'+pesuffix+'.fastq.gz', 'wb') for expt in experimentList}
-    for seq in pes:
-        try:
-            seq_expt = coordsToExperiment[get_coords(seq)]
-            SeqIO.write(seq, pe_files[seq_expt], 'fastq')
-        except: # What exception did this catch? Why does it fail silently?
-            pass
-    logging.info('Finished experiment-matching for paired-end sequences.')
+    logging.info('Indexed %i forward read coordinates.', len(mate_index))
+
+    expts = list(bcs.keys()) + [UNDETERMINED]
+    with open_writers(expts, pesuffix, buffer_size,
+                      **writer_kwargs) as pe_writers:
+        demux_mates_indexed(load_ngs_file(pefname, compact=True), mate_index,
+                            pe_writers)
+    log_written(pe_writers)
     logging.info('Finished paired-end strand demuxing for '+pefname)
+    return {expt: w.fpath for expt, w in pe_writers.items()}
 
-def demux_dataset(yfname, ffname, pefname):
+def demux_dataset(yfname, ffname, pefname, lockstep=None, max_mismatches=0,
+                  **writer_kwargs):
     # Initialize logging
     timestr = time.strftime("%Y%m%d-%H%M%S")
     logging.basicConfig(filename='bcdemux_'+timestr+'.log',
         level=logging.DEBUG, format='%(asctime)s %(message)s')
 
-    demux_by_barcode(yfname, ffname)
-    demux_PE_by_barcode(yfname, pefname)
+    return demux_paired(yfname, ffname, pefname, lockstep=lockstep,
+                        max_mismatches=max_mismatches, **writer_kwargs)
     
 if __name__ == '__main__':
     demux_dataset(sys.argv[1], sys.argv[2], sys.argv[3])
@@ -0,0 +1,224 @@
+"""
+nextgen4b.tools.synthetic
+
+Deterministic synthetic paired-end data for testing and benchmarking the
+filter and analysis code without real sequencing data.
+
+Each simulated DNA fragment is laid out the way the filter expects:
+
+    barcode + forward adapter 0 + insert + forward adapter 1
+
+where the insert is a copy of the template with substitutions, insertions
+and deletions. The forward read is the fragment read from the barcode end,
+and the paired-end read is the fragment read from the other end. Reads
+longer than the fragment run on into random sequence. Read names are in
+Illumina format, so mates can be paired by their coordinates.
+"""
+import argparse
+import gzip
+import os
+import sys
+
+import numpy as np
+import yaml
+
+from ..process.fastq import FastqRecord
+
+__all__ = ['simulate_read_pairs', 'write_synthetic_run', 'DEFAULT_TEMPLATE',
+           'DEFAULT_FILTER_SEQS', 'DEFAULT_BARCODES']
+
+DEFAULT_TEMPLATE = ('GGGCTAGTCGTCTGTATAGGTCTTGCTTCTATCTTTGGCTTCTGTATTTGTCG'
+                    'TCTTGCTTATTGTTCTTGTTCTTATGTTCTGTTCTGGTATTTCGGTT')
+DEFAULT_FILTER_SEQS = {'forward': ['CATTGTCCCTAT', 'AGACCAAGTCTCTGCTACCGTA'],
+                       'reverse': ['']}
+DEFAULT_BARCODES = {'exp1': 'ACGT', 'exp2': 'TGCA', 'exp3': 'GATC',
+                    'exp4': 'CTAG'}
+
+_BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+_RC_TABLE = str.maketrans('ACGTN', 'TGCAN')
+
+
+def _reverse_complement(seq):
+    return seq.translate(_RC_TABLE)[::-1]
+
+def _random_bases(rng, n):
+    return _BASES[rng.randint(0, 4, n)].tobytes().decode('ascii')
+
+def mutate(rng, seq, sub_rate=0.005, ins_rate=0.0005, del_rate=0.0005):
+    """
+    Copy seq with random substitutions (always to a different base),
+    insertions and deletions, each at the given per-base rate.
+    """
+    codes = np.frombuffer(seq.encode('ascii'), dtype=np.uint8).copy()
+    subs = rng.random_sample(len(codes)) < sub_rate
+    if subs.any():
+        idx = np.searchsorted(_BASES, codes[subs])
+        codes[subs] = _BASES[(idx + rng.randint(1, 4, subs.sum())) % 4]
+
+    indels = rng.random_sample(len(codes))
+    if not (indels < ins_rate + del_rate).any():
+        return codes.tobytes().decode('ascii')
+
+    out = []
+    for c, r in zip(codes.tobytes().decode('ascii'), indels):
+        if r < del_rate:
+            continue
+        elif r < del_rate + ins_rate:
+            out.append(_random_bases(rng, 1))
+        out.append(c)
+    return ''.join(out)
+
+def quality_string(rng, length, profile='decay', low_q_rate=0.02):
+    """
+    Phred+33 quality string for a read.
+
+    profile is 'constant' (Q40 throughout), 'decay' (Illumina-like: high
+    at the start of the read and falling off towards the end, with noise),
+    or a function taking (rng, length) and returning an array of scores.
+    With probability low_q_rate, one random base gets a score of 10, so
+    quality filtering has something to remove.
+    """
+    if callable(profile):
+        quals = np.asarray(profile(rng, length), dtype=float)
+    elif profile == 'constant':
+        quals = np.full(length, 40.)
+    elif profile == 'decay':
+        pos = np.arange(length) / float(max(length - 1, 1))
+        quals = 38 - 12 * pos**2 + rng.normal(0, 1.5, length)
+    else:
+        raise ValueError('Unknown quality profile %r.' % profile)
+    quals = np.clip(np.round(quals), 2, 41).astype(np.uint8)
+    if length and rng.random_sample() < low_q_rate:
+        quals[rng.randint(length)] = 10
+    return (quals + 33).tobytes().decode('ascii')
+
+def simulate_read_pairs(n_reads, templates=DEFAULT_TEMPLATE,
+                        barcodes=DEFAULT_BARCODES,
+                        filter_seqs=DEFAULT_FILTER_SEQS, read_len=150,
+                        sub_rate=0.005, ins_rate=0.0005, del_rate=0.0005,
+                        pe_mismatch_rate=0.01, unbarcoded_rate=0.02,
+                        quality='decay', low_q_rate=0.02, seed=0):
+    """
+    Yield n_reads (forward, paired-end) FastqRecord pairs.
+
+    templates is one template sequence, or a dict of templates indexed by
+    experiment ID. barcodes is a dict of barcodes indexed by experiment ID;
+    reads are shared evenly between experiments, except for a fraction
+    unbarcoded_rate that get a random barcode instead. filter_seqs has the
+    same layout as in the experiment YAML file: the first two forward
+    sequences flank the insert. A fraction pe_mismatch_rate of paired-end
+    reads get an extra substitution in the insert, so fail paired-end
+    matching. The same seed always gives the same reads.
+    """
+    rng = np.random.RandomState(seed)
+    expts = sorted(barcodes.keys())
+    if not isinstance(templates, dict):
+        templates = {expt: templates for expt in expts}
+    forward = list(filter_seqs['forward']) + ['', '']
+    adapter0, adapter1 = forward[0], forward[1]
+    bc_len = max([len(bc) for bc in barcodes.values()] + [0])
+
+    for i in range(n_reads):
+        expt = expts[rng.randint(len(expts))]
+        bc = barcodes[expt]
+        if bc_len and rng.random_sample() < unbarcoded_rate:
+            bc = _random_bases(rng, bc_len)
+        insert = mutate(rng, templates[expt], sub_rate=sub_rate,
+                        ins_rate=ins_rate, del_rate=del_rate)
+        fragment = bc + adapter0 + insert + adapter1
+
+        f_seq = fragment[:read_len]
+        f_seq += _random_bases(rng, read_len - len(f_seq))
+
+        pe_fragment = fragment
+        if insert and rng.random_sample() < pe_mismatch_rate:
+            pos = len(bc + adapter0) + rng.randint(len(insert))
+            new_base = 'ACGT'.replace(fragment[pos], '')[rng.randint(3)]
+            pe_fragment = fragment[:pos] + new_base + fragment[pos+1:]
+        pe_seq = _reverse_complement(pe_fragment)[:read_len]
+        pe_seq += _random_bases(rng, read_len - len(pe_seq))
+
+        # Illumina read names: instrument:run:flowcell:lane:tile:x:y
+        coords = 'SYN:1:FC0001:1:%i:%i:%i' % (1101 + i // 1000000,
+                                              1000 + i % 1000,
+                                              1000 + (i // 1000) % 1000)
+        yield (FastqRecord('%s 1:N:0:1' % coords, f_seq,
+                           quality_string(rng, read_len, quality,
+                                          low_q_rate)),
+               FastqRecord('%s 2:N:0:1' % coords, pe_seq,
+                           quality_string(rng, read_len, quality,
+                                          low_q_rate)))
+
+def write_synthetic_run(out_dir, n_reads, run='synthetic', compress=True,
+                        templates=DEFAULT_TEMPLATE, barcodes=DEFAULT_BARCODES,
+                        filter_seqs=DEFAULT_FILTER_SEQS, **sim_kwargs):
+    """
+    Write a synthetic run to out_dir: forward and paired-end FASTQ files
+    (gzipped if compress is True), and an experiment YAML file describing
+    them that can be passed to run_all_experiments. Other keyword
+    arguments are passed to simulate_read_pairs.
+
+    Each experiment's template_seq in the YAML file is the first forward
+    adapter followed by the template, as that is what the trimmed forward
+    reads hold after the barcode.
+
+    Returns the path to the YAML file.
+    """
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    if not isinstance(templates, dict):
+        templates = {expt: templates for expt in barcodes.keys()}
+
+    suffix = '.fastq.gz' if compress else '.fastq'
+    f_name = '%s_S1_L001_R1_001%s' % (run, suffix)
+    pe_name = '%s_S1_L001_R2_001%s' % (run, suffix)
+    opener = gzip.open if compress else open
+    with opener(os.path.join(out_dir, f_name), 'wt') as f_out, \
+         opener(os.path.join(out_dir, pe_name), 'wt') as pe_out:
+        for f_read, pe_read in simulate_read_pairs(n_reads,
+                                                   templates=templates,
+                                                   barcodes=barcodes,
+                                                   filter_seqs=filter_seqs,
+                                                   **sim_kwargs):
+            f_out.write(f_read.format_fastq())
+            pe_out.write(pe_read.format_fastq())
+
+    adapter0 = filter_seqs['forward'][0] if filter_seqs['forward'] else ''
+    expt_yaml = {
+        'ngsruns': {run: {'experiments': sorted(barcodes.keys()),
+                          'f_read_name': f_name,
+                          'pe_read_name': pe_name,
+                          'filter_seqs': {'forward': list(filter_seqs['forward']),
+                                          'reverse': list(filter_seqs['reverse'])}}},
+        'experiments': {expt: {'name': expt,
+                               'barcode': barcodes[expt],
+                               'exp_data': {},
+                               'template_seq': adapter0 + templates[expt]}
+                        for expt in barcodes.keys()}}
+    yaml_path = os.path.join(out_dir, '%s.yaml' % run)
+    with open(yaml_path, 'w') as yaml_f:
+        yaml_f.write(yaml.dump(expt_yaml, default_flow_style=False))
+    return yaml_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Write a synthetic paired-end run and its YAML file.')
+    parser.add_argument('out_dir')
+    parser.add_argument('-n', '--n-reads', type=int, default=100000)
+    parser.add_argument('--read-len', type=int, default=150)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--sub-rate', type=float, default=0.005)
+    parser.add_argument('--indel-rate', type=float, default=0.001)
+    parser.add_argument('--quality', choices=['decay', 'constant'],
+                        default='decay')
+    parser.add_argument('--no-compress', action='store_true')
+    args = parser.parse_args(sys.argv[1:])
+
+    print(write_synthetic_run(args.out_dir, args.n_reads,
+                              compress=not args.no_compress,
+                              read_len=args.read_len, seed=args.seed,
+                              sub_rate=args.sub_rate,
+                              ins_rate=args.indel_rate / 2,
+                              del_rate=args.indel_rate / 2,
+                              quality=args.quality))